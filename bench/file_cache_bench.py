@@ -0,0 +1,100 @@
+"""Micro-benchmark of generator status updates through FileCache.
+
+Compares the old way of updating status (re-writing the whole request dict,
+with a new sqlite connection for every access) with FileCache.set_status.
+Both run against databases in a temporary directory, so the live session
+database isn't touched.
+
+    python bench/file_cache_bench.py [--updates 2000] [--stations 500]
+"""
+
+import argparse
+import importlib.util
+import os
+import pickle
+import shutil
+import sqlite3
+import tempfile
+import time
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+FILE_CACHE = os.path.join(script_dir, '..', 'mapgen', 'file_cache.py')
+
+
+class OldFileCache:
+    """FileCache as it was before it kept its connections open: a new
+    connection per access, in the default journal mode, with no separate
+    status table."""
+
+    def __init__(self, cache_file):
+        self.cache_file = cache_file
+        with sqlite3.connect(self.cache_file) as cache:
+            cur = cache.cursor()
+            cur.execute("CREATE TABLE IF NOT EXISTS cache(key,value, UNIQUE(key))")
+
+    def __setitem__(self, key, value):
+        value = pickle.dumps(value)
+        with sqlite3.connect(self.cache_file) as cache:
+            cur = cache.cursor()
+            try:
+                cur.execute("INSERT INTO cache (key,value) VALUES (?,?)",
+                            (key, value))
+            except sqlite3.IntegrityError:
+                cur.execute("UPDATE cache SET value=? WHERE key=?",
+                            (value, key))
+            cache.commit()
+
+
+def load_file_cache(tmp_dir):
+    """The current FileCache, loaded from a copy of file_cache.py in tmp_dir
+    so its database is created there"""
+    path = os.path.join(tmp_dir, 'file_cache.py')
+    shutil.copyfile(FILE_CACHE, path)
+    spec = importlib.util.spec_from_file_location('bench_file_cache', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.FileCache()
+
+
+def request_data(stations):
+    """A map request about the size of a real one"""
+    return {
+        'station': [{'name': f'STA{i}', 'lat': 55.0 + i / 1000, 'lon': -160 + i / 1000,
+                     'category': 'Seismometer', 'labelLat': 55.1, 'labelLon': -160.1,
+                     'anchorLat': 55.05, 'anchorLon': -160.05}
+                    for i in range(stations)],
+        'insetBounds': [(-160.0, 55.0, -159.0, 56.0)] * 4,
+        'width': 10.0,
+        'height': 7.5,
+    }
+
+
+def run(updates, stations):
+    data = request_data(stations)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        old = OldFileCache(os.path.join(tmp_dir, 'old_session'))
+        old['req'] = data
+        t_start = time.perf_counter()
+        for idx in range(updates):
+            data['gen_status'] = {'status': 'Downloading', 'progress': idx / updates * 100}
+            old['req'] = data
+        t_old = time.perf_counter() - t_start
+
+        new = load_file_cache(tmp_dir)
+        new['req'] = data
+        t_start = time.perf_counter()
+        for idx in range(updates):
+            new.set_status('req', {'status': 'Downloading', 'progress': idx / updates * 100})
+        t_new = time.perf_counter() - t_start
+
+    print(f"{updates} status updates, request with {stations} stations")
+    print(f"old FileCache, full dict per status update: {updates / t_old:8.0f} writes/sec")
+    print(f"new FileCache, set_status:                  {updates / t_new:8.0f} writes/sec")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Benchmark FileCache status updates")
+    parser.add_argument('--updates', type = int, default = 2000)
+    parser.add_argument('--stations', type = int, default = 500)
+    args = parser.parse_args()
+    run(args.updates, args.stations)
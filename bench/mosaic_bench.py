@@ -0,0 +1,166 @@
+"""Benchmark of mosaicing and warping hillshade tiles, VRT vs gdal_merge.
+
+Starts the elevation stand-in server (mapgen/elevation_server.py) in
+synthetic mode, downloads the tiles covering an area through
+ElevationClient, and reads them in place from the downloaded zip of zips,
+as MapGenerator does. Then times, for the same map area:
+
+merge
+    gdal_merge into one file, then warp that (MOSAIC_MODE = 'merge')
+vrt
+    a VRT of the tiles, warped in one pass, at full resolution
+vrt+size
+    the same, at the resolution needed to draw the map (MOSAIC_MODE =
+    'vrt', as _warp_mosaic does without the raster cache)
+
+Needs GDAL, and mapgen/config.py (as for running the app).
+
+    python bench/mosaic_bench.py [--tiles 5 4] [--width 8] [--repeat 3]
+"""
+
+import argparse
+import json
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(script_dir, '..', 'mapgen'))
+
+import osgeo.gdal
+
+from osgeo_utils.gdal_merge import main as gdal_merge
+from shapely.geometry import box, mapping
+
+import elevation_server
+
+from elevation_client import ElevationClient
+from mapgenerator import MapGenerator
+from raster_cache import RasterCache
+
+# South west corner of the area, in Alaska as for real maps
+WEST, SOUTH = -150.0, 61.0
+
+
+def start_server(data_dir):
+    """Run a synthetic stand-in server in a thread, returning its URL"""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+
+    thread = threading.Thread(target = elevation_server.run_server,
+                              kwargs = {'port': port, 'data_dir': data_dir},
+                              daemon = True)
+    thread.start()
+    return f"http://127.0.0.1:{port}"
+
+
+def download_tiles(url, bounds, tmp_dir):
+    """Download the tiles covering bounds, returning their /vsizip paths"""
+    client = ElevationClient(url)
+    geojson = json.dumps(mapping(box(*bounds)))
+    for attempt in range(50):
+        try:
+            client.dataset_info(geojson, MapGenerator.HILLSHADE_DATASET)
+            break
+        except OSError:
+            time.sleep(0.1)  # Server still starting
+
+    zf_path = os.path.join(tmp_dir, 'download.zip')
+    t_start = time.perf_counter()
+    client.download(geojson, MapGenerator.HILLSHADE_DATASET, zf_path)
+    print(f"Downloaded in {time.perf_counter() - t_start:.2f}s")
+
+    tiles = []
+    with zipfile.ZipFile(zf_path) as outer:
+        for inner_name in outer.namelist():
+            with zipfile.ZipFile(outer.open(inner_name)) as inner:
+                tiles += [f"/vsizip//vsizip/{zf_path}/{inner_name}/{name}"
+                          for name in inner.namelist() if name.endswith('.tif')]
+
+    return tiles
+
+
+def warp_kwargs(map_bounds):
+    return {
+        "dstSRS": "EPSG:4326",
+        "multithread": True,
+        "warpOptions": ['NUM_THREADS=ALL_CPUS'],
+        "creationOptions": ['NUM_THREADS=ALL_CPUS'],
+        "outputBounds": map_bounds,
+    }
+
+
+def run_merge(tiles, map_bounds, out_size, tmp_dir):
+    merged = os.path.join(tmp_dir, 'merged.tiff')
+    out_file = os.path.join(tmp_dir, 'merge-processed.tiff')
+    if os.path.exists(merged):
+        os.remove(merged)  # gdal_merge would update it in place
+    gdal_merge(['mosaic_bench.py', '-o', merged] + tiles)
+    osgeo.gdal.Warp(out_file, merged, **warp_kwargs(map_bounds))
+    return out_file
+
+
+def run_vrt(tiles, map_bounds, out_size, tmp_dir):
+    vrt_file = os.path.join(tmp_dir, 'combined_image.vrt')
+    out_file = os.path.join(tmp_dir, 'vrt-processed.tiff')
+    vrt = osgeo.gdal.BuildVRT(vrt_file, tiles)
+    del vrt  # Flush to disk
+    kwargs = warp_kwargs(map_bounds)
+    if out_size is not None:
+        generator = MapGenerator.__new__(MapGenerator)
+        need_x, need_y = generator._degrees_per_pixel(map_bounds, out_size)
+        source = osgeo.gdal.Open(tiles[0]).GetGeoTransform()
+        kwargs['xRes'] = max(source[1], RasterCache.snap_resolution(need_x))
+        kwargs['yRes'] = max(-source[5], RasterCache.snap_resolution(need_y))
+        kwargs['resampleAlg'] = 'average'
+
+    osgeo.gdal.Warp(out_file, vrt_file, **kwargs)
+    return out_file
+
+
+def run(tiles_x, tiles_y, width, repeat):
+    size = elevation_server.TILE_SIZE
+    # Just inside the tiles, so the warp has to trim them
+    map_bounds = [WEST + size / 10, SOUTH + size / 10,
+                  WEST + tiles_x * size - size / 10, SOUTH + tiles_y * size - size / 10]
+    out_size = MapGenerator._mercator_size(map_bounds, width)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        url = start_server(os.path.join(tmp_dir, 'server'))
+        tiles = download_tiles(url, [WEST, SOUTH, WEST + tiles_x * size,
+                                     SOUTH + tiles_y * size], tmp_dir)
+        print(f"{len(tiles)} tiles of {elevation_server.TILE_PIXELS}px, map "
+              f"{out_size[0]:.1f}x{out_size[1]:.1f} in at {MapGenerator.HILLSHADE_DPI} dpi")
+
+        modes = (('merge', run_merge, None),
+                 ('vrt', run_vrt, None),
+                 ('vrt+size', run_vrt, out_size))
+        for name, func, mode_size in modes:
+            times = []
+            for _ in range(repeat):
+                t_start = time.perf_counter()
+                out_file = func(tiles, map_bounds, mode_size, tmp_dir)
+                times.append(time.perf_counter() - t_start)
+
+            ds = osgeo.gdal.Open(out_file)
+            pixels = f"{ds.RasterXSize}x{ds.RasterYSize}"
+            del ds
+            print(f"{name:<9} {min(times):7.2f}s best of {repeat}, output {pixels}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Benchmark mosaicing hillshade tiles")
+    parser.add_argument('--tiles', type = int, nargs = 2, default = [5, 4],
+                        metavar = ('X', 'Y'), help = "Size of the area, in tiles")
+    parser.add_argument('--width', type = float, default = 8,
+                        help = "Map width, in inches")
+    parser.add_argument('--repeat', type = int, default = 3)
+    args = parser.parse_args()
+
+    osgeo.gdal.UseExceptions()
+    run(args.tiles[0], args.tiles[1], args.width, args.repeat)
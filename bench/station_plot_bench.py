@@ -0,0 +1,143 @@
+"""Benchmark of the station plotting stage of MapGenerator.
+
+Runs the station methods of MapGenerator (from the working tree, or any
+git revision) against a recording stand-in for the pygmt figure, for 1k
+and 10k labelled stations. Reports the number of figure plot/text calls
+(each a full GMT module run) and the time taken on the Python side. GMT
+itself isn't run, so neither pygmt nor GDAL is needed.
+
+    python bench/station_plot_bench.py [--rev REV] [--stations 1000 10000]
+
+e.g. compare with --rev <commit>^ for the code before a change.
+"""
+
+import argparse
+import ast
+import contextlib
+import logging
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import types
+import uuid
+
+from collections import defaultdict
+from tempfile import NamedTemporaryFile
+
+import numpy
+import pandas
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+repo_dir = os.path.dirname(script_dir)
+GENERATOR = os.path.join(repo_dir, 'mapgen', 'mapgenerator.py')
+
+# The MapGenerator methods involved in plotting stations, across versions
+METHODS = ('_prepare_stations', '_add_stations', '_plot_label_lines',
+           '_temp_path', 'tempdir')
+
+
+class RecordingFigure:
+    """Stand-in for pygmt.Figure, counting the calls made to it"""
+
+    def __init__(self):
+        self.calls = 0
+        self.segments = 0
+
+    def plot(self, data = None, **kwargs):
+        self.calls += 1
+        if data is not None:
+            with open(data) as file:
+                self.segments += file.read().count('>')
+
+    def text(self, **kwargs):
+        self.calls += 1
+
+
+def load_generator(rev = None):
+    """The MapGenerator class with only its station methods, from rev (or
+    the working tree)"""
+    if rev is None:
+        with open(GENERATOR) as file:
+            source = file.read()
+    else:
+        source = subprocess.run(['git', 'show', f'{rev}:mapgen/mapgenerator.py'],
+                                cwd = repo_dir, check = True, capture_output = True,
+                                text = True).stdout
+
+    tree = ast.parse(source)
+    cls = next(node for node in tree.body
+               if isinstance(node, ast.ClassDef) and node.name == 'MapGenerator')
+    cls.body = [node for node in cls.body
+                if isinstance(node, ast.Assign)
+                or (isinstance(node, ast.FunctionDef) and node.name in METHODS)]
+
+    namespace = {'__file__': GENERATOR, 'numpy': numpy, 'pandas': pandas, 'os': os,
+                 'uuid': uuid, 'logging': logging, 'tempfile': tempfile,
+                 'defaultdict': defaultdict, 'NamedTemporaryFile': NamedTemporaryFile}
+    exec(compile(ast.Module(body = [cls], type_ignores = []), GENERATOR, 'exec'), namespace)
+    return namespace['MapGenerator']
+
+
+def make_stations(count):
+    rng = random.Random(1)
+    categories = ['volcanoRED', 'volcanoGREEN', 'Seismometer', 'GPS', 'Infrasound', 'Camera']
+    return [{'category': rng.choice(categories),
+             'lon': -150 + rng.random(), 'lat': 60 + rng.random(), 'name': f'STA{idx}',
+             'labelLon': -150, 'labelLat': 60, 'anchorLon': -150.1, 'anchorLat': 60.1}
+            for idx in range(count)]
+
+
+def run_stations(generator_class, stations):
+    generator = generator_class.__new__(generator_class)
+    generator._tmp_dir = tempfile.mkdtemp()
+    generator._used_symbols = {}
+    generator.scale_factor = 1
+    generator.BASE_SYM_SIZE = 16
+    generator.BASE_FONT_SIZE = 11
+    generator._update_status = lambda *args, **kwargs: None
+    generator.fig = RecordingFigure()
+    options = ['Seismometer', 'GPS', 'Infrasound', 'Camera']
+    generator.data = {
+        'station': stations,
+        'showVolcNames': 'TL',
+        'showStationNames': 'TL',
+        'showVolcColor': True,
+        'staOpt_Name': options,
+        'staOpt_Icon': ['c', 's', 'd', 'i'],
+        'staOpt_Color': ['#FF0000', '#00FF00', '#0000FF', '#00FFFF'],
+        'staOpt_Label': options,
+    }
+
+    cwd = os.getcwd()
+    t_start = time.perf_counter()
+    try:
+        if hasattr(generator, '_prepare_stations'):
+            generator._add_stations(generator._prepare_stations(stations), 12)
+        else:
+            generator._add_stations(stations, 12)
+    finally:
+        os.chdir(cwd)
+
+    return generator.fig, time.perf_counter() - t_start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Benchmark station plotting")
+    parser.add_argument('--rev', help = "git revision to take mapgenerator.py from")
+    parser.add_argument('--stations', type = int, nargs = '+', default = [1000, 10000])
+    args = parser.parse_args()
+
+    # Only pygmt.config is used outside the figure
+    pygmt = types.ModuleType('pygmt')
+    pygmt.config = lambda **kwargs: contextlib.nullcontext()
+    sys.modules['pygmt'] = pygmt
+
+    generator_class = load_generator(args.rev)
+    print(f"mapgenerator.py from {args.rev or 'the working tree'}")
+    for count in args.stations:
+        fig, elapsed = run_stations(generator_class, make_stations(count))
+        print(f"{count:>6} stations: {fig.calls:>6} plot/text calls, "
+              f"{fig.segments:>6} leader line segments, {elapsed * 1000:7.1f} ms")
@@ -0,0 +1,104 @@
+"""Peak memory of parsing multipart uploads with BaseSchema.parse.
+
+Builds single-file multipart request bodies of increasing size on disk, and
+parses each through BaseSchema.parse in a fresh process, reporting that
+process's peak RSS. For comparison, each body is also parsed the old way,
+reading the whole body into memory first. Streamed, peak memory should stay
+flat as the upload grows.
+
+Needs streaming-form-data, and mapgen/config.py (as for running the app).
+
+    python bench/upload_stream_bench.py [--sizes 50 100 200 400]
+"""
+
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(script_dir, '..', 'mapgen'))
+
+BOUNDARY = 'benchboundary7MA4YWxkTrZu0gW'
+MIB = 1024 * 1024
+
+
+def write_body(path, size):
+    """Write a multipart body with a text field and a size byte file"""
+    block = os.urandom(MIB)
+    with open(path, 'wb') as body:
+        body.write((f'--{BOUNDARY}\r\n'
+                    'Content-Disposition: form-data; name="name"\r\n\r\n'
+                    'bench\r\n'
+                    f'--{BOUNDARY}\r\n'
+                    'Content-Disposition: form-data; name="imgFile"; filename="upload.tif"\r\n'
+                    'Content-Type: application/octet-stream\r\n\r\n').encode('UTF-8'))
+        written = 0
+        while written < size:
+            chunk = block[:size - written]
+            body.write(chunk)
+            written += len(chunk)
+        body.write(f'\r\n--{BOUNDARY}--\r\n'.encode('UTF-8'))
+
+
+def parse(mode, path):
+    """Parse the body at path (in this process), returning the seconds taken"""
+    from streaming_form_data import StreamingFormDataParser
+    from targets import BaseSchema, File, Value
+
+    class BenchSchema(BaseSchema):
+        name = Value(str)
+        imgFile = File()
+
+    with tempfile.TemporaryDirectory() as upload_dir:
+        parser = StreamingFormDataParser(
+            headers = {'Content-Type': f'multipart/form-data; boundary={BOUNDARY}'}
+        )
+        schema = BenchSchema(parser, upload_dir)
+        t_start = time.perf_counter()
+        with open(path, 'rb') as body:
+            if mode == 'stream':
+                schema.parse(body, os.path.getsize(path))
+            else:
+                # As BaseSchema.parse used to: the whole body, then parse it
+                parser.data_received(body.read())
+        values = schema.values()
+        elapsed = time.perf_counter() - t_start
+
+    if values['name'] != 'bench':
+        raise RuntimeError("Upload not parsed")
+
+    return elapsed
+
+
+def run(sizes):
+    print(f"{'upload':>8}  {'mode':<8}  {'peak RSS':>10}  {'time':>7}")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'body')
+        for size in sizes:
+            write_body(path, size * MIB)
+            for mode in ('stream', 'whole'):
+                # Each parse in its own process, so peak RSS is its own
+                output = subprocess.run([sys.executable, __file__, '--child', mode, path],
+                                        check = True, capture_output = True, text = True).stdout
+                elapsed, peak = output.split()
+                print(f"{size:>5} MB  {mode:<8}  {float(peak) / MIB:>6.1f} MiB  {float(elapsed):>6.2f}s")
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description = "Benchmark upload parsing memory use")
+    arg_parser.add_argument('--sizes', type = int, nargs = '+', default = [50, 100, 200, 400],
+                            help = "Upload sizes to try, in MB")
+    arg_parser.add_argument('--child', nargs = 2, metavar = ('MODE', 'PATH'),
+                            help = argparse.SUPPRESS)
+    args = arg_parser.parse_args()
+
+    if args.child:
+        elapsed = parse(*args.child)
+        # ru_maxrss is in KiB on Linux
+        print(elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024)
+    else:
+        run(args.sizes)
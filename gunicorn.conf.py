@@ -7,8 +7,12 @@ chdir = script_dir
 user = "www-data"
 group = "www-data"
 bind = ['unix:/run/mapgen/gunicorn.sock','127.0.0.1:5002']
-workers = 1
-threads = 100
+# Generator status messages are routed through mapgen/status_broker.py, and
+# the job queue, MAX_CONCURRENT_JOBS limit and identical in-progress
+# requests are shared through sqlite, so any worker can accept a map request
+# or hold its web socket. Each worker runs GENERATOR_WORKERS generators.
+workers = 4
+threads = 25
 worker_connections = 102
 timeout = 300
 accesslog = "/var/log/mapgen/access.log"
@@ -7,4 +7,100 @@ DB_HOST = 'my.host.server'
 DB_USER = 'myuser'
 DB_PASSWORD = 'MyPassword'
 DB_NAME = 'MyDBName'
+DB_POOL_SIZE = 5  # Maximum open connections per process
+DB_CONNECT_TIMEOUT = 5  # seconds
 
+# How long to use the active volcano list before refreshing it from the database
+VOLCANO_CACHE_TTL = 60 * 60
+
+
+# Server hillshade tiles are downloaded from, and the timeout (seconds) for
+# connecting to it and for each read from it. For offline testing, run the
+# stand-in server (python mapgen/elevation_server.py --help) and point this
+# at it, e.g. 'http://localhost:8001'.
+ELEVATION_URL = 'https://elevation.alaska.gov'
+ELEVATION_TIMEOUT = 60
+
+# Local cache of hillshade tiles downloaded from elevation.alaska.gov.
+# TILE_CACHE_DIR defaults to the cache directory inside the mapgen package.
+TILE_CACHE_DIR = None
+TILE_CACHE_SIZE = 10 * 1024 ** 3  # bytes
+
+# Directory of the local elevation store, built with mapgen/elevation_store.py.
+# Maps entirely inside the area it covers are made from it, rather than from
+# tiles downloaded from elevation.alaska.gov. None to always download.
+ELEVATION_STORE = None
+
+# How multiple hillshade tiles are combined. 'vrt' mosaics them in a VRT and
+# warps them in one pass, at no more than the resolution needed for the map.
+# 'merge' writes a full resolution merged file with gdal_merge first.
+MOSAIC_MODE = 'vrt'
+
+# Processed (mosaiced and warped) hillshades are kept so later maps of the
+# same area can be cut out of them. RASTER_CACHE_DIR defaults to the cache
+# directory inside the mapgen package. Only used with MOSAIC_MODE = 'vrt'.
+RASTER_CACHE_DIR = None
+RASTER_CACHE_SIZE = 5 * 1024 ** 3  # bytes
+
+# Hillshades for inset maps that don't overlap are prepared in up to this
+# many threads at once, while the main map is drawn.
+INSET_WORKERS = 4
+
+# Pool of map generator worker processes, in each web server process.
+# Workers are replaced after GENERATOR_MAX_JOBS maps, or when they use more
+# than GENERATOR_MAX_RSS bytes.
+GENERATOR_WORKERS = 1
+GENERATOR_MAX_JOBS = 25
+GENERATOR_MAX_RSS = 2 * 1024 ** 3
+
+# Maximum number of maps to generate at once, across all web server
+# processes (defaults to GENERATOR_WORKERS). Should be no more than
+# GENERATOR_WORKERS times the number of gunicorn workers. Cheap, low zoom
+# maps may skip ahead of queued high zoom maps, but no map is skipped once
+# it has waited SCHEDULER_MAX_WAIT seconds.
+MAX_CONCURRENT_JOBS = 2
+SCHEDULER_MAX_WAIT = 120
+
+# Maximum number of progress updates per second sent to the client while
+# generating a map. Step changes and errors are always sent immediately.
+STATUS_UPDATES_PER_SEC = 4
+
+# Have nginx send finished maps using X-Accel-Redirect, rather than sending
+# them through the app. Must match the internal location in the nginx config,
+# e.g. '/mapgen/maps/'. Files are removed X_ACCEL_CLEANUP_DELAY seconds later.
+X_ACCEL_REDIRECT_PREFIX = None
+X_ACCEL_CLEANUP_DELAY = 300
+
+# Finished maps still in the cache directory after this many seconds (never
+# downloaded, or missed by the cleanup above after a restart) are removed by
+# a periodic sweep. Should be well over X_ACCEL_CLEANUP_DELAY.
+MAP_FILE_MAX_AGE = 60 * 60
+
+# Finished maps are kept for RESULT_CACHE_TTL seconds, up to RESULT_CACHE_SIZE
+# bytes total, so identical requests can be served without re-generating them.
+RESULT_CACHE_TTL = 24 * 60 * 60
+RESULT_CACHE_SIZE = 2 * 1024 ** 3
+
+# A map being generated for one request is shared with identical requests
+# for up to IN_FLIGHT_TIMEOUT seconds, after which it is assumed lost and the
+# next identical request generates it again.
+IN_FLIGHT_TIMEOUT = 60 * 60
+
+# Unix socket of the status broker, which routes generator status messages to
+# whichever web server process holds the client's web socket. Defaults to
+# status_broker.sock in the cache directory inside the mapgen package.
+STATUS_BROKER_ADDRESS = None
+# Web server processes that fall this many status messages behind are
+# disconnected from the broker.
+STATUS_BROKER_QUEUE = 100
+
+# Uploaded images, and their processed versions, are kept by content hash so
+# repeat uploads can be skipped. UPLOAD_STORE_DIR defaults to the cache
+# directory inside the mapgen package.
+UPLOAD_STORE_DIR = None
+UPLOAD_STORE_SIZE = 20 * 1024 ** 3  # bytes
+
+# Uploads are read in UPLOAD_CHUNK_SIZE byte chunks, and rejected once they
+# pass MAX_UPLOAD_SIZE bytes (keep in line with client_max_body_size in nginx)
+UPLOAD_CHUNK_SIZE = 64 * 1024
+MAX_UPLOAD_SIZE = 1024 ** 3
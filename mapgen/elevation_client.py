@@ -0,0 +1,181 @@
+"""Client for the elevation.alaska.gov query and download API, or anything
+else implementing it at ELEVATION_URL (such as a local stand-in server for
+testing)."""
+
+import logging
+import os
+import threading
+import time
+
+import requests
+
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    from . import config
+except ImportError:
+    import config
+
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """The requests Session shared by everything in this process, which
+    keeps connections to the server open between requests, and retries
+    failed connections and server errors."""
+    global _session, _session_pid
+    with _session_lock:
+        if _session is None or _session_pid != os.getpid():
+            retry = Retry(total = 3,
+                          backoff_factor = 0.5,
+                          status_forcelist = (429, 500, 502, 503, 504),
+                          allowed_methods = None)  # query.json POSTs are safe to retry
+            adapter = HTTPAdapter(pool_connections = 4,
+                                  pool_maxsize = 8,
+                                  max_retries = retry)
+            _session = requests.Session()
+            _session.mount('https://', adapter)
+            _session.mount('http://', adapter)
+            _session_pid = os.getpid()
+
+    return _session
+
+
+class ElevationClient:
+    def __init__(self, base_url = None, timeout = None):
+        if base_url is None:
+            base_url = getattr(config, 'ELEVATION_URL', 'https://elevation.alaska.gov')
+        if timeout is None:
+            timeout = getattr(config, 'ELEVATION_TIMEOUT', 60)
+
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+
+    def dataset_info(self, geojson, dataset):
+        """The server's listing for dataset in the area of geojson (including
+        the estimated download size in 'bytes'), or None if it has none."""
+        resp = get_session().post(f"{self.base_url}/query.json",
+                                  data = {'geojson': geojson, },
+                                  timeout = self.timeout)
+        resp.raise_for_status()
+        for info in resp.json():
+            if info['dataset_id'] == dataset:
+                return info
+
+        return None
+
+    def download(self, geojson, dataset, path, progress = None, max_attempts = 5):
+        """Download the zip of dataset files in the area of geojson to path.
+
+        Interrupted transfers are resumed with HTTP Range requests, if the
+        server gave a validator (a strong ETag, or Last-Modified) to make sure
+        the rest comes from the same file. Otherwise, or if the server can't
+        resume from the right place, they start over. progress, if given, is
+        called with the number of bytes received each time more arrive
+        (negative if a transfer has to start over).
+
+        Returns the number of bytes downloaded.
+        """
+        session = get_session()
+        params = {'geojson': geojson, 'ids': dataset}
+        received = 0
+        attempt = 0
+        validator = None
+        with open(path, 'wb') as file:
+
+            def restart():
+                nonlocal received
+                if progress and received:
+                    progress(-received)
+                file.seek(0)
+                file.truncate()
+                received = 0
+
+            while True:
+                headers = {}
+                if received:
+                    if validator is None:
+                        # /download builds the zip per request, so without a
+                        # validator the rest may not belong to what we have.
+                        logging.info("No validator to resume with, restarting download")
+                        restart()
+                    else:
+                        headers['Range'] = f"bytes={received}-"
+                        headers['If-Range'] = validator
+
+                try:
+                    with session.get(f"{self.base_url}/download",
+                                     params = params,
+                                     headers = headers,
+                                     stream = True,
+                                     timeout = self.timeout) as resp:
+                        if received and resp.status_code == 416:
+                            logging.info("Server rejected range request, restarting download")
+                            restart()
+                            validator = None
+                            raise _Restart()
+
+                        resp.raise_for_status()
+                        if received and resp.status_code == 206:
+                            if _range_start(resp.headers.get('Content-Range')) != received:
+                                logging.info("Server resumed from the wrong place, restarting download")
+                                restart()
+                                validator = None
+                                raise _Restart()
+                        elif received:
+                            # Range not supported, or the file has changed.
+                            # This is the whole file. Start again.
+                            logging.info("Server ignored range request, restarting download")
+                            restart()
+
+                        if not received:
+                            validator = _validator(resp)
+
+                        for chunk in resp.iter_content(chunk_size = 1024 * 1024):
+                            file.write(chunk)
+                            received += len(chunk)
+                            if progress:
+                                progress(len(chunk))
+
+                    return received
+                except (requests.exceptions.ConnectionError,
+                        requests.exceptions.ChunkedEncodingError,
+                        requests.exceptions.Timeout,
+                        _Restart) as err:
+                    attempt += 1
+                    if attempt >= max_attempts:
+                        if isinstance(err, _Restart):
+                            raise requests.exceptions.RetryError("Unable to resume download")
+                        raise
+
+                    if not isinstance(err, _Restart):
+                        logging.warning(f"Download interrupted after {received} bytes ({err}). Resuming.")
+                        time.sleep(min(0.5 * 2 ** attempt, 10))
+
+
+class _Restart(Exception):
+    """A resumed download has to start over with a fresh request"""
+
+
+def _validator(resp):
+    """If-Range value for resuming resp, or None if it has no usable one"""
+    etag = resp.headers.get('ETag')
+    if etag and not etag.startswith('W/'):  # Weak ETags can't be used in If-Range
+        return etag
+
+    return resp.headers.get('Last-Modified')
+
+
+def _range_start(content_range):
+    """First byte position of a "bytes start-end/size" Content-Range, or None"""
+    try:
+        unit, spec = content_range.split(' ', 1)
+        if unit != 'bytes':
+            return None
+        return int(spec.split('-', 1)[0])
+    except (AttributeError, ValueError):
+        return None
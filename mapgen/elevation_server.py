@@ -0,0 +1,305 @@
+"""Local stand-in for the elevation.alaska.gov query.json and download API,
+for testing and benchmarking hillshade downloads offline.
+
+    python mapgen/elevation_server.py --mode synthetic --port 8001
+
+then set ELEVATION_URL = 'http://localhost:8001' in config.py.
+
+Modes:
+
+synthetic
+    Serve generated GeoTIFF tiles (a smooth, continuous pattern on a regular
+    lon/lat grid) for any requested area, in the same zip of zips layout as
+    the real server. Tiles are generated once, and kept in the data dir.
+record
+    Pass requests on to the real server (--upstream), saving the responses
+    in the data dir.
+replay
+    Serve responses saved by record. Requests that weren't recorded get a
+    404.
+
+--latency and --bandwidth simulate a slow server or connection, so changes
+to download, decompression and warping can be measured offline.
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import math
+import os
+import shutil
+import tempfile
+import time
+import uuid
+import zipfile
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+from shapely.geometry import box, shape
+
+# Size of the synthetic tiles, in degrees and pixels. Downloads have one
+# inner zip for each 1 degree block.
+TILE_SIZE = 0.25
+TILE_PIXELS = 1024
+
+
+def _synthetic_tile(path, lon, lat):
+    import numpy
+    import osgeo.gdal
+    import osgeo.osr
+
+    step = TILE_SIZE / TILE_PIXELS
+    lons = lon + (numpy.arange(TILE_PIXELS) + 0.5) * step
+    lats = lat + TILE_SIZE - (numpy.arange(TILE_PIXELS) + 0.5) * step
+    lon_grid, lat_grid = numpy.meshgrid(lons, lats)
+    # Continuous across tile edges, so mosaics look like terrain
+    data = (128
+            + 60 * numpy.sin(lon_grid * 7.3) * numpy.cos(lat_grid * 5.1)
+            + 40 * numpy.sin(lon_grid * 41.0 + lat_grid * 37.0))
+    data = numpy.clip(data, 0, 255).astype(numpy.uint8)
+
+    srs = osgeo.osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+
+    # Concurrent requests may generate the same tile
+    tmp_path = f"{path}.{uuid.uuid4().hex}"
+    driver = osgeo.gdal.GetDriverByName('GTiff')
+    ds = driver.Create(tmp_path, TILE_PIXELS, TILE_PIXELS, 1, osgeo.gdal.GDT_Byte,
+                       options = ['COMPRESS=DEFLATE', 'TILED=YES'])
+    ds.SetGeoTransform((lon, step, 0, lat + TILE_SIZE, 0, -step))
+    ds.SetProjection(srs.ExportToWkt())
+    ds.GetRasterBand(1).WriteArray(data)
+    del ds
+    os.replace(tmp_path, path)
+
+
+class _Synthetic:
+    def __init__(self, data_dir, outer_compression):
+        self.tile_dir = os.path.join(data_dir, 'synthetic')
+        os.makedirs(self.tile_dir, exist_ok = True)
+        self.outer_compression = outer_compression
+
+    def _tiles(self, geojson):
+        """(lon, lat, path) of each tile touching the geojson area,
+        generating any that don't exist yet"""
+        area = shape(json.loads(geojson))
+        minx, miny, maxx, maxy = area.bounds
+        tiles = []
+        for x in range(math.floor(minx / TILE_SIZE), math.ceil(maxx / TILE_SIZE)):
+            for y in range(math.floor(miny / TILE_SIZE), math.ceil(maxy / TILE_SIZE)):
+                lon, lat = x * TILE_SIZE, y * TILE_SIZE
+                if not area.intersects(box(lon, lat, lon + TILE_SIZE, lat + TILE_SIZE)):
+                    continue
+
+                path = os.path.join(self.tile_dir, f"tile_{lon:.2f}_{lat:.2f}.tif")
+                if not os.path.isfile(path):
+                    _synthetic_tile(path, lon, lat)
+                tiles.append((lon, lat, path))
+
+        return tiles
+
+    def query(self, form):
+        tiles = self._tiles(form['geojson'])
+        size = sum(os.path.getsize(path) for lon, lat, path in tiles)
+        return [{'dataset_id': 151,
+                 'dataset_name': 'Synthetic DSM Hillshade',
+                 'num_files': len(tiles),
+                 'bytes': size}]
+
+    def download(self, params, out_file):
+        blocks = {}
+        for lon, lat, path in self._tiles(params['geojson']):
+            blocks.setdefault((math.floor(lon), math.floor(lat)), []).append(path)
+
+        with zipfile.ZipFile(out_file, 'w', self.outer_compression) as outer:
+            for (lon, lat), paths in sorted(blocks.items()):
+                with tempfile.NamedTemporaryFile(suffix = '.zip') as inner_file:
+                    with zipfile.ZipFile(inner_file, 'w', zipfile.ZIP_DEFLATED) as inner:
+                        for path in paths:
+                            inner.write(path, f"tiles/{os.path.basename(path)}")
+                    inner_file.flush()
+                    outer.write(inner_file.name, f"block_{lon}_{lat}.zip")
+
+
+class _Recorder:
+    """Record responses from an upstream server, or replay them"""
+
+    def __init__(self, data_dir, upstream = None):
+        self.record_dir = os.path.join(data_dir, 'recorded')
+        os.makedirs(self.record_dir, exist_ok = True)
+        self.upstream = upstream
+
+    def _path(self, endpoint, values):
+        key = json.dumps([endpoint, sorted(values.items())])
+        return os.path.join(self.record_dir,
+                            hashlib.sha256(key.encode('UTF-8')).hexdigest())
+
+    def _fetch(self, endpoint, values, out_file):
+        import requests
+
+        url = f"{self.upstream.rstrip('/')}/{endpoint}"
+        if endpoint == 'query.json':
+            resp = requests.post(url, data = values, stream = True)
+        else:
+            resp = requests.get(url, params = values, stream = True)
+        resp.raise_for_status()
+        # Replies are replayed without a Content-Encoding, so save the
+        # decoded body, not what came over the wire.
+        resp.raw.decode_content = True
+        with open(out_file, 'wb') as file:
+            shutil.copyfileobj(resp.raw, file)
+
+    def response(self, endpoint, values, out_file):
+        """Copy the response for this request to out_file. Returns False if
+        there isn't one."""
+        path = self._path(endpoint, values)
+        if not os.path.isfile(path):
+            if self.upstream is None:
+                return False
+
+            logging.info(f"Recording {endpoint} {values}")
+            tmp_path = f"{path}.{uuid.uuid4().hex}"
+            self._fetch(endpoint, values, tmp_path)
+            os.replace(tmp_path, path)
+
+        shutil.copyfile(path, out_file)
+        return True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def _delay(self):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+    def _send_file(self, path, content_type):
+        """Send path, honouring any Range (and If-Range) header, at the
+        simulated bandwidth"""
+        size = os.path.getsize(path)
+        # Responses are built per request, so the ETag is of the content
+        digest = hashlib.sha256()
+        with open(path, 'rb') as file:
+            for chunk in iter(lambda: file.read(1024 * 1024), b''):
+                digest.update(chunk)
+        etag = f'"{digest.hexdigest()}"'
+
+        start = 0
+        range_header = self.headers.get('Range', '')
+        if_range = self.headers.get('If-Range')
+        if (range_header.startswith('bytes=') and range_header.endswith('-')
+                and if_range in (None, etag)):
+            start = int(range_header[6:-1])
+            if start >= size:
+                self.send_response(416)
+                self.send_header('Content-Range', f"bytes */{size}")
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+
+        if start:
+            self.send_response(206)
+            self.send_header('Content-Range', f"bytes {start}-{size - 1}/{size}")
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(size - start))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', etag)
+        self.end_headers()
+
+        chunk_size = 64 * 1024
+        t_start = time.monotonic()
+        sent = 0
+        with open(path, 'rb') as file:
+            file.seek(start)
+            while True:
+                chunk = file.read(chunk_size)
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+                sent += len(chunk)
+                if self.server.bandwidth:
+                    ahead = sent / self.server.bandwidth - (time.monotonic() - t_start)
+                    if ahead > 0:
+                        time.sleep(ahead)
+
+    def _respond(self, endpoint, values, content_type):
+        self._delay()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            out_file = os.path.join(tmp_dir, 'response')
+            backend = self.server.backend
+            if isinstance(backend, _Recorder):
+                if not backend.response(endpoint, values, out_file):
+                    self.send_error(404, "Request not recorded")
+                    return
+            elif endpoint == 'query.json':
+                with open(out_file, 'w') as file:
+                    json.dump(backend.query(values), file)
+            else:
+                backend.download(values, out_file)
+
+            self._send_file(out_file, content_type)
+
+    def do_POST(self):
+        if urlsplit(self.path).path.rstrip('/') != '/query.json':
+            self.send_error(404)
+            return
+
+        length = int(self.headers.get('Content-Length', 0))
+        form = dict(parse_qsl(self.rfile.read(length).decode('UTF-8')))
+        self._respond('query.json', form, 'application/json')
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path.rstrip('/') != '/download':
+            self.send_error(404)
+            return
+
+        self._respond('download', dict(parse_qsl(url.query)), 'application/zip')
+
+
+def run_server(port = 8001, mode = 'synthetic', data_dir = None, upstream = None,
+               latency = 0, bandwidth = None, outer_compression = zipfile.ZIP_STORED):
+    if data_dir is None:
+        script_dir = os.path.dirname(__file__)
+        data_dir = os.path.join(script_dir, 'cache', 'elevation_server')
+    os.makedirs(data_dir, exist_ok = True)
+
+    if mode == 'synthetic':
+        backend = _Synthetic(data_dir, outer_compression)
+    else:
+        backend = _Recorder(data_dir, upstream if mode == 'record' else None)
+
+    server = ThreadingHTTPServer(('', port), _Handler)
+    server.backend = backend
+    server.latency = latency
+    server.bandwidth = bandwidth
+    logging.info(f"Elevation stand-in ({mode}) listening on port {port}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level = logging.INFO)
+    parser = argparse.ArgumentParser(description = "Local stand-in for elevation.alaska.gov")
+    parser.add_argument('--port', type = int, default = 8001)
+    parser.add_argument('--mode', choices = ('synthetic', 'record', 'replay'),
+                        default = 'synthetic')
+    parser.add_argument('--data-dir', help = "Where to keep generated tiles and recordings")
+    parser.add_argument('--upstream', default = 'https://elevation.alaska.gov',
+                        help = "Server to record from")
+    parser.add_argument('--latency', type = float, default = 0,
+                        help = "Seconds to wait before each response")
+    parser.add_argument('--bandwidth', type = float,
+                        help = "Maximum bytes/second to send, per response")
+    parser.add_argument('--outer-compression', choices = ('stored', 'deflated'),
+                        default = 'stored',
+                        help = "How inner zips are stored in downloads")
+    args = parser.parse_args()
+
+    compression = {'stored': zipfile.ZIP_STORED,
+                   'deflated': zipfile.ZIP_DEFLATED}[args.outer_compression]
+    run_server(args.port, args.mode, args.data_dir, args.upstream,
+               args.latency, args.bandwidth, compression)
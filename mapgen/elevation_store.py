@@ -0,0 +1,185 @@
+"""Local, multi-resolution store of elevation (hillshade) data.
+
+Used instead of downloading tiles from elevation.alaska.gov for any map
+entirely inside the area it covers. Built from a directory of DSM GeoTIFFs
+with:
+
+    python mapgen/elevation_store.py /path/to/dsm/tiffs [--srs EPSG:3338]
+
+Each GeoTIFF is converted to a tiled, compressed Cloud Optimized GeoTIFF
+(with its own overviews), and the lot mosaiced in a VRT with overviews of
+its own, so maps of large areas don't need to open every tile. Warps from
+the store read whichever overview level is closest to (but not coarser
+than) the resolution the map is drawn at.
+
+Re-running the command, on the same or another directory, picks up new or
+changed GeoTIFFs, and rebuilds the mosaic from everything in the store.
+"""
+
+import argparse
+import glob
+import hashlib
+import json
+import logging
+import os
+import uuid
+
+import osgeo.gdal
+
+from shapely import wkt
+from shapely.ops import unary_union
+
+try:
+    from . import config
+    from .tile_cache import raster_footprint
+except ImportError:
+    import config
+    from tile_cache import raster_footprint
+
+
+_COG_OPTIONS = [
+    'COMPRESS=DEFLATE',
+    'PREDICTOR=2',
+    'BLOCKSIZE=512',
+    'OVERVIEWS=AUTO',
+    'NUM_THREADS=ALL_CPUS',
+]
+
+
+class ElevationStore:
+    """Read side of the store. Does nothing useful (covers() is always False)
+    if no store has been set up."""
+
+    def __init__(self, store_dir = None):
+        if store_dir is None:
+            store_dir = getattr(config, 'ELEVATION_STORE', None)
+
+        self.store_dir = store_dir
+        self._info = None
+        if store_dir is not None:
+            try:
+                with open(os.path.join(store_dir, 'store.json')) as file:
+                    self._info = json.load(file)
+            except FileNotFoundError:
+                logging.warning(f"No elevation store found in {store_dir}")
+
+    @property
+    def mosaic(self):
+        """Path of the mosaic VRT covering the whole store"""
+        return os.path.join(self.store_dir, self._info['mosaic'])
+
+    def covers(self, polys):
+        """True if the store has data for all of polys (lon/lat polygons,
+        split at the dateline)"""
+        if self._info is None:
+            return False
+
+        footprint = wkt.loads(self._info['footprint'])
+        return all(footprint.contains(poly) for poly in polys)
+
+
+def _up_to_date(src, dst):
+    return os.path.isfile(dst) and os.path.getmtime(dst) >= os.path.getmtime(src)
+
+
+def _cog_name(src):
+    """Store file name for a source GeoTIFF. Unique to its full path, so
+    same-named files in different directories (or ingests) don't clash."""
+    src = os.path.abspath(src)
+    digest = hashlib.sha256(src.encode('UTF-8')).hexdigest()[:16]
+    stem = os.path.splitext(os.path.basename(src))[0]
+    return f"{stem}-{digest}.tif"
+
+
+def ingest(src_dir, store_dir = None, srs = None):
+    """Add the GeoTIFFs in src_dir (and below) to the store, and rebuild the
+    mosaic from everything in the store. All files must share a projection,
+    unless srs is given, in which case they are warped to it."""
+    if store_dir is None:
+        store_dir = getattr(config, 'ELEVATION_STORE', None)
+    if store_dir is None:
+        raise ValueError("No store directory given, and ELEVATION_STORE not set")
+
+    tile_dir = os.path.join(store_dir, 'tiles')
+    os.makedirs(tile_dir, exist_ok = True)
+
+    sources = sorted(
+        path for pattern in ('**/*.tif', '**/*.tiff')
+        for path in glob.glob(os.path.join(src_dir, pattern), recursive = True)
+    )
+    if not sources:
+        raise ValueError(f"No GeoTIFFs found in {src_dir}")
+
+    for idx, src in enumerate(sources):
+        cog = os.path.join(tile_dir, _cog_name(src))
+        if _up_to_date(src, cog):
+            continue
+
+        logging.info(f"Converting {src} ({idx + 1}/{len(sources)})")
+        tmp_file = f"{cog}.tmp"
+        if srs is None:
+            osgeo.gdal.Translate(tmp_file, src, format = 'COG',
+                                 creationOptions = _COG_OPTIONS)
+        else:
+            osgeo.gdal.Warp(tmp_file, src, format = 'COG', dstSRS = srs,
+                            multithread = True,
+                            creationOptions = _COG_OPTIONS)
+        os.replace(tmp_file, cog)
+
+    # Everything ingested so far, not just this src_dir
+    cogs = sorted(glob.glob(os.path.join(tile_dir, '*.tif')))
+    logging.info(f"Building mosaic of {len(cogs)} files")
+    mosaic = os.path.join(store_dir, f"mosaic-{uuid.uuid4().hex}.vrt")
+    osgeo.gdal.BuildVRT(mosaic, cogs)
+
+    # External overviews of the mosaic itself, down to about 256 pixels
+    ds = osgeo.gdal.Open(mosaic)
+    levels = []
+    level = 2
+    while min(ds.RasterXSize, ds.RasterYSize) / level >= 256:
+        levels.append(level)
+        level *= 2
+
+    if levels:
+        logging.info(f"Building mosaic overviews {levels}")
+        osgeo.gdal.SetConfigOption('COMPRESS_OVERVIEW', 'DEFLATE')
+        osgeo.gdal.SetConfigOption('GDAL_NUM_THREADS', 'ALL_CPUS')
+        ds.BuildOverviews('AVERAGE', levels)
+    del ds
+
+    footprint = unary_union([raster_footprint(cog) for cog in cogs])
+
+    # Switch to the new mosaic in one step. Generators that have already
+    # opened the old one may still be using it, but new ones won't.
+    info_file = os.path.join(store_dir, 'store.json')
+    old_mosaic = None
+    try:
+        with open(info_file) as file:
+            old_mosaic = json.load(file)['mosaic']
+    except FileNotFoundError:
+        pass
+
+    with open(f"{info_file}.tmp", 'w') as file:
+        json.dump({'mosaic': os.path.basename(mosaic),
+                   'footprint': footprint.wkt}, file)
+    os.replace(f"{info_file}.tmp", info_file)
+
+    if old_mosaic is not None:
+        for path in (old_mosaic, f"{old_mosaic}.ovr"):
+            try:
+                os.remove(os.path.join(store_dir, path))
+            except FileNotFoundError:
+                pass
+
+    logging.info(f"Elevation store {store_dir} updated")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level = logging.INFO)
+    parser = argparse.ArgumentParser(description = "Add DSM GeoTIFFs to the local elevation store")
+    parser.add_argument('src_dir', help = "Directory of GeoTIFFs to add")
+    parser.add_argument('--store', help = "Store directory (defaults to ELEVATION_STORE from config.py)")
+    parser.add_argument('--srs', help = "Warp all files to this projection, e.g. EPSG:3338")
+    args = parser.parse_args()
+    osgeo.gdal.UseExceptions()
+    ingest(args.src_dir, args.store, args.srs)
@@ -1,17 +1,41 @@
 import sqlite3
 import os
 import pickle
+import threading
 
 
 class FileCache:
+    """Dictionary-like store shared between the web server and generator
+    processes, backed by a sqlite database.
+
+    Generator progress is kept in a separate status table, so updating it
+    doesn't mean re-writing the full request data.
+    """
+
     def __init__(self):
         script_dir = os.path.dirname(__file__)
         cache_dir = os.path.join(script_dir, 'cache')
         os.makedirs(cache_dir, exist_ok = True)
         self.cache_file = os.path.join(cache_dir, "global_session")
-        with sqlite3.connect(self.cache_file) as cache:
-            cur = cache.cursor()
-            cur.execute("CREATE TABLE IF NOT EXISTS cache(key,value, UNIQUE(key))")
+        self._local = threading.local()
+
+        cache = self._connection()
+        with cache:
+            cache.execute("CREATE TABLE IF NOT EXISTS cache(key,value, UNIQUE(key))")
+            cache.execute("CREATE TABLE IF NOT EXISTS status(key,value, UNIQUE(key))")
+
+    def _connection(self):
+        # sqlite connections can't be shared between threads, or survive a
+        # fork, so keep one open per thread per process.
+        cache = getattr(self._local, 'connection', None)
+        if cache is None or self._local.pid != os.getpid():
+            cache = sqlite3.connect(self.cache_file, timeout = 30)
+            cache.execute("PRAGMA journal_mode=WAL")
+            cache.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = cache
+            self._local.pid = os.getpid()
+
+        return cache
 
     def get(self, key, default = None):
         try:
@@ -20,29 +44,39 @@ class FileCache:
             return default
 
     def __getitem__(self, key):
-        with sqlite3.connect(self.cache_file) as cache:
-            cur = cache.cursor()
-            cur.execute("SELECT value FROM cache WHERE key=?", (key, ))
-            value = cur.fetchone()
-            if value is None:
-                raise KeyError(key)
+        cur = self._connection().execute("SELECT value FROM cache WHERE key=?",
+                                         (key, ))
+        value = cur.fetchone()
+        if value is None:
+            raise KeyError(key)
 
         return pickle.loads(value[0])
 
     def __setitem__(self, key, value):
         value = pickle.dumps(value)
-        with sqlite3.connect(self.cache_file) as cache:
-            cur = cache.cursor()
-            try:
-                cur.execute("INSERT INTO cache (key,value) VALUES (?,?)",
-                            (key, value))
-            except sqlite3.IntegrityError:
-                cur.execute("UPDATE cache SET value=? WHERE key=?",
-                            (value, key))
-            cache.commit()
+        cache = self._connection()
+        with cache:
+            cache.execute("INSERT OR REPLACE INTO cache (key,value) VALUES (?,?)",
+                          (key, value))
 
     def __delitem__(self, key):
-        with sqlite3.connect(self.cache_file) as cache:
-            cur = cache.cursor()
-            cur.execute("DELETE FROM cache WHERE key=?", (key, ))
-            cache.commit()
+        cache = self._connection()
+        with cache:
+            cache.execute("DELETE FROM cache WHERE key=?", (key, ))
+            cache.execute("DELETE FROM status WHERE key=?", (key, ))
+
+    def get_status(self, key, default = None):
+        cur = self._connection().execute("SELECT value FROM status WHERE key=?",
+                                         (key, ))
+        value = cur.fetchone()
+        if value is None:
+            return default
+
+        return pickle.loads(value[0])
+
+    def set_status(self, key, status):
+        value = pickle.dumps(status)
+        cache = self._connection()
+        with cache:
+            cache.execute("INSERT OR REPLACE INTO status (key,value) VALUES (?,?)",
+                          (key, value))
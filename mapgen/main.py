@@ -1,8 +1,12 @@
+import functools
+import glob
 import logging
 import json
-import multiprocessing
 import os
+import shutil
+import tempfile
 import threading
+import time
 import uuid
 
 from urllib.parse import unquote
@@ -10,10 +14,17 @@ from urllib.parse import unquote
 import flask
 import ujson
 
+from simple_websocket import ConnectionClosed
 from werkzeug.utils import secure_filename
 
-from . import app, sockets, _global_session, utils
+from . import app, sockets, _global_session, config, utils
 from .mapgenerator import MapGenerator
+from .point_data import AGGREGATES
+from .result_cache import ResultCache, request_key
+from .socket_dispatcher import SocketDispatcher
+from .status_broker import BrokerPipe, BrokerSubscription
+from .upload_store import UploadStore, valid_hash
+from .worker_pool import GeneratorPool
 from .targets import (
     List,
     Value,
@@ -23,17 +34,32 @@ from .targets import (
 )
 
 
-@app.get('/')
-def index():
+# Long-lived, pre-warmed processes to run MapGenerator.generate in
+generator_pool = GeneratorPool()
+
+
+def _load_active_volcs():
     try:
         with utils.MySQLCursor() as cursor:
             cursor.execute('SELECT volcano FROM tbllistvolc WHERE HistoricalCat=1')
             volcs = cursor.fetchall()
-        volcs = ujson.dumps([x[0] for x in volcs])
     except Exception as e:
-        app.logger.warning("Unable to fetch active volcanoes from geodiva", e)
-        volcs = ujson.dumps([])
+        app.logger.warning("Unable to fetch active volcanoes from geodiva: %s", e)
+        raise
+
+    return ujson.dumps([x[0] for x in volcs])
+
 
+# The active volcano list rarely changes, so don't hit the database for
+# every page load.
+active_volcs = utils.RefreshingCache(_load_active_volcs,
+                                     ttl = getattr(config, 'VOLCANO_CACHE_TTL', 60 * 60),
+                                     default = ujson.dumps([]))
+
+
+@functools.lru_cache()
+def _station_types():
+    """Station type and icon options for the index page, which are fixed"""
     sta_symbols = MapGenerator.station_symbols
     symbol_img = MapGenerator.icon_images
     staTypes = []
@@ -77,7 +103,13 @@ def index():
         in zip(icon_symbols.keys(), icon_urls.keys())
     ]
 
-    return flask.render_template("index.html", activevolcs = volcs,
+    return staTypes, iconOpts
+
+
+@app.get('/')
+def index():
+    staTypes, iconOpts = _station_types()
+    return flask.render_template("index.html", activevolcs = active_volcs.get(),
                                  staTypes = staTypes, icons = iconOpts)
 
 
@@ -126,6 +158,9 @@ def JSON(value):
 
 
 class MapSchema(BaseSchema):
+    chunk_size = getattr(config, 'UPLOAD_CHUNK_SIZE', 64 * 1024)
+    max_size = getattr(config, 'MAX_UPLOAD_SIZE', 1024 ** 3)
+
     width = Value(float)
     height = Value(float)
     bounds = Value(str)
@@ -147,7 +182,10 @@ class MapSchema(BaseSchema):
     insetHeight = List(float, default = [])
     socketID = Value(str)
     imgFile = File(default = None)
-    worldFile = File(default = None)
+    # Set instead of imgFile when the server already has the image
+    imgHash = Value(str, default = None)
+    imgName = Value(str, default = None)
+    worldFile = File(default = None, max_size = 1024 * 1024)
     colorMap = Value(str, default = None)
     cmMin = Value(float, default = None)
     cmMax = Value(float, default = None)
@@ -157,6 +195,8 @@ class MapSchema(BaseSchema):
     latcol = Value(str, default = None)
     loncol = Value(str, default = None)
     valcol = Value(str, default = None)
+    dataAggregate = Value(str, default = None)  # One of point_data.AGGREGATES
+    dataAggregateStyle = Value(str, default = 'points')  # points or grid
     mapColormap = Value(str, default = None)
     overviewColormap = Value(str, default = None)
     showCMTitle = Value(bool, default = False)
@@ -179,46 +219,156 @@ class MapSchema(BaseSchema):
 
 
 @app.post('/getMap')
-@api_input(MapSchema)
-def request_map(data):
+@api_input(MapSchema, upload_dir = tempfile.mkdtemp)
+def request_map(data, upload_dir):
     logging.info("Map request received")
     req_id = uuid.uuid4().hex
     flask.session['REQ_ID'] = req_id
-    generator = MapGenerator()
-    upload_dir = generator.tempdir()
+    # Uploads are streamed straight into the generator's working directory
+    generator = MapGenerator(tmp_dir = upload_dir)
 
     _global_session[req_id] = data
     generator.setReqId(req_id)
 
-    socket_id = data['socketID']
-    read_queue, write_queue = socket_queues[socket_id]
-
-    logging.info("Processing upload(s)")
-    filename = data.get('imgFile').name if data.get('imgFile') else None
-    logging.info("File upload processed")
-    if filename:
-        data['imgFile'].save(upload_dir)
-        if data.get('worldFile') and data['worldFile'].name:
-            data['worldFile'].save(upload_dir)
+    # The web socket may be held by another web server process, so
+    # status messages go through the broker.
+    status_pipe = BrokerPipe(data['socketID'])
 
+    if data.get('imgFile') and data['imgFile'].name:
         # User is trying to upload *something*. Deal with it.
-        data['hillshade_file'] = os.path.join(upload_dir, filename)
+        data['hillshade_file'] = data['imgFile'].path
+        data['imgHash'] = data['imgFile'].hash
+        data['imgName'] = data['imgFile'].name
+        logging.info(f"Received {data['imgFile'].name} ({utils.format_size(data['imgFile'].size)})")
+    elif data.get('imgHash'):
+        # The client checked we already have this image, and didn't send it
+        img_name = secure_filename(data.get('imgName') or '') or 'upload.tiff'
+        img_file = None
+        if valid_hash(data['imgHash']):
+            img_file = UploadStore().checkout(data['imgHash'],
+                                              os.path.join(upload_dir, img_name))
+        if img_file is None:
+            del _global_session[req_id]
+            shutil.rmtree(upload_dir, ignore_errors = True)
+            flask.abort(409, "Stored image not found. Please upload it again.")
+
+        logging.info(f"Using stored image {data['imgHash']}")
+        data['hillshade_file'] = img_file
+        data['imgName'] = img_name
 
     if data.get('plotData') and data['plotData'].name:
-        data['plotData'].save(upload_dir)
-        data['plotDataFile'] = os.path.join(upload_dir, data['plotData'].name)
+        data['plotDataFile'] = data['plotData'].path
 
+    if data.get('dataAggregate') and data['dataAggregate'] not in AGGREGATES:
+        del _global_session[req_id]
+        shutil.rmtree(upload_dir, ignore_errors = True)
+        flask.abort(400, f"Unknown aggregate {data['dataAggregate']}")
+
+    result_key = request_key(data)
+    data['result_key'] = result_key
     _global_session[req_id] = data
 
-    mp = multiprocessing.get_context('spawn')
-    logging.info("Initalizing generator process")
-    mp.Process(target = generator.generate,
-               args = (write_queue, req_id),
-               daemon = True).start()
-    logging.info("Generator started")
+    if _use_existing_result(result_key, req_id, status_pipe):
+        shutil.rmtree(upload_dir, ignore_errors = True)
+        return req_id
+
+    generator_pool.submit(generator, status_pipe, req_id,
+                          priority = MapGenerator.job_cost(data),
+                          callback = functools.partial(_job_finished, result_key))
+    logging.info("Generator job queued")
     return req_id
 
 
+@app.get('/checkUpload')
+def check_upload():
+    """Let the client skip uploading an image we already have"""
+    img_hash = flask.request.args.get('hash', '')
+    if not valid_hash(img_hash):
+        flask.abort(400, "Invalid hash")
+
+    return {'stored': img_hash in UploadStore()}
+
+
+def _send_status(status_pipe, status):
+    try:
+        status_pipe.send(status)
+    except OSError:
+        pass  # Web socket has been closed
+
+
+def _complete_from_cache(result_key, req_id, status_pipe):
+    map_file = ResultCache().checkout(result_key)
+    if map_file is None:
+        return False
+
+    data = _global_session[req_id]
+    data['map_file'] = map_file
+    _global_session[req_id] = data
+    _global_session.set_status(req_id, "Complete")
+    _send_status(status_pipe, "COMPLETE")
+    return True
+
+
+def _use_existing_result(result_key, req_id, status_pipe):
+    """Complete a request from a previously generated map, or attach it to
+    an identical request still being generated, by this or any other web
+    server process. Returns False if the map needs to be generated."""
+    if _complete_from_cache(result_key, req_id, status_pipe):
+        logging.info("Map request served from result cache")
+        status_pipe.close()
+        return True
+
+    if ResultCache().attach(result_key, req_id, status_pipe):
+        logging.info("Map request attached to identical request in progress")
+        status = "Waiting for an identical map to finish generating..."
+        _global_session.set_status(req_id, status)
+        _send_status(status_pipe, status)
+        status_pipe.close()
+        return True
+
+    # The identical request may have finished between checking the cache
+    # and attaching to it.
+    if _complete_from_cache(result_key, req_id, status_pipe):
+        logging.info("Map request served from result cache")
+        status_pipe.close()
+        _job_finished(result_key, req_id)
+        return True
+
+    return False
+
+
+def _job_finished(result_key, req_id):
+    for waiting_id, status_pipe in ResultCache().release(result_key):
+        if not _complete_from_cache(result_key, waiting_id, status_pipe):
+            _global_session.set_status(waiting_id, "FAILED")
+            _send_status(status_pipe, 'ERROR')
+        status_pipe.close()
+
+
+def _sweep_map_files():
+    """Remove finished maps more than MAP_FILE_MAX_AGE seconds old, at
+    startup and then periodically. Catches maps whose X-Accel cleanup timer
+    was lost to a worker restart, and maps that were never downloaded."""
+    max_age = getattr(config, 'MAP_FILE_MAX_AGE', 60 * 60)
+    cache_dir = os.path.join(os.path.dirname(__file__), 'cache')
+    while True:
+        cutoff = time.time() - max_age
+        for path in glob.glob(os.path.join(cache_dir, '*.pdf')):
+            try:
+                # ctime rather than mtime, as maps from the result cache are
+                # hard links, with the mtime of the cached copy.
+                if os.stat(path).st_ctime < cutoff:
+                    logging.info(f"Removing expired map file {path}")
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
+
+        time.sleep(max_age / 4)
+
+
+threading.Thread(target = _sweep_map_files, daemon = True).start()
+
+
 @app.get('/getMap')
 def get_map_image():
     logging.info("Final image requested")
@@ -230,17 +380,42 @@ def get_map_image():
         flask.abort(404)
 
     file_path = _global_session[req_id]['map_file']
-    with open(file_path, 'rb') as file:
-        file_data = file.read()
+    logging.info(f"Sending {file_path} ({utils.format_size(os.path.getsize(file_path))})")
 
-    logging.info(f"Loaded file with length {len(file_data)}")
-    os.remove(file_path)
-    del _global_session[req_id]
+    def _cleanup():
+        try:
+            os.remove(file_path)
+        except FileNotFoundError:
+            pass
+
+    accel_prefix = getattr(config, 'X_ACCEL_REDIRECT_PREFIX', None)
+    if accel_prefix:
+        # Let nginx send the file. We don't know when it is done with it,
+        # so give it plenty of time before removing the file.
+        del _global_session[req_id]
+        response = flask.make_response()
+        response.headers.set('X-Accel-Redirect',
+                             accel_prefix + os.path.basename(file_path))
+        response.headers.set('Content-Type', 'application/pdf')
+        response.headers.set('Content-Disposition', 'attachment',
+                             filename="MapImage.pdf")
+        cleanup_delay = getattr(config, 'X_ACCEL_CLEANUP_DELAY', 300)
+        timer = threading.Timer(cleanup_delay, _cleanup)
+        timer.daemon = True
+        timer.start()
+    else:
+        # Streamed using sendfile where the server supports it, rather than
+        # being read into memory.
+        response = flask.send_file(file_path,
+                                   mimetype = 'application/pdf',
+                                   as_attachment = True,
+                                   download_name = "MapImage.pdf")
+
+        @response.call_on_close
+        def _finish_download():
+            _cleanup()
+            del _global_session[req_id]
 
-    response = flask.make_response(file_data)
-    response.headers.set('Content-Type', 'application/pdf')
-    response.headers.set('Content-Disposition', 'attachment',
-                         filename="MapImage.pdf")
     response.set_cookie('DownloadComplete', "1")
 
     return response
@@ -254,7 +429,7 @@ def check_status():
     except KeyError:
         flask.abort(404)
 
-    stat = data_dict.get('gen_status', "Initalizing...")
+    stat = _global_session.get_status(req_id, "Initalizing...")
     if stat == "FAILED":
         flask.abort(500, 'Unable to generate map. An internal server error occured.')
 
@@ -264,8 +439,7 @@ def check_status():
         return {'status': 'complete', 'done': True}
 
 
-socket_queues = {}
-ws_objects = {}
+socket_dispatcher = SocketDispatcher()
 
 
 # This is weird (to me) but to be able to handle this URL both with and without
@@ -284,43 +458,22 @@ def monitor_w_slash(ws):
 def monitor_socket(ws):
     logging.info("New web socket connection opened")
     socket_id = uuid.uuid4().hex
-    read_pipe, write_pipe = multiprocessing.Pipe()
-    socket_queues[socket_id] = (read_pipe, write_pipe)
-    ws_objects[socket_id] = ws
+
+    # The dispatcher sends status messages from the generator to the client,
+    # while the loop below keeps the web socket alive and responds to messages
+    # received FROM the client.
+    socket_dispatcher.register(socket_id, ws, BrokerSubscription(socket_id))
     msg = {'type': 'socketID', 'content': socket_id, }
     ws.send(json.dumps(msg))
 
-    # This thread monitors the sockets, above, and sends information to the client,
-    # while the loop below keeps the web socket alive and responds to messages received
-    # FROM the client.
-    logging.info("Creating webSocket monitor thread")
-    thread = threading.Thread(target = _run_monitor_socket,
-                              args = (ws, read_pipe))
-    thread.start()
-    logging.info("Web socket monitor thread started")
-
-    while True:
-        msg = ws.receive()
-        if msg == "PING":
-            ws.send('PONG')
+    try:
+        while True:
+            msg = ws.receive()
+            if msg == "PING":
+                ws.send('PONG')
+    except ConnectionClosed:
+        pass
+    finally:
+        socket_dispatcher.unregister(socket_id)
 
     logging.info("Web socket closed")
-
-
-def _run_monitor_socket(ws, pipe):
-    # Needs to be run in a seperate thread so it doesn't block other requests
-    logging.info("Web socket handler thread started")
-    while ws.connected:
-        # Check and loop rather than blocking indefinitely
-        # so we can know if the socket has closed.
-        msg_waiting = pipe.poll(.25)
-        if not msg_waiting:
-            continue
-
-        message = pipe.recv()
-        message = {'type': 'status',
-                   'content': message}
-        ws.send(json.dumps(message))
-
-    logging.info("Exiting web socket handler thread")
-
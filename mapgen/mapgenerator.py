@@ -1,4 +1,5 @@
 from shapely.geometry import Polygon
+from shapely.ops import unary_union
 import shapely_geojson
 
 import errno
@@ -10,14 +11,14 @@ import pickle
 import socket
 import shutil
 import signal
+import threading
 import time
 import tempfile
 import traceback
 import uuid
 import zipfile
 
-from collections import defaultdict
-from io import BytesIO
+from concurrent.futures import Future, ThreadPoolExecutor, wait
 from tempfile import NamedTemporaryFile
 
 import numpy
@@ -47,8 +48,26 @@ except ImportError:
 
 try:
     from . import utils
+    from .elevation_client import ElevationClient
+    from .elevation_store import ElevationStore
+    from .point_data import aggregate, read_points
+    from .progress import ProgressPublisher
+    from .raster_cache import RasterCache
+    from .result_cache import ResultCache
+    from .tile_cache import TileCache, overlapping_tiles
+    from .upload_store import UploadStore
+    from . import config
 except ImportError:
     import utils
+    from elevation_client import ElevationClient
+    from elevation_store import ElevationStore
+    from point_data import aggregate, read_points
+    from progress import ProgressPublisher
+    from raster_cache import RasterCache
+    from result_cache import ResultCache
+    from tile_cache import TileCache, overlapping_tiles
+    from upload_store import UploadStore
+    import config
 
 
 def run_process(queue):
@@ -98,6 +117,15 @@ def run_process(queue):
 
 
 class MapGenerator:
+    # Resolution hillshade images are drawn at
+    HILLSHADE_DPI = 300
+    # Resolution aggregated plot data grids are drawn at
+    DATA_GRID_DPI = 300
+    # Eccentricity of the WGS-84 ellipsoid, for sizing Mercator maps
+    WGS84_E = 0.0818191908426
+    # elevation.alaska.gov dataset to use for hillshades (DSM hillshade)
+    HILLSHADE_DATASET = 151
+
     _volc_colors = {
         'RED': '#EC0000',
         'GREEN': '#87C264',
@@ -148,8 +176,11 @@ class MapGenerator:
         },
     }
 
-    def __init__(self, req_id = None):
-        self._tmp_dir = tempfile.mkdtemp()
+    def __init__(self, req_id = None, tmp_dir = None):
+        if tmp_dir is None:
+            tmp_dir = tempfile.mkdtemp()
+
+        self._tmp_dir = tmp_dir
         self._req_id = req_id
         if req_id is not None:
             self.data = _global_session[self._req_id]
@@ -157,12 +188,110 @@ class MapGenerator:
             self.data = None
 
         self._used_symbols = {}
+        # Hillshade tiles (name -> path) already found or downloaded for
+        # this map, and the area they cover, so insets inside it don't need
+        # to look them up again.
+        self._job_tiles = {}
+        self._job_coverage = None
+        # Inset hillshades are prepared in background threads. Their status
+        # updates are kept here (latest per inset), and reported by the main
+        # thread, rather than published directly.
+        self._inset_status = {}
+        self._init_thread_state()
         self._socket_queue = None
+        self._progress = None
         self.gmt_bounds = []
         self.BASE_SIZE = [10, 7.5]
         self.BASE_FONT_SIZE = 11
         self.BASE_SYM_SIZE = 16
 
+    # Locks and thread state, which can't be pickled (to send the generator
+    # to a worker process), and are only used once generate() is running.
+    _THREAD_STATE = ('_job_lock', '_upload_lock', '_inset_local', '_inset_cancel')
+
+    def _init_thread_state(self):
+        self._job_lock = threading.Lock()
+        self._upload_lock = threading.Lock()
+        self._inset_local = threading.local()
+        self._inset_cancel = threading.Event()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in self._THREAD_STATE:
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_thread_state()
+
+    @staticmethod
+    def job_cost(data):
+        """Rough cost class of generating a map for the request data.
+
+        0: only uses GMT's @earth_relief_15s
+        1: uses @earth_relief_01s, or has an uploaded image to process
+        2: needs hillshade files downloaded from elevation.alaska.gov
+        """
+        zooms = [data.get('mapZoom', 0)] + list(data.get('insetZoom', []))
+        zoom = max(zooms)
+        if zoom <= 7:
+            cost = 0
+        elif zoom < 10:
+            cost = 1
+        else:
+            cost = 2
+
+        if data.get('hillshade_file'):
+            cost = max(cost, 1)
+
+        return cost
+
+    @staticmethod
+    def _inches(width, height, unit):
+        """Convert a GMT width and height (in i, c or p units) to inches"""
+        per_inch = {'i': 1, 'c': 2.54, 'p': 72}.get(unit, 1)
+        return (width / per_inch, height / per_inch)
+
+    @classmethod
+    def _mercator_y(cls, lat):
+        """Mercator northing of lat on the WGS-84 ellipsoid (as GMT uses by
+        default), in radians of the equator"""
+        e_sin = cls.WGS84_E * math.sin(math.radians(lat))
+        return (math.log(math.tan(math.pi / 4 + math.radians(lat) / 2))
+                + cls.WGS84_E / 2 * math.log((1 - e_sin) / (1 + e_sin)))
+
+    @classmethod
+    def _mercator_size(cls, bounds, width, height = None):
+        """Size (width, height) in inches GMT draws bounds ([west, south,
+        east, north]) at in a Mercator projection width wide (as for
+        "M{width}"), or if height is given, fitted inside width x height
+        (as for "M?" in an inset)"""
+        lon_span = math.radians((bounds[2] - bounds[0]) % 360 or 360)
+        aspect = (cls._mercator_y(bounds[3]) - cls._mercator_y(bounds[1])) / lon_span
+        if height is not None and width * aspect > height:
+            width = height / aspect
+
+        return (width, width * aspect)
+
+    def _degrees_per_pixel(self, bounds, out_size):
+        """Resolution (x, y) in degrees needed to draw bounds ([west, south,
+        east, north]) at out_size inches in a Mercator projection, at
+        HILLSHADE_DPI"""
+        lon_span = (bounds[2] - bounds[0]) % 360 or 360
+        x_res = lon_span / (out_size[0] * self.HILLSHADE_DPI)
+
+        # Mercator stretches latitude by about sec(lat), so a degree of
+        # latitude is drawn tallest at the edge furthest from the equator.
+        merc_span = self._mercator_y(bounds[3]) - self._mercator_y(bounds[1])
+        lat = math.radians(max(abs(bounds[1]), abs(bounds[3])))
+        e2 = self.WGS84_E ** 2
+        stretch = (1 - e2) / ((1 - e2 * math.sin(lat) ** 2) * math.cos(lat))
+        inches_per_degree = math.radians(out_size[1] / merc_span * stretch)
+        y_res = 1 / (inches_per_degree * self.HILLSHADE_DPI)
+
+        return (x_res, y_res)
+
     def setReqId(self, req_id):
         self._req_id = req_id
         self.data = _global_session[self._req_id]
@@ -170,15 +299,54 @@ class MapGenerator:
     def tempdir(self):
         return self._tmp_dir
 
-    def _update_status(self, status):
-        self.data['gen_status'] = status
-        _global_session[self._req_id] = self.data
+    def _temp_path(self, name):
+        """A unique path in the temp dir, based on name. Hillshades for
+        insets may be processed at the same time."""
+        stem, ext = os.path.splitext(name)
+        return os.path.join(self.tempdir(), f"{stem}-{uuid.uuid4().hex[:8]}{ext}")
+
+    def _update_status(self, status, inset = None):
+        """Publish status, or if it is for an inset (being prepared on this
+        thread, or given), keep it to be reported by _inset_hillshade"""
+        if inset is None:
+            inset = getattr(self._inset_local, 'inset', None)
+        if inset is not None:
+            self._check_inset_cancelled(inset)
+            self._inset_status[inset] = status
+            return
 
-        if self._socket_queue is not None:
-            self._socket_queue.send(status)
+        if self._progress is None:
+            self._progress = ProgressPublisher(self._publish_status)
 
-    def _download_elevation(self, bounds):
-        if bounds[0] < -180 or bounds[2] > 180 or bounds[0] > bounds[2]:
+        self._progress.update(status)
+
+    def _check_inset_cancelled(self, inset):
+        if inset is not None and self._inset_cancel.is_set():
+            # The map has failed, so stop preparing this inset
+            raise RuntimeError("Inset preparation cancelled")
+
+    def _publish_status(self, status):
+        _global_session.set_status(self._req_id, status)
+
+        if self._socket_queue is not None:
+            try:
+                self._socket_queue.send(status)
+            except OSError:
+                # The web socket has been closed. Finish the map anyway,
+                # so it can be cached.
+                logging.info("Status pipe closed")
+                self._socket_queue = None
+
+    @staticmethod
+    def _crosses_dateline(bounds):
+        """True if bounds ([west, south, east, north]) cross the dateline,
+        whether given as west < -180, east > 180, or west > east"""
+        return bounds[0] < -180 or bounds[2] > 180 or bounds[0] > bounds[2]
+
+    @classmethod
+    def _split_bounds(cls, bounds):
+        """Polygons covering bounds, split at the dateline"""
+        if cls._crosses_dateline(bounds):
             # Crossing dateline. Need to split request.
             bounds = list(bounds)
             bounds2 = bounds.copy()
@@ -192,118 +360,324 @@ class MapGenerator:
             if bounds2[2] > 0:
                 bounds2[2] -= 360
 
-            poly2 = Polygon.from_bounds(*bounds2)
-            poly3 = Polygon.from_bounds(*bounds3)
-            bounds_list = [shapely_geojson.dumps(poly3),
-                           shapely_geojson.dumps(poly2)]
+            poly_list = [Polygon.from_bounds(*bounds3),
+                         Polygon.from_bounds(*bounds2)]
         else:
-            poly = Polygon.from_bounds(*bounds)
-            bounds_list = [shapely_geojson.dumps(poly), ]
+            poly_list = [Polygon.from_bounds(*bounds), ]
 
-        ids = 151  # DSM hillshade
-        URL_BASE = 'https://elevation.alaska.gov'
-        list_url = f'{URL_BASE}/query.json'
-        url = f'{URL_BASE}/download'
-        est_size = 0
-        logging.info("Downloading hillshade files")
-        tempdir = self.tempdir()
-        zf_path = os.path.join(tempdir, 'custom_download.zip')
-        tiff_dir = os.path.join(tempdir, 'tiffs')
-        os.makedirs(tiff_dir, exist_ok=True)
+        return poly_list
+
+    def _download_elevation(self, bounds):
+        """Make sure all the hillshade tiles covering bounds are in the tile
+        cache, returning them as a tile name -> path dict"""
+        poly_list = self._split_bounds(bounds)
+        ids = self.HILLSHADE_DATASET
+
+        with self._job_lock:
+            if (self._job_coverage is not None
+                    and all(self._job_coverage.contains(poly) for poly in poly_list)):
+                logging.info("Using hillshade tiles already fetched for this map")
+                return dict(self._job_tiles)
+
+        tile_cache = TileCache()
+
+        # Only ask the server for the areas we don't already have cached
+        bounds_list = []
+        cached_tiles = {}
+        for poly in poly_list:
+            tiles, missing = tile_cache.lookup(ids, poly)
+            cached_tiles.update(tiles)
+            if not missing.is_empty:
+                bounds_list.append(missing.envelope)
+
+        if not bounds_list:
+            logging.info(f"Using {len(cached_tiles)} cached hillshade tiles")
+            self._update_status(f"Using {len(cached_tiles)} cached hillshade tiles...")
+            self._add_job_tiles(cached_tiles, poly_list)
+            return cached_tiles
 
+        logging.info("Downloading hillshade files")
+        self._update_status(f"Downloading hillshade files ({len(cached_tiles)} tiles cached)...")
+
+        client = ElevationClient()
+        geojsons = [shapely_geojson.dumps(poly) for poly in bounds_list]
+        # Progress is reported from the download threads, so pass on which
+        # inset (if any) this is for.
+        inset = getattr(self._inset_local, 'inset', None)
+        progress_lock = threading.Lock()
+        est_size = 0
         loaded_bytes = 0
-        pc = 0
-        chunk_size = 1024 * 1024 * 1000  # 10 MB
 
-        for geojson in bounds_list:
-            # get file listings
+        def add_estimate(listing):
+            nonlocal est_size
             try:
-                req = requests.post(list_url, data = {'geojson': geojson, })
-            except requests.exceptions.ConnectionError:
-                logging.warning("Connection error attempting to get file listings")
-                continue
+                file_info = listing.result()
+            except requests.exceptions.RequestException as e:
+                logging.warning(f"Unable to get file listings: {e}")
+                return
+
+            if file_info is None:
+                logging.warning("Requested dataset info not found in server response")
+                return
+
+            logging.debug(str(file_info))
+            with progress_lock:
+                est_size += file_info.get('bytes', -1)
+
+        def add_received(count):
+            nonlocal loaded_bytes
+            # Stops the download, if the inset it is for has been cancelled
+            self._check_inset_cancelled(inset)
+            with progress_lock:
+                loaded_bytes += count
+                if est_size <= 0:
+                    return
 
-            if req.status_code != 200:
-                logging.warning(f"Unable to get file listings. Server returned {req.status_code}")
-            else:
-                files = req.json()
-                try:
-                    file_info = next((x for x
-                                      in files
-                                      if x['dataset_id'] == ids))
-                except StopIteration:
-                    logging.warning("Requested dataset info not found in server response")
-                else:
-                    logging.debug(str(file_info))
-                    est_size += file_info.get('bytes', -1)
+                pc = round((loaded_bytes / est_size) * 100, 1)
+                current_size = utils.format_size(loaded_bytes)
+                total_size_str = utils.format_size(est_size)
+
+            self._update_status({
+                'status': f"Downloading hillshade files ({current_size}/{total_size_str})...",
+                'progress': pc
+            }, inset = inset)
 
         _t_start = time.time()
-        total_size_str = utils.format_size(est_size)
-        for geojson in bounds_list:
-            req = requests.get(url,
-                               params = {'geojson': geojson,
-                                         'ids': ids},
-                               stream = True)
-            if req.status_code != 200:
-                logging.warning(f"Unable to fetch hillshade files for region. Server returned {req.status_code}")
-                print(req.status_code)
-                print(req.text)
-                continue
+        hits = set()
+        misses = set()
+        failed = False
+        # The listings (only needed for the progress estimate) and the
+        # downloads for each half of the map all run at once.
+        with ThreadPoolExecutor(max_workers = 2 * len(geojsons)) as pool:
+            for geojson in geojsons:
+                listing = pool.submit(client.dataset_info, geojson, ids)
+                listing.add_done_callback(add_estimate)
+
+            downloads = [pool.submit(self._fetch_archive, client, tile_cache,
+                                     ids, geojson, add_received)
+                         for geojson in geojsons]
+
+            for poly, download in zip(bounds_list, downloads):
+                try:
+                    zf_path = download.result()
+                except requests.exceptions.RequestException as e:
+                    logging.warning(f"Unable to fetch hillshade files for region: {e}")
+                    failed = True
+                    continue
+
+                try:
+                    self._update_status("Indexing hillshade data...")
+                    query_tiles = self._add_tiles(tile_cache, ids, zf_path,
+                                                  hits, misses)
+                except BaseException:
+                    try:
+                        os.remove(zf_path)
+                    except FileNotFoundError:
+                        pass
+                    raise
+
+                tile_cache.add_query(ids, poly, query_tiles)
+
+        _t_download = time.time() - _t_start
+        logging.info(f"Downloaded {utils.format_size(loaded_bytes)} of hillshade files in {_t_download} ({utils.format_size(loaded_bytes / _t_download)}/sec)")
+
+        # Everything we need should now be cached
+        tiles = {}
+        for poly in poly_list:
+            found, _ = tile_cache.lookup(ids, poly)
+            tiles.update(found)
+
+        hits |= set(cached_tiles) - misses
+        logging.info(f"Hillshade tile cache: {len(hits)} hits, {len(misses)} misses")
+        self._update_status(f"Hillshade tiles: {len(hits)} cached, {len(misses)} downloaded")
+
+        tile_cache.evict()
+        if not failed:
+            self._add_job_tiles(tiles, poly_list)
+        return tiles
+
+    def _add_job_tiles(self, tiles, polys):
+        with self._job_lock:
+            self._job_tiles.update(tiles)
+            if self._job_coverage is None:
+                self._job_coverage = unary_union(polys)
+            else:
+                self._job_coverage = unary_union([self._job_coverage, *polys])
+
+    def _fetch_archive(self, client, tile_cache, ids, geojson, progress):
+        # Download straight into the tile cache. The tiles are read from
+        # the archive in place, so this is the only copy ever written.
+        zf_path = tile_cache.archive_path(ids)
+        try:
+            client.download(geojson, ids, zf_path, progress = progress)
+        except BaseException:
+            try:
+                os.remove(zf_path)
+            except FileNotFoundError:
+                pass
+            raise
+
+        return zf_path
+
+    def _filter_tiles(self, tiles, map_bounds, out_size = None):
+        """Paths of the tiles (name -> path) that overlap the map area by
+        more than a pixel of the output"""
+        poly_list = self._split_bounds(map_bounds)
+        min_width = min_height = 0
+        if out_size is not None:
+            min_width, min_height = self._degrees_per_pixel(map_bounds, out_size)
+
+        footprints = TileCache().footprints(self.HILLSHADE_DATASET, tiles)
+        names = overlapping_tiles(footprints, poly_list, min_width, min_height)
+        if len(names) < len(tiles):
+            logging.info(f"Using {len(names)} of {len(tiles)} hillshade tiles")
+
+        return [tiles[name] for name in names]
+
+    def _add_tiles(self, tile_cache, ids, zf_path, hits, misses):
+        """Add the tiles in a downloaded archive (a zip of zips of tiffs) to
+        the tile cache, without extracting them. Returns the names of all
+        tiles in the archive."""
+        archives = {zf_path: False}  # archive -> has tiles we need
+        try:
+            query_tiles = self._index_archive(tile_cache, ids, zf_path,
+                                              archives, hits, misses)
+        except BaseException:
+            # Remove any inner zips copied out. zf_path is up to the caller.
+            for archive in archives:
+                if archive != zf_path and os.path.exists(archive):
+                    os.remove(archive)
+            raise
+
+        for archive, used in archives.items():
+            if used:
+                tile_cache.add_archive(archive)
+            else:
+                os.remove(archive)
+
+        return query_tiles
+
+    def _index_archive(self, tile_cache, ids, zf_path, archives, hits, misses):
+        with zipfile.ZipFile(zf_path, 'r') as zf:
+            files = [x for x in zf.infolist() if x.filename.endswith('.zip')]
+
+            inner_zips = []
+            for info in files:
+                if info.compress_type == zipfile.ZIP_STORED:
+                    # GDAL can read the inner zip in place
+                    inner_zips.append((f"/vsizip//vsizip/{zf_path}/{info.filename}",
+                                       zf_path))
+                    continue
 
-            with open(zf_path, 'wb') as zf:
-                for chunk in req.iter_content(chunk_size = None):
-                    if chunk:
-                        bytes_written = zf.write(chunk)
-                        loaded_bytes += bytes_written
-                        if est_size > 0:
-                            pc = round((loaded_bytes / est_size) * 100, 1)
-                            current_size = utils.format_size(loaded_bytes)
-
-                            self._update_status({
-                                'status': f"Downloading hillshade files ({current_size}/{total_size_str})...",
-                                'progress': pc
-                            })
-
-            _t_download = time.time() - _t_start
-            logging.info(f"Downloaded {utils.format_size(loaded_bytes)} of hillshade files in {_t_download} ({utils.format_size(loaded_bytes / _t_download)}/sec)")
-
-            # Pull out the various tiff files needed
-            logging.info("Extracting tiffs")
-
-            self._update_status("Decompressing hillshade data...")
-
-            with zipfile.ZipFile(zf_path, 'r') as zf:
-                files = [x for x in zf.namelist() if x.endswith('.zip')]
-                file_count = len(files)
-                for idx, file in enumerate(files):
-                    logging.info(f"Reading {file}")
-                    zf_data = BytesIO(zf.read(file))
-                    with zipfile.ZipFile(zf_data, 'r') as zf2:
-                        for tiffile in zf2.namelist():
-                            if tiffile.endswith('.tif'):
-                                if os.path.isfile(os.path.join(tiff_dir, tiffile)):
-                                    continue  # already extracted, move on
-                                logging.info(f"Extracting {tiffile}")
-                                zf2.extract(tiffile, path = tiff_dir)
-                    if file_count > 1:
-                        pc = round(((idx + 1) / file_count) * 100, 1)
-                        self._update_status({
-                            'status': f"Decompressing hillshade data ({idx + 1}/{file_count})...",
-                            'progress': pc
-                        })
-
-        logging.info("Downloaded files in %f", time.time() - _t_start)
-        return tiff_dir
-
-    def _process_files(self, all_files, warp_bounds, proj = None):
+                # Seeking in a compressed entry means decompressing it from the
+                # start, so copy the inner zip out (a chunk at a time) instead.
+                inner_path = tile_cache.archive_path(ids)
+                archives[inner_path] = False
+                with zf.open(info) as src, open(inner_path, 'wb') as dst:
+                    shutil.copyfileobj(src, dst, 1024 * 1024)
+                inner_zips.append((f"/vsizip/{inner_path}", inner_path))
+
+        query_tiles = []
+        file_count = len(inner_zips)
+        for idx, (inner_zip, archive) in enumerate(inner_zips):
+            logging.info(f"Reading {inner_zip}")
+            tiffiles = osgeo.gdal.ReadDirRecursive(inner_zip) or []
+            for tiffile in tiffiles:
+                if not tiffile.endswith('.tif'):
+                    continue
+
+                query_tiles.append(tiffile)
+                if (ids, tiffile) in tile_cache:
+                    hits.add(tiffile)
+                    continue  # already have it, move on
+
+                tile_cache.add(ids, tiffile, f"{inner_zip}/{tiffile}", archive)
+                archives[archive] = True
+                misses.add(tiffile)
+
+            if file_count > 1:
+                pc = round(((idx + 1) / file_count) * 100, 1)
+                self._update_status({
+                    'status': f"Indexing hillshade data ({idx + 1}/{file_count})...",
+                    'progress': pc
+                })
+
+        return query_tiles
+
+    @staticmethod
+    def _trim_bounds(file_bounds, warp_bounds):
+        """Limit file_bounds to warp_bounds.
+
+        Returns
+        -------
+        bounds : list or None
+            The trimmed bounds, in the same longitude range as warp_bounds,
+            or None if the file should be skipped.
+        trimmed : bool
+            True if the bounds had to be trimmed.
+        """
+        use_bounds = False
+
+        # Make signs of warp and file bounds match
+        # Stupid dateline!
+        if file_bounds[0] < 0 and warp_bounds[0] > 0:
+            file_bounds[0] += 360
+        if file_bounds[0] > 0 and warp_bounds[0] < 0:
+            file_bounds[0] -= 360
+
+        if file_bounds[2] < 0 and warp_bounds[2] > 0:
+            file_bounds[2] += 360
+        if file_bounds[2] > 0 and warp_bounds[2] < 0:
+            file_bounds[2] -= 360
+
+        # limit extents to warp_bounds
+        if file_bounds[0] < warp_bounds[0]:
+            file_bounds[0] = warp_bounds[0]
+            use_bounds = True
+        if file_bounds[1] < warp_bounds[1]:
+            file_bounds[1] = warp_bounds[1]
+            use_bounds = True
+        if file_bounds[2] > warp_bounds[2]:
+            file_bounds[2] = warp_bounds[2]
+            use_bounds = True
+        if file_bounds[3] > warp_bounds[3]:
+            file_bounds[3] = warp_bounds[3]
+            use_bounds = True
+
+        if use_bounds:
+            logging.info(f"Using bounds of {file_bounds}")
+            if ((file_bounds[0] < 0) == (file_bounds[2] < 0)) and file_bounds[0] > file_bounds[2]:
+                logging.warning("Skipping file due to negative bounds")
+                return None, use_bounds
+
+            # this seems unlikely, but still would be wrong
+            if ((file_bounds[0] < 0) != (file_bounds[2] < 0)) and file_bounds[0] < file_bounds[2]:
+                logging.warning("Skipping file due to really weird bounds")
+                return None, use_bounds
+
+        return file_bounds, use_bounds
+
+    def _process_files(self, all_files, warp_bounds, proj = None, out_size = None,
+                       cacheable = False):
+        """Mosaic all_files, and convert to lat/lon trimmed to warp_bounds.
+
+        out_size is the (width, height) in inches the result will be drawn at.
+        If given, the result is no higher resolution than needed to draw it.
+        cacheable files (which never change) may be processed using the
+        raster cache.
+        """
         osgeo.gdal.AllRegister()  # Why? WHY!?!? But needed...
-        files = []
         num_files = len(all_files)
-        
+
+        if ((num_files > 1 or (num_files and cacheable))
+                and getattr(config, 'MOSAIC_MODE', 'vrt') == 'vrt'):
+            return self._warp_mosaic(all_files, warp_bounds, proj, out_size,
+                                     cacheable = cacheable)
+
+        files = []
         if num_files > 1:
             logging.info(f"Merging {num_files} Files")
-            file_path = os.path.dirname(all_files[0])
-            merged_file = os.path.join(file_path, "combined_image.tiff")
+            merged_file = self._temp_path("combined_image.tiff")
             # out_file = os.path.join(in_path, "combined_warped_image.tiff")
             merge_args = ["myScript.py", "-o", merged_file]
             merge_args += all_files
@@ -314,40 +688,17 @@ class MapGenerator:
         for idx, in_file in enumerate(all_files):
             logging.info(f"Processing image {idx+1} of {len(all_files)}")
 
-            in_path, in_ext = os.path.splitext(in_file)
-            out_file = f"{in_path}-processed.tiff"
+            # Write output to our own temp dir, as the input may be a cached tile
+            in_name, in_ext = os.path.splitext(os.path.basename(in_file))
+            out_file = self._temp_path(f"{in_name}-processed.tiff")
 
             ds = osgeo.gdal.Open(in_file)
             file_bounds = utils.get_extents(ds, proj)
             del ds
 
-            use_bounds = False
-
-            # Make signs of warp and file bounds match
-            # Stupid dateline!
-            if file_bounds[0] < 0 and warp_bounds[0] > 0:
-                file_bounds[0] += 360
-            if file_bounds[0] > 0 and warp_bounds[0] < 0:
-                file_bounds[0] -= 360
-
-            if file_bounds[2] < 0 and warp_bounds[2] > 0:
-                file_bounds[2] += 360
-            if file_bounds[2] > 0 and warp_bounds[2] < 0:
-                file_bounds[2] -= 360
-
-            # limit extents to warp_bounds
-            if file_bounds[0] < warp_bounds[0]:
-                file_bounds[0] = warp_bounds[0]
-                use_bounds = True
-            if file_bounds[1] < warp_bounds[1]:
-                file_bounds[1] = warp_bounds[1]
-                use_bounds = True
-            if file_bounds[2] > warp_bounds[2]:
-                file_bounds[2] = warp_bounds[2]
-                use_bounds = True
-            if file_bounds[3] > warp_bounds[3]:
-                file_bounds[3] = warp_bounds[3]
-                use_bounds = True
+            file_bounds, use_bounds = self._trim_bounds(file_bounds, warp_bounds)
+            if file_bounds is None:
+                continue
 
             kwargs = {
                 "dstSRS": "EPSG:4326",
@@ -361,15 +712,6 @@ class MapGenerator:
 
             if use_bounds:
                 kwargs['outputBounds'] = file_bounds
-                logging.info(f"Using bounds of {file_bounds}")
-                if ((file_bounds[0] < 0) == (file_bounds[2] < 0)) and file_bounds[0] > file_bounds[2]:
-                    logging.warning("Skipping file due to negative bounds")
-                    continue
-
-                # this seems unlikely, but still would be wrong
-                if ((file_bounds[0] < 0) != (file_bounds[2] < 0)) and file_bounds[0] < file_bounds[2]:
-                    logging.warning("Skipping file due to really weird bounds")
-                    continue
 
             osgeo.gdal.Warp(out_file, in_file, **kwargs)
             files.append(out_file)
@@ -380,22 +722,145 @@ class MapGenerator:
           
         return files
 
-    def _set_hillshade(self, zoom, map_bounds):
+    def _warp_mosaic(self, all_files, warp_bounds, proj = None, out_size = None,
+                     cacheable = False):
+        """Mosaic and warp all_files in a single pass, using a VRT rather than
+        writing out a merged file first.
+
+        If cacheable (all_files are never modified, like cached tiles) and
+        out_size is given, the result is kept in the raster cache, and the
+        warp skipped entirely if a cached raster already covers the area.
+        """
+        out_file = self._temp_path("combined_image-processed.tiff")
+
+        if len(all_files) == 1 and proj is None:
+            # Nothing to mosaic. Warp the file directly, so that any
+            # overviews it has can be used.
+            vrt_file = all_files[0]
+            vrt = osgeo.gdal.Open(vrt_file)
+        else:
+            logging.info(f"Mosaicing {len(all_files)} Files")
+            vrt_file = self._temp_path("combined_image.vrt")
+            vrt_args = {}
+            if proj is not None:
+                vrt_args['outputSRS'] = proj
+
+            vrt = osgeo.gdal.BuildVRT(vrt_file, all_files, **vrt_args)
+
+        file_bounds = utils.get_extents(vrt, proj)
+        del vrt  # Flush to disk
+
+        file_bounds, use_bounds = self._trim_bounds(file_bounds, warp_bounds)
+        if file_bounds is None:
+            return []
+
+        kwargs = {
+            "dstSRS": "EPSG:4326",
+            "multithread": True,
+            "warpOptions": ['NUM_THREADS=ALL_CPUS'],
+            "creationOptions": ['NUM_THREADS=ALL_CPUS'],
+        }
+
+        if proj is not None:
+            kwargs['srcSRS'] = proj
+
+        if use_bounds:
+            kwargs['outputBounds'] = file_bounds
+
+        if out_size is not None:
+            # Find the resolution GDAL would use by default (cheaply, as a
+            # warped VRT), and reduce it to what is needed to draw the map.
+            auto = osgeo.gdal.Warp('', vrt_file, format = 'VRT', **kwargs)
+            x_res, y_res = auto.GetGeoTransform()[1], -auto.GetGeoTransform()[5]
+            del auto
+
+            # out_size is the size of the whole map, not just the part of it
+            # these files cover. Snapped to a power of two, so similar maps
+            # can share cached rasters.
+            need_x, need_y = self._degrees_per_pixel(warp_bounds, out_size)
+            need_x = RasterCache.snap_resolution(need_x)
+            need_y = RasterCache.snap_resolution(need_y)
+            kwargs['xRes'] = max(x_res, need_x)
+            kwargs['yRes'] = max(y_res, need_y)
+            if need_x > x_res or need_y > y_res:
+                kwargs['resampleAlg'] = 'average'
+                logging.info(f"Warping at {kwargs['xRes']}x{kwargs['yRes']} (source {x_res}x{y_res})")
+
+            if cacheable:
+                return [self._cached_warp(all_files, vrt_file, file_bounds,
+                                          proj, kwargs)]
+
+        self._update_status("Processing hillshade data...")
+        osgeo.gdal.Warp(out_file, vrt_file, callback = self._warp_progress, **kwargs)
+        return [out_file]
+
+    def _cached_warp(self, all_files, vrt_file, bounds, proj, kwargs):
+        """Cut bounds out of a cached processed raster, making (and caching)
+        one first if needed"""
+        x_res, y_res = kwargs['xRes'], kwargs['yRes']
+        raster_cache = RasterCache()
+        cached, cached_res = raster_cache.find(all_files, bounds, x_res, y_res, proj)
+        if cached is None:
+            # Warp a slightly larger, grid aligned area, so the next map of
+            # about the same place can use it too.
+            snapped = RasterCache.snap_bounds(bounds, x_res, y_res)
+            kwargs['outputBounds'] = snapped
+            cached = raster_cache.new_path()
+            tmp_file = f"{cached}.tmp"
+
+            self._update_status("Processing hillshade data...")
+            osgeo.gdal.Warp(tmp_file, vrt_file, callback = self._warp_progress,
+                            **kwargs)
+            os.replace(tmp_file, cached)
+            raster_cache.add(cached, all_files, snapped, x_res, y_res, proj)
+        else:
+            logging.info(f"Using cached processed hillshade {cached}")
+
+        translate_args = {
+            'projWin': [bounds[0], bounds[3], bounds[2], bounds[1]],
+        }
+        if cached_res is not None and cached_res != (x_res, y_res):
+            translate_args.update(xRes = x_res, yRes = y_res,
+                                  resampleAlg = 'average')
+
+        out_file = self._temp_path("combined_image-processed.tiff")
+        osgeo.gdal.Translate(out_file, cached, **translate_args)
+        return out_file
+
+    def _warp_progress(self, complete, message, data):
+        self._update_status({
+            'status': "Processing hillshade data...",
+            'progress': round(complete * 100, 1)
+        })
+        return 1
+
+    def _set_hillshade(self, zoom, map_bounds, out_size = None):
         if zoom <= 7:
             hillshade_files = ["@earth_relief_15s"]
         elif zoom < 10:
             hillshade_files = ["@earth_relief_01s"]
         else:
-            # For higher zooms, use elevation.alaska.gov data
-            self._update_status("Downloading hillshade files...")
+            elevation_store = ElevationStore()
+            if elevation_store.covers(self._split_bounds(map_bounds)):
+                # We have a local copy of this area. The warp will read the
+                # overview level matching the output resolution.
+                logging.info("Using local elevation store")
+                all_files = [elevation_store.mosaic]
+            else:
+                # For higher zooms, use elevation.alaska.gov data
+                self._update_status("Downloading hillshade files...")
 
-            tiff_dir = self._download_elevation(map_bounds)
+                tiles = self._download_elevation(map_bounds)
+                all_files = self._filter_tiles(tiles, map_bounds, out_size)
             logging.info("Generating composite hillshade file")
 
             self._update_status("Processing hillshade data...")
 
-            all_files = [os.path.join(tiff_dir, x) for x in os.listdir(tiff_dir)]
-            out_files = self._process_files(all_files, map_bounds)
+            # Tiles in the tile cache (and store mosaics) never change, so
+            # can use the raster cache
+            out_files = self._process_files(all_files, map_bounds,
+                                            out_size = out_size,
+                                            cacheable = True)
 
             hillshade_files = out_files
 
@@ -405,21 +870,128 @@ class MapGenerator:
         if uploaded_file:
             # See if we need to process this
             self._update_status("Processing uploads...")
+            # The main map and insets share one processed upload
+            with self._upload_lock:
+                processed_file = self._process_upload(uploaded_file)
 
-            img_type = self.data['imgType']
-            proj = None
+            if not self._crosses_dateline(map_bounds):
+                # GMT will trim it to the map area for us
+                hillshade_files.append(processed_file)
+            else:
+                # Map crosses the dateline. Trim to the map area, in the
+                # map's longitude range.
+                out_file = self._process_files([processed_file], map_bounds,
+                                               out_size = out_size)
+                if out_file:
+                    hillshade_files.append(out_file[0])
 
-            if img_type == 'j':
-                # Image/World files need to have their projection specified. GeoTIFF files have it embeded.
-                proj = self.data['imgProj']
+        return hillshade_files
 
-            # Either way, we need to convert to lat/lon and trim to map area
-            out_file = self._process_files([uploaded_file],
-                                           map_bounds, proj=proj)
-            if out_file:
-                hillshade_files.append(out_file[0])
+    def _start_inset_hillshades(self, inset_maps, unit):
+        """Start preparing the hillshades of the insets in the background.
+
+        Insets that don't overlap are prepared concurrently. Overlapping
+        ones are prepared in turn, so later ones can use the tiles and
+        rasters fetched and processed for earlier ones rather than fetching
+        them again. Returns the pool (None if there are no insets) and a
+        future for each inset's hillshade files.
+        """
+        if not inset_maps:
+            return None, []
+
+        groups = []  # [polys, inset indexes]
+        for idx, (bounds, *_) in enumerate(inset_maps):
+            group = [self._split_bounds(bounds), [idx]]
+            for other in [other for other in groups
+                          if any(poly.intersects(other_poly)
+                                 for poly in group[0] for other_poly in other[0])]:
+                groups.remove(other)
+                group[0] += other[0]
+                group[1] += other[1]
+            groups.append(group)
+
+        futures = [Future() for _ in inset_maps]
+
+        def prepare(indexes):
+            for idx in sorted(indexes):
+                if self._inset_cancel.is_set():
+                    futures[idx].cancel()
+                    continue
 
-        return hillshade_files
+                bounds, zoom, left, top, width, height = inset_maps[idx]
+                self._inset_local.inset = idx
+                out_size = self._mercator_size(bounds, *self._inches(width, height, unit))
+                try:
+                    futures[idx].set_result(
+                        self._set_hillshade(zoom, bounds, out_size = out_size)
+                    )
+                except Exception as e:
+                    futures[idx].set_exception(e)
+                finally:
+                    self._inset_local.inset = None
+
+        workers = min(len(groups), getattr(config, 'INSET_WORKERS', 4))
+        logging.info(f"Preparing {len(inset_maps)} inset hillshades in {len(groups)} groups")
+        pool = ThreadPoolExecutor(max_workers = max(workers, 1))
+        for polys, indexes in groups:
+            pool.submit(prepare, indexes)
+
+        return pool, futures
+
+    def _inset_hillshade(self, hillshade, idx, count):
+        """Wait for an inset's hillshade from _start_inset_hillshades,
+        reporting the progress of its preparation"""
+        while not wait([hillshade], timeout = 0.5).done:
+            status = self._inset_status.get(idx, "Preparing hillshade data...")
+            if isinstance(status, dict):
+                status = dict(status)
+            else:
+                status = {'status': status}
+            status['status'] = f"Inset map {idx + 1} of {count}: {status['status']}"
+            self._update_status(status)
+
+        return hillshade.result()
+
+    def _process_upload(self, uploaded_file):
+        """Convert the uploaded image to lat/lon, using the previously
+        processed version from the upload store if there is one."""
+        img_type = self.data['imgType']
+        proj = None
+
+        if img_type == 'j':
+            # Image/World files need to have their projection specified. GeoTIFF files have it embeded.
+            proj = self.data['imgProj']
+
+        world_file = self.data.get('worldFile')
+        world_hash = world_file.hash if world_file and world_file.name else None
+        key = UploadStore.processed_key(self.data['imgHash'], world_hash, proj)
+
+        out_file = os.path.join(self.tempdir(), "upload-processed.tiff")
+        if os.path.isfile(out_file):
+            return out_file  # Already done for another part of this map
+
+        store = UploadStore()
+        if store.checkout(key, out_file) is not None:
+            logging.info("Using stored processed upload")
+            return out_file
+
+        store.add(self.data['imgHash'], uploaded_file)
+
+        kwargs = {
+            "dstSRS": "EPSG:4326",
+            "multithread": True,
+            "warpOptions": ['NUM_THREADS=ALL_CPUS'],
+            "creationOptions": ['NUM_THREADS=ALL_CPUS'],
+        }
+
+        if proj is not None:
+            kwargs['srcSRS'] = proj
+
+        # Process the full image, rather than just the map area, so the
+        # result can be used for any map.
+        osgeo.gdal.Warp(out_file, uploaded_file, **kwargs)
+        store.add(key, out_file)
+        return out_file
 
     def _draw_hillshades(self, hillshade_file, **kwargs):
         if not isinstance(hillshade_file, (list, tuple)):
@@ -456,30 +1028,13 @@ class MapGenerator:
 
             self.fig.grdimage(file, shading=True,  **kwargs)
 
-    def _add_stations(self, stations, zoom):
-        logging.info("Plotting stations")
-        self._update_status("Plotting Stations...")
-
-        main_dir = os.path.dirname(__file__)
-        img_dir = os.path.join(main_dir, 'static/img')
-        os.chdir(img_dir)
-
-        sym_outline = "faint,128" if zoom < 10 else 'thin,128'
-
-        # sym_size = (8 / 3) * zoom - (13 + (1 / 3))
-        # if sym_size < 8:
-        # sym_size = 8
-
-        stations = self.data.get('station', [])
-        sta_count = len(stations)
-
-        plot_defs = defaultdict(lambda: defaultdict(lambda: defaultdict(list)))
+    def _prepare_stations(self, stations):
+        """Resolve the symbol, color and label of each station, once for the
+        main map and all insets. Returns a DataFrame with a row per station
+        to draw, with columns x, y, symbol, color, name, label_x, label_y,
+        anchor_x, anchor_y and labelled."""
         volcNamePos = self.data['showVolcNames']
         staNamePos = self.data.get('showStationNames', True)
-        volc_names = []
-        station_names = []
-        volc_label_lines = []
-        station_label_lines = []
 
         # Pull the user-selected icons/colors from the HTTP request data
         custom_symbols = self.station_symbols.copy()
@@ -501,17 +1056,16 @@ class MapGenerator:
         sym_size = self.BASE_SYM_SIZE * self.scale_factor
         if sym_size < 9:
             sym_size = 9
+        # Used to find the stations near enough to an inset to show in it
+        self._station_sym_size = sym_size
 
+        rows = []
         for station in stations:
             category = station.get('category', 'Unknown')
             if isinstance(category, dict):
                 category = category['type']
 
-            sta_x = float(station['lon'])
-            sta_y = float(station['lat'])
-
             if category.startswith('volcano'):
-                outline = "thin,0"
                 use_color = self.data['showVolcColor']
 
                 if use_color:
@@ -528,67 +1082,95 @@ class MapGenerator:
                 continue
 
             symbol += f"{sym_size}p"
+            is_volcano = symbol.startswith('tV')
 
-            label_x = station.get('labelLon')
-            label_y = station.get('labelLat')
-            anchor_x = station.get('anchorLon')
-            anchor_y = station.get('anchorLat')
-            origin_x = station.get('lon')
-            origin_y = station.get('lat')
+            rows.append((float(station['lon']), float(station['lat']),
+                         symbol, color, station['name'],
+                         station.get('labelLon'), station.get('labelLat'),
+                         station.get('anchorLon'), station.get('anchorLat'),
+                         (volcNamePos if is_volcano else staNamePos) != ''))
 
-            if symbol.startswith('tV') and volcNamePos != '':
-                volc_names.append((station['name'], label_x, label_y))
-                volc_label_lines.append(((anchor_x, origin_x), (anchor_y, origin_y)))
-
-            if not symbol.startswith('tV') and staNamePos != '':
-                station_names.append((station['name'], label_x, label_y))
-                station_label_lines.append(((anchor_x, origin_x), (anchor_y, origin_y)))
-
-            plot_defs[symbol][color]['x'].append(sta_x)
-            plot_defs[symbol][color]['y'].append(sta_y)
-
-            if not symbol.startswith('tV'):
+            if not is_volcano:
                 label = legend_labels[category]
-                plot_defs[symbol][color]['label'] = label
                 self._used_symbols[label] = {'symbol': symbol,
                                              'color': color, }
 
-        #Station/marker name labels
-        labels = []
-        label_lines = []
-        if station_names:
-            labels += station_names
-            label_lines += station_label_lines
-        if volc_names:
-            labels += volc_names
-            label_lines += volc_label_lines
+        prepared = pandas.DataFrame(rows, columns = [
+            'x', 'y', 'symbol', 'color', 'name',
+            'label_x', 'label_y', 'anchor_x', 'anchor_y', 'labelled'
+        ])
+        for col in ('label_x', 'label_y', 'anchor_x', 'anchor_y'):
+            prepared[col] = pandas.to_numeric(prepared[col], errors = 'coerce')
+
+        return prepared
+
+    def _add_stations(self, prepared, zoom, bounds = None, width = None):
+        """Draw stations from _prepare_stations. If bounds ([west, east,
+        south, north]) is given, only those that can show inside it are
+        drawn. width is the width of the area, in inches."""
+        logging.info("Plotting stations")
+        self._update_status("Plotting Stations...")
+
+        if bounds is not None:
+            west, east, south, north = bounds
+            # Stations just outside can still show, partly, or through their
+            # label and leader line. So pad by a symbol's size at this
+            # scale, and keep stations with their label or anchor inside.
+            pad = 0
+            if width:
+                span = (east - west) % 360 or 360
+                pad = self._station_sym_size / 72 * span / width
+
+            def inside(xs, ys):
+                return (utils.lon_in_bounds(xs.to_numpy(), west - pad, east + pad)
+                        & ys.between(south - pad, north + pad).to_numpy())
+
+            label_inside = (inside(prepared['label_x'], prepared['label_y'])
+                            | inside(prepared['anchor_x'], prepared['anchor_y']))
+            visible = (inside(prepared['x'], prepared['y'])
+                       | (prepared['labelled'].to_numpy() & label_inside))
+            prepared = prepared[visible]
+            logging.info(f"{len(prepared)} stations in or near the inset")
+
+        if not len(prepared):
+            return
+
+        main_dir = os.path.dirname(__file__)
+        img_dir = os.path.join(main_dir, 'static/img')
+        os.chdir(img_dir)
+
+        sym_outline = "faint,128" if zoom < 10 else 'thin,128'
+
+        # sym_size = (8 / 3) * zoom - (13 + (1 / 3))
+        # if sym_size < 8:
+        # sym_size = 8
+
+        sta_count = len(prepared)
+
+        #Station/marker name labels, stations first, then volcanoes
+        labels = prepared[prepared['labelled']]
+        labels = labels.iloc[numpy.argsort(labels['symbol'].str.startswith('tV').to_numpy(),
+                                           kind = 'stable')]
 
         complete = 0
         run_count = sta_count
-        if labels: # if labels, then label lines as well, or else bug.
-            run_count += len(label_lines)
+        if len(labels): # if labels, then label lines as well, or else bug.
+            run_count += len(labels)
             try:
                 import pygmt
             except Exception:
                 os.environ['GMT_LIBRARY_PATH'] = '/usr/local/lib'
                 import pygmt
 
-            for line_x, line_y in label_lines:
-                try:
-                    self.fig.plot(x = line_x, y = line_y, pen = '1p')
-                except:
-                    pass
+            self._plot_label_lines(labels[['anchor_x', 'anchor_y', 'x', 'y']].to_numpy())
 
-                complete += 1
-                prog = round((complete / run_count) * 100, 1)
-                self._update_status({
-                    'status': "Plotting Stations...",
-                    'progress': prog
-                })
+            complete += len(labels)
+            prog = round((complete / run_count) * 100, 1)
+            self._update_status({
+                'status': "Plotting Stations...",
+                'progress': prog
+            })
 
-            names, vx, vy = zip(*labels)
-            vx = numpy.asarray(vx, dtype = float)
-            vy = numpy.asarray(vy, dtype = float)
             font_size = self.BASE_FONT_SIZE * self.scale_factor
             if font_size < 8:
                 font_size = 8
@@ -597,15 +1179,25 @@ class MapGenerator:
             with pygmt.config(FONT_ANNOT_PRIMARY = font_str):
                 # Plot the names using standard positioning
                 self.fig.text(
-                    x = vx, y = vy,
-                    text = names,
+                    x = labels['label_x'].to_numpy(),
+                    y = labels['label_y'].to_numpy(),
+                    text = labels['name'].tolist(),
                     justify = 'TL',
                 )
 
-        for symbol, sym_dict in plot_defs.items():
-            for color, col_dict in sym_dict.items():
-                x = col_dict['x']
-                y = col_dict['y']
+        # One plot call per symbol/color combination: symbols in order of
+        # first appearance, then each symbol's colors in order of first
+        # appearance, so later groups are drawn on top, as before.
+        sta_xs = prepared['x'].to_numpy()
+        sta_ys = prepared['y'].to_numpy()
+        groups = {}
+        for idx, (symbol, color) in enumerate(zip(prepared['symbol'], prepared['color'])):
+            groups.setdefault(symbol, {}).setdefault(color, []).append(idx)
+
+        for symbol, colors in groups.items():
+            for color, members in colors.items():
+                x = sta_xs[members]
+                y = sta_ys[members]
                 outline = sym_outline
                 plot_symbol = symbol
                 if symbol.startswith('tV'):  # this is a volcano marker
@@ -622,6 +1214,21 @@ class MapGenerator:
                     'progress': prog
                 })
 
+    def _plot_label_lines(self, lines):
+        """Draw label leader lines (rows of anchor_x, anchor_y, origin_x,
+        origin_y) with a single plot call, as one multi-segment file. Lines
+        missing a coordinate are skipped."""
+        lines = lines[numpy.isfinite(lines).all(axis = 1)]
+        if not len(lines):
+            return
+
+        with NamedTemporaryFile('w', dir = self.tempdir(), suffix = '.txt') as file:
+            file.write(''.join(f">\n{anchor_x} {anchor_y}\n{origin_x} {origin_y}\n"
+                               for anchor_x, anchor_y, origin_x, origin_y in lines.tolist()))
+            file.flush()
+
+            self.fig.plot(data = file.name, pen = '1p')
+
     def _plot_data(self, zoom):
         plotdata_file = self.data.get('plotDataFile')
         if plotdata_file is None:
@@ -632,32 +1239,55 @@ class MapGenerator:
         sym_size = (8 / 4) * zoom - (13 + (1 / 3))
         symbol = f"c{sym_size}p"
 
-        latcol = self.data.get('latcol', 'latitude')
-        loncol = self.data.get('loncol', 'longitude')
-        valcol = self.data.get('valcol', 'value')
+        latcol = self.data.get('latcol') or 'latitude'
+        loncol = self.data.get('loncol') or 'longitude'
+        valcol = self.data.get('valcol') or 'value'
 
-        plot_data = pandas.read_csv(plotdata_file)
-        logging.info("Plot data file:")
-        logging.info(str(plot_data))
+        points = read_points(plotdata_file, latcol, loncol, valcol, self.gmt_bounds)
+        if not len(points):
+            logging.warning("No plot data points inside the map")
+            return
+
+        # Optionally reduce dense data to one value per symbol (or, drawn
+        # as a grid, per pixel). The color scale is then that of the reduced
+        # values.
+        reducer = self.data.get('dataAggregate')
+        as_grid = False
+        if reducer:
+            as_grid = self.data.get('dataAggregateStyle') == 'grid'
+            map_width, map_height = self._inches(self.data['width'],
+                                                 self.data['height'],
+                                                 self.data['unit'])
+            if as_grid:
+                per_inch = self.DATA_GRID_DPI
+            else:
+                per_inch = 72 / max(sym_size, 1)
 
-        latitudes = plot_data[latcol].to_numpy()
-        longitudes = plot_data[loncol].to_numpy()
-        values = plot_data[valcol].to_numpy()
+            shape = (max(int(map_height * per_inch), 1),
+                     max(int(map_width * per_inch), 1))
+            points = aggregate(points, self.gmt_bounds, shape, reducer)
+
+        latitudes = points.latitudes
+        longitudes = points.longitudes
+        values = points.values
 
         trans_level = self.data.get('dataTrans', 0)
         cm = self.data.get('colorMap')
         cm_min = self.data.get('cmMin')
         cm_max = self.data.get('cmMax')
 
+        # Color scale from the whole file, not just the points shown (unless
+        # aggregated)
         if cm_min is None:
-            cm_min = values.min()
+            cm_min = points.value_min
         if cm_max is None:
-            cm_max = values.max()
+            cm_max = points.value_max
 
         if (cm_max - cm_min) > 1e6:
-            scaled_values = 2000.0 * (values - cm_min) / numpy.ptp(values) - 1000
-            cm_min_scaled = scaled_values.min()
-            cm_max_scaled = scaled_values.max()
+            value_range = points.value_max - points.value_min
+            scaled_values = 2000.0 * (values - cm_min) / value_range - 1000
+            cm_min_scaled = 2000.0 * (points.value_min - cm_min) / value_range - 1000
+            cm_max_scaled = 2000.0 * (points.value_max - cm_min) / value_range - 1000
         else:
             scaled_values = values
             cm_min_scaled = cm_min
@@ -675,8 +1305,12 @@ class MapGenerator:
         pygmt.makecpt(cmap = cm, series = ("{:f}". format(cm_min_scaled),
                                            "{:f}". format(cm_max_scaled)),
                       background = "i")
-        self.fig.plot(x = longitudes, y = latitudes, style = symbol,
-                      color = scaled_values, cmap = True, transparency = trans_level)
+        if as_grid:
+            self.fig.grdimage(points.grid(scaled_values), cmap = True,
+                              nan_transparent = True, transparency = trans_level)
+        else:
+            self.fig.plot(x = longitudes, y = latitudes, style = symbol,
+                          color = scaled_values, cmap = True, transparency = trans_level)
         logging.info("data plotted!")
 
         cb_position = self.data.get('colorbar')
@@ -765,13 +1399,12 @@ class MapGenerator:
         print("Map generation failed! Error:")
         print(error)
         print("-->{}<--".format(error.__cause__))
-        data = _global_session[req_id]
-        data['gen_status'] = "FAILED"
-        _global_session[req_id] = data
+        _global_session.set_status(req_id, "FAILED")
 
     def generate(self, queue, req_id):
         logging.info("Starting generation process")
         self._socket_queue = queue
+        inset_pool = None
         try:
             self.data = _global_session.get(self._req_id)
             self._update_status("Initializing")
@@ -852,10 +1485,24 @@ class MapGenerator:
             self.fig.basemap(**basemap_args)
 
             zoom = self.data['mapZoom']
-            hillshade_file = self._set_hillshade(zoom, warp_bounds)
+            # The frame is width wide, and as tall as Mercator makes it,
+            # whatever height was requested.
+            out_size = self._mercator_size(warp_bounds,
+                                           self._inches(width, height, unit)[0])
+            hillshade_file = self._set_hillshade(zoom, warp_bounds,
+                                                 out_size = out_size)
+
+            # Get the inset hillshades ready while the main map is drawn
+            inset_maps = list(zip(self.data['insetBounds'],
+                                  self.data['insetZoom'],
+                                  self.data['insetLeft'],
+                                  self.data['insetTop'],
+                                  self.data['insetWidth'],
+                                  self.data['insetHeight']))
+            inset_pool, inset_hillshades = self._start_inset_hillshades(inset_maps, unit)
 
             hillshade_args = {
-                "dpi": 300,
+                "dpi": self.HILLSHADE_DPI,
                 # "shading": True
             }
 
@@ -874,8 +1521,9 @@ class MapGenerator:
             logging.info("Getting ready to add stations")
             cur_dir = os.getcwd()
 
-            # Plot stations/markers on map
-            stations = self.data.get('station', [])
+            # Plot stations/markers on map. Prepared once, and reused
+            # (clipped to their bounds) for the insets.
+            stations = self._prepare_stations(self.data.get('station', []))
             self._add_stations(stations, zoom)
 
             logging.info("Adding scalebar")
@@ -948,14 +1596,8 @@ class MapGenerator:
                                   style=f"a{star_size}", fill="blue")
 
             ############# INSET MAPS##############
-            inset_maps = zip(self.data['insetBounds'],
-                             self.data['insetZoom'],
-                             self.data['insetLeft'],
-                             self.data['insetTop'],
-                             self.data['insetWidth'],
-                             self.data['insetHeight'])
-
-            for bounds, zoom, left, top, width, height in inset_maps:
+            for inset_idx, ((bounds, zoom, left, top, width, height),
+                            hillshade) in enumerate(zip(inset_maps, inset_hillshades)):
                 inset_bounds = [
                     bounds[0],
                     bounds[2],
@@ -963,7 +1605,8 @@ class MapGenerator:
                     bounds[3]
                 ]
 
-                hillshade_file = self._set_hillshade(zoom, bounds)
+                hillshade_file = self._inset_hillshade(hillshade, inset_idx,
+                                                       len(inset_maps))
                 pos = f"x{left}{unit}/{top}{unit}+w{width}{unit}/{height}{unit}+jTL"
 
                 with self.fig.inset(position=pos, box="+gwhite+p1p"):
@@ -971,14 +1614,19 @@ class MapGenerator:
                         "region": inset_bounds,
                         "projection": "M?",
                         # "shading": True,
-                        "dpi": 300,
+                        "dpi": self.HILLSHADE_DPI,
                     }
                     self._draw_hillshades(hillshade_file, **hillshade_args)
 
                     self.fig.coast(water='#CBE7FF',
                                    resolution='f')
 
-                    self._add_stations(stations, zoom)
+                    inset_size = self._mercator_size(bounds,
+                                                     *self._inches(width, height, unit))
+                    self._add_stations(stations, zoom, inset_bounds, inset_size[0])
+
+            if inset_pool is not None:
+                inset_pool.shutdown()
 
             legend = self.data['legend']
 
@@ -1051,23 +1699,38 @@ class MapGenerator:
             os.makedirs(cache_dir, exist_ok = True)
             file_path = os.path.join(cache_dir, save_file)
             self.fig.savefig(file_path, resize = "+m.25i", anti_alias = True)
+            if self.data.get('result_key'):
+                ResultCache().store(self.data['result_key'], file_path)
+
             self.data['map_file'] = file_path
-            self.data['gen_status'] = "Complete"
             _global_session[self._req_id] = self.data
+            _global_session.set_status(self._req_id, "Complete")
             self._update_status("COMPLETE")
-
+            logging.debug(str(file_path))
+        except Exception as e:
+            if inset_pool is not None:
+                # Stop preparing insets (at the next status update for any in
+                # progress), and wait, so nothing is still running, or
+                # writing to the temp dir, once the failure is reported.
+                self._inset_cancel.set()
+                inset_pool.shutdown(wait = True)
+            if self._progress is not None:
+                self._progress.cancel()
+            try:
+                if self._socket_queue is not None:
+                    self._socket_queue.send('ERROR')
+            except OSError:
+                pass
+            traceback.print_exc()
+            self._gen_fail_callback(req_id, e)
+        finally:
             # Clean up the temporary directory
             logging.info(f"Cleaning up temporary directory {self.tempdir()}")
             try:
                 shutil.rmtree(self.tempdir())
             except OSError as err:
                 if err.errno != errno.ENOENT:
-                    raise
-            logging.debug(str(file_path))
-        except Exception as e:
-            self._socket_queue.send('ERROR')
-            traceback.print_exc()
-            self._gen_fail_callback(req_id, e)
+                    logging.warning(f"Unable to remove {self.tempdir()}: {err}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,236 @@
+"""Reading of uploaded point data (latitude, longitude, value) for plotting.
+
+Point files can have millions of rows, most of them often well outside the
+map. Only the three columns needed are read, as float64, a chunk at a time,
+and only the points inside the map kept, so memory use depends on the
+number of points shown rather than the size of the file.
+
+CSV, Parquet, Feather (Arrow IPC) and NetCDF files are supported, chosen by
+file extension. Parquet and Feather need pyarrow.
+"""
+
+import logging
+import os
+
+import numpy
+import pandas
+import xarray
+
+try:
+    from .utils import lon_in_bounds
+except ImportError:
+    from utils import lon_in_bounds
+
+
+# Rows read at a time
+CHUNK_ROWS = 1_000_000
+
+_PARQUET = ('.parquet', '.parq', '.pq')
+_FEATHER = ('.feather', '.arrow', '.ipc')
+_NETCDF = ('.nc', '.nc4', '.netcdf', '.cdf')
+
+
+class PointData:
+    """Points inside the map, along with the range of values in the whole
+    file (so the color scale doesn't depend on the part of the file shown)"""
+
+    def __init__(self, latitudes, longitudes, values, value_min, value_max, total):
+        self.latitudes = latitudes
+        self.longitudes = longitudes
+        self.values = values
+        self.value_min = value_min
+        self.value_max = value_max
+        self.total = total
+
+    def __len__(self):
+        return len(self.values)
+
+
+def _csv_chunks(path, columns):
+    reader = pandas.read_csv(path, usecols = columns,
+                             dtype = {col: numpy.float64 for col in columns},
+                             chunksize = CHUNK_ROWS)
+    with reader:
+        for chunk in reader:
+            yield [chunk[col].to_numpy() for col in columns]
+
+
+def _parquet_chunks(path, columns):
+    import pyarrow.parquet
+
+    parquet_file = pyarrow.parquet.ParquetFile(path)
+    for idx in range(parquet_file.num_row_groups):
+        table = parquet_file.read_row_group(idx, columns = columns)
+        yield [table.column(col).to_numpy().astype(numpy.float64) for col in columns]
+
+
+def _feather_chunks(path, columns):
+    import pyarrow
+    import pyarrow.ipc
+
+    # Memory mapped, and read a record batch at a time
+    with pyarrow.memory_map(path) as source:
+        reader = pyarrow.ipc.open_file(source)
+        for idx in range(reader.num_record_batches):
+            batch = reader.get_batch(idx)
+            yield [batch.column(col).to_numpy(zero_copy_only = False).astype(numpy.float64)
+                   for col in columns]
+
+
+def _netcdf_chunks(path, columns):
+    with xarray.open_dataset(path) as dataset:
+        variables = [dataset[col] for col in columns]
+        dims = {var.dims for var in variables}
+        if len(dims) != 1 or len(variables[0].dims) != 1:
+            raise ValueError("NetCDF point data must have latitude, longitude "
+                             "and value variables along a single, shared dimension")
+
+        dim = variables[0].dims[0]
+        for start in range(0, dataset.sizes[dim], CHUNK_ROWS):
+            rows = slice(start, start + CHUNK_ROWS)
+            yield [var.isel({dim: rows}).to_numpy().astype(numpy.float64)
+                   for var in variables]
+
+
+def _chunks(path, columns):
+    ext = os.path.splitext(path)[1].lower()
+    if ext in _PARQUET:
+        return _parquet_chunks(path, columns)
+    if ext in _FEATHER:
+        return _feather_chunks(path, columns)
+    if ext in _NETCDF:
+        return _netcdf_chunks(path, columns)
+
+    return _csv_chunks(path, columns)
+
+
+def read_points(path, latcol, loncol, valcol, bounds):
+    """Read the points in path inside bounds ([west, east, south, north],
+    as used for the GMT region, where east may be past 180 for maps crossing
+    the dateline)"""
+    west, east, south, north = bounds
+    lat_parts = []
+    lon_parts = []
+    val_parts = []
+    value_min = numpy.inf
+    value_max = -numpy.inf
+    total = 0
+
+    for lats, lons, values in _chunks(path, [latcol, loncol, valcol]):
+        total += len(values)
+        valid = numpy.isfinite(values)
+        if valid.any():
+            value_min = min(value_min, values[valid].min())
+            value_max = max(value_max, values[valid].max())
+
+        keep = (valid
+                & (lats >= south) & (lats <= north)
+                & lon_in_bounds(lons, west, east))
+        lat_parts.append(lats[keep])
+        lon_parts.append(lons[keep])
+        val_parts.append(values[keep])
+
+    if not numpy.isfinite(value_min):
+        value_min = value_max = numpy.nan
+
+    points = PointData(numpy.concatenate(lat_parts) if lat_parts else numpy.empty(0),
+                       numpy.concatenate(lon_parts) if lon_parts else numpy.empty(0),
+                       numpy.concatenate(val_parts) if val_parts else numpy.empty(0),
+                       value_min, value_max, total)
+    logging.info(f"Read {total} points from {os.path.basename(path)}, {len(points)} inside the map")
+    return points
+
+
+AGGREGATES = ('mean', 'median', 'max')
+
+
+class BinnedPoints:
+    """Point data reduced to one value per bin of a regular lon/lat grid"""
+
+    def __init__(self, rows, cols, lons, lats, values, bounds, shape):
+        self.rows = rows
+        self.cols = cols
+        self.longitudes = lons
+        self.latitudes = lats
+        self.values = values
+        self.bounds = bounds
+        self.shape = shape
+
+    def __len__(self):
+        return len(self.values)
+
+    @property
+    def value_min(self):
+        return self.values.min()
+
+    @property
+    def value_max(self):
+        return self.values.max()
+
+    def grid(self, values = None):
+        """The bins as an xarray grid (NaN where there are no points), for
+        grdimage. values, if given, replaces the binned values (e.g. with a
+        rescaled copy)."""
+        if values is None:
+            values = self.values
+
+        west, east, south, north = self.bounds
+        n_rows, n_cols = self.shape
+        x_step = (east - west) / n_cols
+        y_step = (north - south) / n_rows
+
+        data = numpy.full(self.shape, numpy.nan, dtype = numpy.float32)
+        data[self.rows, self.cols] = values
+        return xarray.DataArray(
+            data,
+            dims = ('lat', 'lon'),
+            coords = {'lat': south + (numpy.arange(n_rows) + 0.5) * y_step,
+                      'lon': west + (numpy.arange(n_cols) + 0.5) * x_step},
+        )
+
+
+def aggregate(points, bounds, shape, reducer = 'mean'):
+    """Bin points (all inside bounds, see read_points) into a grid of shape
+    (rows, cols) over bounds, reducing the values in each bin with reducer
+    (one of AGGREGATES). Each bin's point is placed at the mean position of
+    the points in it."""
+    if reducer not in AGGREGATES:
+        raise ValueError(f"Unknown aggregate {reducer}")
+
+    west, east, south, north = bounds
+    n_rows, n_cols = shape
+    # Longitudes relative to west, so maps crossing the dateline bin correctly
+    rel_lons = (points.longitudes - west) % 360
+    cols = numpy.minimum((rel_lons * n_cols / (east - west)).astype(numpy.int64), n_cols - 1)
+    rows = numpy.minimum(((points.latitudes - south) * n_rows / (north - south)).astype(numpy.int64),
+                         n_rows - 1)
+    bins = rows * n_cols + cols
+    n_bins = n_rows * n_cols
+
+    counts = numpy.bincount(bins, minlength = n_bins)
+    used = numpy.flatnonzero(counts)
+    counts = counts[used]
+
+    if reducer == 'mean':
+        values = numpy.bincount(bins, points.values, n_bins)[used] / counts
+    elif reducer == 'max':
+        values = numpy.full(n_bins, -numpy.inf)
+        numpy.maximum.at(values, bins, points.values)
+        values = values[used]
+    else:
+        # Sort by bin, then value, so each bin's values are one contiguous,
+        # sorted run, in the same order as used.
+        by_value = numpy.argsort(points.values)
+        order = by_value[numpy.argsort(bins[by_value], kind = 'stable')]
+        sorted_values = points.values[order]
+        starts = numpy.r_[0, numpy.cumsum(counts)[:-1]]
+        values = (sorted_values[starts + (counts - 1) // 2]
+                  + sorted_values[starts + counts // 2]) / 2
+
+    lons = west + numpy.bincount(bins, rel_lons, n_bins)[used] / counts
+    lats = numpy.bincount(bins, points.latitudes, n_bins)[used] / counts
+
+    binned = BinnedPoints(used // n_cols, used % n_cols, lons, lats, values,
+                          bounds, shape)
+    logging.info(f"Aggregated {len(points)} points into {len(binned)} bins ({reducer})")
+    return binned
@@ -0,0 +1,70 @@
+import threading
+import time
+
+try:
+    from . import config
+except ImportError:
+    import config
+
+
+class ProgressPublisher:
+    """Rate limit progress updates from the generator hot loops.
+
+    Status dictionaries (with a progress value) are published no more than
+    `max_rate` times per second. Updates arriving faster than that are
+    merged, with only the most recent one being published once the interval
+    has passed. Plain string statuses (new steps, COMPLETE, ERROR etc.) and
+    100% progress updates are always published immediately, and replace any
+    update still waiting to be sent.
+    """
+
+    def __init__(self, publish, max_rate = None):
+        if max_rate is None:
+            max_rate = getattr(config, 'STATUS_UPDATES_PER_SEC', 4)
+
+        self._publish = publish
+        self._interval = 1 / max_rate if max_rate else 0
+        self._last_sent = 0
+        self._pending = None
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def update(self, status):
+        with self._lock:
+            immediate = (not isinstance(status, dict)
+                         or status.get('progress', 0) >= 100)
+
+            wait = self._last_sent + self._interval - time.monotonic()
+            if immediate or wait <= 0:
+                self._pending = None
+                self._send(status)
+                return
+
+            self._pending = status
+            if self._timer is None:
+                # Make sure the latest update goes out even if nothing
+                # else comes along after it.
+                self._timer = threading.Timer(wait, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        """Publish any update still waiting on the rate limit"""
+        with self._lock:
+            self._timer = None
+            if self._pending is not None:
+                status = self._pending
+                self._pending = None
+                self._send(status)
+
+    def cancel(self):
+        """Drop any update still waiting on the rate limit"""
+        with self._lock:
+            self._pending = None
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+    def _send(self, status):
+        self._last_sent = time.monotonic()
+        self._publish(status)
@@ -0,0 +1,146 @@
+import json
+import logging
+import math
+import os
+import sqlite3
+import time
+import uuid
+
+try:
+    from . import config
+except ImportError:
+    import config
+
+
+class RasterCache:
+    """On-disk, size-bounded cache of processed (mosaiced and warped to
+    EPSG:4326) hillshade rasters.
+
+    Rasters are keyed by the source files they were made from, their bounds,
+    resolution and source projection. Any later request for an area inside a
+    cached raster, from the same (or fewer) sources, at the same or a coarser
+    resolution, can be cut out of it rather than warped again. Bounds and
+    resolution are snapped to a grid, so that nearly identical requests share
+    a raster.
+
+    Rasters are evicted least-recently-used first once the total size of the
+    cache grows past `max_bytes`.
+    """
+
+    # Don't evict rasters that may still be in use by a running generator
+    MIN_AGE = 600
+
+    # Raster bounds are snapped outwards to multiples of this many pixels
+    SNAP_PIXELS = 256
+
+    def __init__(self, cache_dir = None, max_bytes = None):
+        if cache_dir is None:
+            cache_dir = getattr(config, 'RASTER_CACHE_DIR', None)
+        if cache_dir is None:
+            script_dir = os.path.dirname(__file__)
+            cache_dir = os.path.join(script_dir, 'cache', 'rasters')
+
+        if max_bytes is None:
+            max_bytes = getattr(config, 'RASTER_CACHE_SIZE', 5 * 1024 ** 3)
+
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok = True)
+        self.cache_file = os.path.join(cache_dir, "raster_index")
+        with sqlite3.connect(self.cache_file) as cache:
+            cur = cache.cursor()
+            cur.execute("""CREATE TABLE IF NOT EXISTS rasters(
+                path, srs, x_res, y_res, minx, miny, maxx, maxy, sources,
+                size, last_used, UNIQUE(path))""")
+
+    @staticmethod
+    def snap_resolution(res):
+        """Round res down to a power of two, so it is at least as fine"""
+        return 2 ** math.floor(math.log2(res))
+
+    @classmethod
+    def snap_bounds(cls, bounds, x_res, y_res):
+        """Expand bounds out to the snapping grid for this resolution"""
+        x_step = x_res * cls.SNAP_PIXELS
+        y_step = y_res * cls.SNAP_PIXELS
+        return [
+            math.floor(bounds[0] / x_step) * x_step,
+            max(math.floor(bounds[1] / y_step) * y_step, -90),
+            math.ceil(bounds[2] / x_step) * x_step,
+            min(math.ceil(bounds[3] / y_step) * y_step, 90),
+        ]
+
+    def new_path(self):
+        """A new, unique path in the cache to write a raster to"""
+        return os.path.join(self.cache_dir, f"{uuid.uuid4().hex}.tiff")
+
+    def find(self, sources, bounds, x_res, y_res, srs = None):
+        """Find a cached raster covering bounds, made from (at least) sources,
+        at x_res/y_res or finer. Returns the path and resolution of the
+        smallest one, or (None, None) if there isn't one."""
+        sources = set(sources)
+        # Allow for floating point noise in the bounds and resolution
+        eps = 1e-9
+        with sqlite3.connect(self.cache_file) as cache:
+            cur = cache.cursor()
+            cur.execute("""SELECT path, x_res, y_res, sources FROM rasters
+                        WHERE srs=? AND x_res<=? AND y_res<=?
+                        AND minx<=? AND miny<=? AND maxx>=? AND maxy>=?
+                        ORDER BY (maxx-minx)*(maxy-miny)""",
+                        (srs or '', x_res + eps, y_res + eps,
+                         bounds[0] + eps, bounds[1] + eps,
+                         bounds[2] - eps, bounds[3] - eps))
+            for path, found_x, found_y, found_sources in cur.fetchall():
+                if not sources.issubset(json.loads(found_sources)):
+                    continue
+                if not os.path.isfile(path):
+                    continue
+
+                cur.execute("UPDATE rasters SET last_used=? WHERE path=?",
+                            (time.time(), path))
+                cache.commit()
+                return path, (found_x, found_y)
+
+        return None, None
+
+    def add(self, path, sources, bounds, x_res, y_res, srs = None):
+        """Add a raster written to new_path()"""
+        with sqlite3.connect(self.cache_file) as cache:
+            cur = cache.cursor()
+            cur.execute("""INSERT OR REPLACE INTO rasters
+                        (path, srs, x_res, y_res, minx, miny, maxx, maxy,
+                         sources, size, last_used)
+                        VALUES (?,?,?,?,?,?,?,?,?,?,?)""",
+                        (path, srs or '', x_res, y_res, *bounds,
+                         json.dumps(sorted(sources)), os.path.getsize(path),
+                         time.time()))
+            cache.commit()
+
+        self.evict()
+
+    def evict(self):
+        """Remove least recently used rasters until the cache fits in max_bytes"""
+        with sqlite3.connect(self.cache_file) as cache:
+            cur = cache.cursor()
+            cur.execute("SELECT SUM(size) FROM rasters")
+            total = cur.fetchone()[0] or 0
+            if total <= self.max_bytes:
+                return
+
+            cutoff = time.time() - self.MIN_AGE
+            cur.execute("""SELECT path, size FROM rasters
+                        WHERE last_used<? ORDER BY last_used""", (cutoff, ))
+            for path, size in cur.fetchall():
+                if total <= self.max_bytes:
+                    break
+
+                logging.info(f"Evicting processed hillshade {path} from cache")
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+                total -= size
+                cur.execute("DELETE FROM rasters WHERE path=?", (path, ))
+
+            cache.commit()
@@ -0,0 +1,203 @@
+import hashlib
+import json
+import logging
+import os
+import pickle
+import shutil
+import sqlite3
+import time
+import uuid
+
+try:
+    from . import config
+except ImportError:
+    import config
+
+
+# Request fields that don't affect the generated map, or that refer to
+# per-request upload locations rather than their content. The image file is
+# identified by imgHash and imgName, which are set whether it was uploaded
+# or already stored.
+_IGNORED_FIELDS = {
+    'socketID',
+    'result_key',
+    'hillshade_file',
+    'plotDataFile',
+    'imgFile',
+}
+
+
+def request_key(data):
+    """Canonical hash of a map request, from the parsed MapSchema values"""
+    values = {}
+    for field, value in data.items():
+        if field in _IGNORED_FIELDS:
+            continue
+
+        if hasattr(value, 'save'):
+            # An uploaded file. Key on the name (which determines how GDAL
+            # reads it, and pairs it with its world file) and content.
+            if not value.name:
+                value = None
+            else:
+                value = {'name': value.name, 'hash': value.hash}
+
+        values[field] = value
+
+    canonical = json.dumps(values, sort_keys = True, default = str)
+    return hashlib.blake2b(canonical.encode('UTF-8'), digest_size = 20).hexdigest()
+
+
+def _link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+class ResultCache:
+    """Rendered maps, keyed by request_key, kept for up to `ttl` seconds
+    and `max_bytes` total size, least recently used maps being removed
+    first.
+
+    Also tracks which maps are being generated, by any web server process,
+    so identical requests can wait for the one map rather than each
+    generating their own."""
+
+    def __init__(self, ttl = None, max_bytes = None, in_flight_timeout = None):
+        if ttl is None:
+            ttl = getattr(config, 'RESULT_CACHE_TTL', 24 * 60 * 60)
+        if max_bytes is None:
+            max_bytes = getattr(config, 'RESULT_CACHE_SIZE', 2 * 1024 ** 3)
+        if in_flight_timeout is None:
+            in_flight_timeout = getattr(config, 'IN_FLIGHT_TIMEOUT', 60 * 60)
+
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.in_flight_timeout = in_flight_timeout
+
+        script_dir = os.path.dirname(__file__)
+        self.map_dir = os.path.join(script_dir, 'cache')
+        self.cache_dir = os.path.join(self.map_dir, 'results')
+        os.makedirs(self.cache_dir, exist_ok = True)
+        self.cache_file = os.path.join(self.cache_dir, "result_index")
+        with sqlite3.connect(self.cache_file) as cache:
+            cur = cache.cursor()
+            cur.execute("""CREATE TABLE IF NOT EXISTS results(
+                key, path, size, created, last_used, UNIQUE(key))""")
+            cur.execute("""CREATE TABLE IF NOT EXISTS in_flight(
+                key, started, UNIQUE(key))""")
+            cur.execute("""CREATE TABLE IF NOT EXISTS in_flight_waiting(
+                key, req_id, status_pipe)""")
+
+    def store(self, key, map_file):
+        """Add a copy of a rendered map to the cache"""
+        path = os.path.join(self.cache_dir, f"{key}.pdf")
+        tmp_path = f"{path}.{uuid.uuid4().hex}"
+        _link_or_copy(map_file, tmp_path)
+        os.replace(tmp_path, path)
+
+        now = time.time()
+        with sqlite3.connect(self.cache_file) as cache:
+            cur = cache.cursor()
+            cur.execute("""INSERT OR REPLACE INTO results
+                        (key, path, size, created, last_used)
+                        VALUES (?,?,?,?,?)""",
+                        (key, path, os.path.getsize(path), now, now))
+            cache.commit()
+
+        self.evict(keep = key)
+
+    def checkout(self, key):
+        """Get a copy of the cached map for key, for a single request to
+        download (and remove). Returns None if there is no cached map."""
+        with sqlite3.connect(self.cache_file) as cache:
+            cur = cache.cursor()
+            cur.execute("SELECT path, created FROM results WHERE key=?", (key, ))
+            row = cur.fetchone()
+            if row is None:
+                return None
+
+            path, created = row
+            if time.time() - created > self.ttl or not os.path.isfile(path):
+                return None
+
+            cur.execute("UPDATE results SET last_used=? WHERE key=?",
+                        (time.time(), key))
+            cache.commit()
+
+        map_file = os.path.join(self.map_dir, f'{uuid.uuid4().hex}.pdf')
+        try:
+            _link_or_copy(path, map_file)
+        except FileNotFoundError:
+            return None  # Evicted out from under us
+
+        return map_file
+
+    def attach(self, key, req_id, status_pipe):
+        """Attach a request to an identical one already being generated,
+        returning True. If there is none, the request is recorded as being
+        generated, and False returned. The owner must call release(key)
+        once it has finished, successfully or not."""
+        with sqlite3.connect(self.cache_file, timeout = 30,
+                             isolation_level = None) as cache:
+            cur = cache.cursor()
+            # Immediate, so two identical requests can't both become owner
+            cur.execute("BEGIN IMMEDIATE")
+            cur.execute("SELECT started FROM in_flight WHERE key=?", (key, ))
+            row = cur.fetchone()
+            now = time.time()
+            if row is not None and now - row[0] < self.in_flight_timeout:
+                cur.execute("""INSERT INTO in_flight_waiting (key, req_id, status_pipe)
+                            VALUES (?,?,?)""",
+                            (key, req_id, pickle.dumps(status_pipe)))
+                return True
+
+            # Either new, or its owner went away without releasing it. Any
+            # requests waiting on a lost owner now wait on this one.
+            cur.execute("INSERT OR REPLACE INTO in_flight (key, started) VALUES (?,?)",
+                        (key, now))
+            return False
+
+    def release(self, key):
+        """Mark key as no longer being generated, returning the (req_id,
+        status_pipe) of the requests that were waiting on it"""
+        with sqlite3.connect(self.cache_file, timeout = 30,
+                             isolation_level = None) as cache:
+            cur = cache.cursor()
+            cur.execute("BEGIN IMMEDIATE")
+            cur.execute("SELECT req_id, status_pipe FROM in_flight_waiting WHERE key=?",
+                        (key, ))
+            waiting = [(req_id, pickle.loads(status_pipe))
+                       for req_id, status_pipe in cur.fetchall()]
+            cur.execute("DELETE FROM in_flight_waiting WHERE key=?", (key, ))
+            cur.execute("DELETE FROM in_flight WHERE key=?", (key, ))
+
+        return waiting
+
+    def evict(self, keep = None):
+        """Remove expired maps, then least recently used maps until the
+        cache fits in max_bytes"""
+        with sqlite3.connect(self.cache_file) as cache:
+            cur = cache.cursor()
+            cur.execute("SELECT key, path, size, created FROM results ORDER BY last_used")
+            rows = cur.fetchall()
+            total = sum(row[2] for row in rows)
+            expired = time.time() - self.ttl
+            for key, path, size, created in rows:
+                if key == keep:
+                    continue
+
+                if created >= expired and total <= self.max_bytes:
+                    continue
+
+                logging.info(f"Removing cached map {key}")
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+                total -= size
+                cur.execute("DELETE FROM results WHERE key=?", (key, ))
+
+            cache.commit()
@@ -0,0 +1,79 @@
+import json
+import logging
+import multiprocessing
+import threading
+
+from multiprocessing.connection import wait
+
+
+class SocketDispatcher:
+    """Forward generator status messages to their web sockets.
+
+    A single thread waits on every registered socket's status subscription
+    at once, and sends whatever arrives to the matching web socket. Sockets
+    are dropped (and their subscriptions closed) once unregistered, or once
+    sending to them fails.
+    """
+
+    def __init__(self):
+        self._sockets = {}  # socket_id -> (ws, subscription)
+        self._closed = set()
+        self._lock = threading.Lock()
+        self._wake_read, self._wake_write = multiprocessing.Pipe(duplex = False)
+
+        thread = threading.Thread(target = self._run, daemon = True)
+        thread.start()
+
+    def register(self, socket_id, ws, subscription):
+        with self._lock:
+            self._sockets[socket_id] = (ws, subscription)
+        self._wake()
+
+    def unregister(self, socket_id):
+        # Subscriptions are closed by the dispatcher thread, as it may be
+        # waiting on them
+        with self._lock:
+            self._closed.add(socket_id)
+        self._wake()
+
+    def _wake(self):
+        self._wake_write.send(None)
+
+    def _remove_closed(self):
+        with self._lock:
+            closed = self._closed
+            self._closed = set()
+            for socket_id in closed:
+                try:
+                    ws, subscription = self._sockets.pop(socket_id)
+                except KeyError:
+                    continue
+
+                subscription.close()
+                logging.info(f"Web socket {socket_id} removed from dispatcher")
+
+    def _run(self):
+        logging.info("Web socket dispatcher thread started")
+        while True:
+            self._remove_closed()
+            with self._lock:
+                pipes = {subscription: socket_id
+                         for socket_id, (ws, subscription)
+                         in self._sockets.items()}
+
+            for pipe in wait(list(pipes) + [self._wake_read]):
+                if pipe is self._wake_read:
+                    while self._wake_read.poll():
+                        self._wake_read.recv()
+                    continue
+
+                socket_id = pipes[pipe]
+                ws = self._sockets[socket_id][0]
+                try:
+                    message = pipe.recv()
+                    message = {'type': 'status',
+                               'content': message}
+                    ws.send(json.dumps(message))
+                except Exception:
+                    logging.info(f"Unable to send status to web socket {socket_id}")
+                    self.unregister(socket_id)
@@ -852,6 +852,14 @@ function updateBounds() {
 }
 
 var req_id = null;
+var mapComplete = false;
+
+function downloadMap() {
+    mapComplete = false;
+    url = `getMap?REQ_ID=${req_id}`;
+    window.location.href = url;
+    closeStatus(5000);
+}
 
 function updateStatus(payload) {
     if (typeof(payload) == 'object') {
@@ -860,9 +868,11 @@ function updateStatus(payload) {
     } else {
         var stat = payload;
         if (stat == "COMPLETE") {
-            url = `getMap?REQ_ID=${req_id}`;
-            window.location.href = url;
-            closeStatus(5000);
+            // Cached maps can complete before the request for them returns
+            if (req_id === null)
+                mapComplete = true;
+            else
+                downloadMap();
         } else if (stat == "ERROR") {
             alert("Unable to generate map. A server error occured");
             closeStatus();
@@ -985,8 +995,64 @@ function init_socket() {
     }
 }
 
-function runGetMap() {
+// Must match HASH_BLOCK_SIZE in upload_store.py
+const HASH_BLOCK_SIZE = 8 * 1024 * 1024;
+
+function toHex(buffer) {
+    return Array.from(new Uint8Array(buffer))
+        .map(function(b) { return b.toString(16).padStart(2, '0'); })
+        .join('');
+}
+
+// SHA-256 of the SHA-256 of each block of the file, so we never need the
+// whole (potentially huge) file in memory.
+async function hashFile(file) {
+    var digests = new Uint8Array(Math.ceil(file.size / HASH_BLOCK_SIZE) * 32);
+    for (var offset = 0, idx = 0; offset < file.size; offset += HASH_BLOCK_SIZE, idx++) {
+        var block = await file.slice(offset, offset + HASH_BLOCK_SIZE).arrayBuffer();
+        var digest = await crypto.subtle.digest('SHA-256', block);
+        digests.set(new Uint8Array(digest), idx * 32);
+    }
+    return toHex(await crypto.subtle.digest('SHA-256', digests));
+}
+
+// Resolves to the hash of the selected image if the server already has it,
+// otherwise null (in which case we upload it as normal).
+async function checkStoredImage() {
+    var imgInput = $('#imgFile')[0];
+    if (typeof(imgInput) === 'undefined' || imgInput.files.length == 0 ||
+        typeof(crypto.subtle) === 'undefined') {
+        return null;
+    }
+
+    try {
+        $('#downloadStatus').text("Checking image...");
+        var imgHash = await hashFile(imgInput.files[0]);
+        var resp = await $.getJSON('checkUpload', { hash: imgHash });
+        return resp['stored'] ? imgHash : null;
+    } catch (err) {
+        console.log("Unable to check for stored image", err);
+        return null;
+    }
+}
+
+async function runGetMap() {
+    var imgHash = await checkStoredImage();
+    postMapRequest(imgHash);
+}
+
+function postMapRequest(imgHash) {
     var formData = new FormData($('#setupForm')[0]);
+    var uploading = $('#imgFile').val() !== '';
+    if (imgHash) {
+        // Server already has this image. Send its hash instead.
+        formData.set('imgName', formData.get('imgFile').name);
+        formData.delete('imgFile');
+        formData.set('imgHash', imgHash);
+        uploading = false;
+        $('#downloadStatus').text("Requesting...");
+    }
+
     ajax_opts = {
         url: 'getMap',
         method: 'POST',
@@ -996,7 +1062,7 @@ function runGetMap() {
         cache: false,
     }
 
-    if ($('#imgFile').val() !== '') {
+    if (uploading) {
         ajax_opts['xhr'] = xhrFunc;
     }
 
@@ -1004,9 +1070,18 @@ function runGetMap() {
         .done(function(resp) {
             req_id = resp
             console.log(resp);
+            if (mapComplete) {
+                downloadMap();
+                return;
+            }
             checkDownloadStatus();
         })
         .fail(function(jqXHR, textStatus, errorThrown) {
+            if (imgHash && jqXHR.status == 409) {
+                // Stored image went away before we asked for it. Upload it.
+                postMapRequest(null);
+                return;
+            }
             alert(`Unable to request map. Server returned code ${jqXHR.status}, error: ${errorThrown}`);
             $('#downloading').hide();
         });
@@ -1774,6 +1849,13 @@ function parseDataHeaders() {
     }
 
     file = file[0];
+    const columns = $('#dataColumns').empty();
+    if (!/\.(csv|txt)$/i.test(file.name)) {
+        // Binary formats (Parquet, Feather, NetCDF). Column names are
+        // typed in, defaulting to latitude/longitude/value.
+        return;
+    }
+
     if (file.size > 1024) {
         //only read in the first 1KB of data at most to keep this fast
         file = file.slice(0, 1024);
@@ -1784,14 +1866,16 @@ function parseDataHeaders() {
         const data = $.csv.toArrays(reader.result);
         const header = data[0]
 
-        const latSel = $('#latCol').empty();
-        const lonSel = $('#lonCol').empty();
-        const valSel = $('#valCol').empty();
         for (var i = 0; i < header.length; i++) {
-            let option = `<option>${header[i]}</option>`;
-            latSel.append(option);
-            lonSel.append(option);
-            valSel.append(option);
+            columns.append($('<option>').val(header[i]));
+        }
+
+        // Keep the current column names where the file has them
+        for (const sel of ['#latCol', '#lonCol', '#valCol']) {
+            const input = $(sel);
+            if (!header.includes(input.val())) {
+                input.val(header[0]);
+            }
         }
     }
     reader.readAsBinaryString(file);
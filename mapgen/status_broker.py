@@ -0,0 +1,287 @@
+"""Local pub/sub broker routing generator status messages to web sockets.
+
+Generators publish status messages for a web socket ID, and whichever web
+server process holds that web socket subscribes to them. This means the
+process accepting a map request doesn't need to be the one holding the web
+socket, so the web tier can run more than one worker process.
+
+Messages for each subscriber are queued and sent by a thread of its own.
+A subscriber that falls STATUS_BROKER_QUEUE messages behind is dropped, so
+one stalled web server process can't hold up status for the others.
+
+The broker runs as its own process, listening on a unix socket. It is
+started on demand by the first process that fails to connect to it, or it
+can be run directly:
+
+    python mapgen/status_broker.py
+"""
+
+import errno
+import fcntl
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+from multiprocessing.connection import Client, Listener, wait
+
+try:
+    from . import config
+except ImportError:
+    import config
+
+
+def _broker_address():
+    address = getattr(config, 'STATUS_BROKER_ADDRESS', None)
+    if address is None:
+        script_dir = os.path.dirname(__file__)
+        cache_dir = os.path.join(script_dir, 'cache')
+        os.makedirs(cache_dir, exist_ok = True)
+        address = os.path.join(cache_dir, 'status_broker.sock')
+
+    return address
+
+
+def start_broker():
+    """Launch a broker process, detached from this one so it outlives it.
+    Does nothing (other than start a process that exits) if a broker is
+    already running."""
+    logging.info("Starting status broker")
+    subprocess.Popen([sys.executable, os.path.abspath(__file__)],
+                     stdin = subprocess.DEVNULL,
+                     start_new_session = True)
+
+
+def _connect(address = None, timeout = 10):
+    if address is None:
+        address = _broker_address()
+
+    started = False
+    deadline = time.time() + timeout
+    while True:
+        try:
+            return Client(address, family = 'AF_UNIX')
+        except (FileNotFoundError, ConnectionRefusedError):
+            if not started:
+                start_broker()
+                started = True
+            if time.time() > deadline:
+                raise
+            time.sleep(.1)
+
+
+def _send(conn, message):
+    # Messages are json rather than pickled, so the broker never has to
+    # unpickle anything.
+    conn.send_bytes(json.dumps(message).encode('UTF-8'))
+
+
+def _recv(conn):
+    return json.loads(conn.recv_bytes())
+
+
+class BrokerPipe:
+    """Send-only, pipe-like connection for publishing status messages to a
+    web socket through the broker. Can be pickled and sent to another
+    process, which will make its own connection to the broker."""
+
+    def __init__(self, socket_id, address = None):
+        self.socket_id = socket_id
+        self.address = address
+        self._conn = None
+
+    def __getstate__(self):
+        return {'socket_id': self.socket_id,
+                'address': self.address,
+                '_conn': None}
+
+    def send(self, status):
+        if self._conn is None:
+            self._conn = _connect(self.address)
+
+        _send(self._conn, {'socket': self.socket_id, 'status': status})
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+class BrokerSubscription:
+    """Receive the status messages published for a web socket. Can be
+    used with multiprocessing.connection.wait"""
+
+    def __init__(self, socket_id, address = None):
+        self.socket_id = socket_id
+        self._conn = _connect(address)
+        _send(self._conn, {'subscribe': socket_id})
+
+    def fileno(self):
+        return self._conn.fileno()
+
+    def recv(self):
+        return _recv(self._conn)
+
+    def close(self):
+        self._conn.close()
+
+
+class _Subscriber:
+    """Queue of status messages for a subscribed connection, sent by a
+    thread of its own, so a slow subscriber can't hold up routing for the
+    others"""
+
+    _STOP = object()
+
+    def __init__(self, conn, socket_id, max_queued):
+        self.conn = conn
+        self.socket_id = socket_id
+        self._queue = queue.Queue(maxsize = max_queued)
+        self._thread = threading.Thread(target = self._run, daemon = True)
+        self._thread.start()
+
+    def put(self, status):
+        """Queue status to be sent. Returns False if the queue is full."""
+        try:
+            self._queue.put_nowait(status)
+        except queue.Full:
+            return False
+
+        return True
+
+    def stop(self):
+        """Stop the sending thread, interrupting any send in progress. The
+        connection is left for the caller to close."""
+        try:
+            sock = socket.fromfd(self.conn.fileno(), socket.AF_UNIX, socket.SOCK_STREAM)
+            with sock:
+                sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+        try:
+            self._queue.put_nowait(self._STOP)
+        except queue.Full:
+            pass  # The shutdown will stop it at its next send
+
+        self._thread.join(timeout = 1)
+
+    def _run(self):
+        while True:
+            status = self._queue.get()
+            if status is self._STOP:
+                return
+
+            try:
+                _send(self.conn, status)
+            except OSError:
+                # Gone. The broker will see that when it next reads from it.
+                return
+
+
+class _Broker:
+    def __init__(self, address, max_queued = None):
+        if max_queued is None:
+            max_queued = getattr(config, 'STATUS_BROKER_QUEUE', 100)
+
+        self._address = address
+        self._max_queued = max_queued
+        self._conns = set()
+        self._subscribers = {}  # socket_id -> _Subscriber
+        self._subscribed = {}  # conn -> _Subscriber
+        self._lock = threading.Lock()
+        self._wake_read, self._wake_write = multiprocessing.Pipe(duplex = False)
+
+    def serve(self):
+        listener = Listener(self._address, family = 'AF_UNIX')
+        os.chmod(self._address, 0o660)
+        logging.info(f"Status broker listening on {self._address}")
+
+        thread = threading.Thread(target = self._route, daemon = True)
+        thread.start()
+
+        while True:
+            conn = listener.accept()
+            with self._lock:
+                self._conns.add(conn)
+            self._wake_write.send(None)
+
+    def _drop(self, conn):
+        self._conns.discard(conn)
+        subscriber = self._subscribed.pop(conn, None)
+        if subscriber is not None:
+            if self._subscribers.get(subscriber.socket_id) is subscriber:
+                del self._subscribers[subscriber.socket_id]
+            subscriber.stop()
+        conn.close()
+
+    def _route(self):
+        while True:
+            with self._lock:
+                conns = list(self._conns)
+
+            for conn in wait(conns + [self._wake_read]):
+                if conn is self._wake_read:
+                    while self._wake_read.poll():
+                        self._wake_read.recv()
+                    continue
+
+                try:
+                    message = _recv(conn)
+                except (EOFError, OSError, ValueError):
+                    with self._lock:
+                        self._drop(conn)
+                    continue
+
+                if 'subscribe' in message:
+                    if conn not in self._subscribed:
+                        subscriber = _Subscriber(conn, message['subscribe'],
+                                                 self._max_queued)
+                        self._subscribers[subscriber.socket_id] = subscriber
+                        self._subscribed[conn] = subscriber
+                    continue
+
+                subscriber = self._subscribers.get(message.get('socket'))
+                if subscriber is None:
+                    continue  # Web socket gone. Nobody to tell.
+
+                if not subscriber.put(message['status']):
+                    # Not keeping up. Drop it, rather than hold messages
+                    # (or the broker) up waiting for it.
+                    logging.warning(f"Dropping slow status subscriber {subscriber.socket_id}")
+                    with self._lock:
+                        self._drop(subscriber.conn)
+
+
+def run_broker(address = None):
+    if address is None:
+        address = _broker_address()
+
+    # Only one broker may run at once. Holding the lock also means any
+    # existing socket file is stale, and safe to remove.
+    lock_file = open(f"{address}.lock", 'w')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError as err:
+        if err.errno in (errno.EAGAIN, errno.EACCES):
+            logging.info("Status broker already running")
+            return
+        raise
+
+    try:
+        os.remove(address)
+    except FileNotFoundError:
+        pass
+
+    _Broker(address).serve()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level = logging.INFO)
+    run_broker()
@@ -9,30 +9,92 @@ from pathlib import Path
 import flask
 
 from streaming_form_data.targets import BaseTarget, DirectoryTarget
+from streaming_form_data.validators import MaxSizeValidator, ValidationError
 from streaming_form_data import StreamingFormDataParser
 
+try:
+    from .upload_store import ContentHash
+except ImportError:
+    from upload_store import ContentHash
 
-def api_input(schema, **kwargs):
+
+class UploadTooLarge(Exception):
+    """The request body, or one of its fields, is larger than allowed"""
+
+
+def api_input(schema, upload_dir = None):
+    """
+    Parse the request form data using schema, passing the resulting values
+    to the decorated view.
+
+    Parameters
+    ----------
+    schema : BaseSchema subclass
+    upload_dir : callable, optional
+        Returns the directory uploaded files should be saved in. This
+        directory is passed to the view as a second argument, and is left
+        for the view to clean up. By default files are saved in a temporary
+        directory that is removed once the view returns.
+    """
     def decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
-            with tempfile.TemporaryDirectory() as tempdir:
-                try:
-                    data = _parseFormData(schema, flask.request, tempdir)
-                except ValueError as e:
-                    return flask.abort(400, "Missing Parameter:" + str(e))
-                result = f(data)
-            return result
+            if upload_dir is None:
+                with tempfile.TemporaryDirectory() as tempdir:
+                    data = _parse_request(schema, tempdir)
+                    result = f(data)
+                return result
+
+            file_dir = upload_dir()
+            try:
+                data = _parse_request(schema, file_dir)
+            except Exception:
+                shutil.rmtree(file_dir, ignore_errors = True)
+                raise
+
+            return f(data, file_dir)
         return wrapper
     return decorator
 
 
+def _parse_request(schema, file_dir):
+    try:
+        return _parseFormData(schema, flask.request, file_dir)
+    except UploadTooLarge as e:
+        flask.abort(413, str(e))
+    except ValueError as e:
+        flask.abort(400, "Missing Parameter:" + str(e))
+
+
+class _FieldSizeValidator(MaxSizeValidator):
+    def __init__(self, field, max_size):
+        super().__init__(max_size)
+        self.field = field
+
+    def __call__(self, chunk):
+        try:
+            super().__call__(chunk)
+        except ValidationError:
+            raise UploadTooLarge(f"{self.field} is larger than {self.max_size} bytes")
+
+
 class BaseSchema:
-    """Base class from which request parse schemas should inherit"""
+    """Base class from which request parse schemas should inherit.
+
+    Individual fields may be limited in size by passing max_size (in bytes)
+    when declaring them. Fields other than files, which are held in memory,
+    are limited to max_value_size bytes by default.
+    """
     targets = None,
     defaults = None,
     _parser = None
 
+    # Size of the chunks read from the request body
+    chunk_size = 64 * 1024
+    # Maximum size of the request body, in bytes. None for no limit.
+    max_size = None
+    max_value_size = 16 * 1024 * 1024
+
     def __init__(self, parser, temp_dir = None):
         self.targets = {}
         self.defaults = {}
@@ -45,15 +107,32 @@ class BaseSchema:
             if hasattr(generator, 'default'):
                 self.defaults[field] = generator.default
 
-            self.targets[field] = generator.target()
+            max_size = getattr(generator, 'max_size', None)
+            if max_size is None and not isinstance(generator, File):
+                max_size = self.max_value_size
+
+            validator = None
+            if max_size is not None:
+                validator = _FieldSizeValidator(field, max_size)
+
+            self.targets[field] = generator.target(validator = validator)
             parser.register(field, self.targets[field])
 
-    def parse(self, data):
-        # chunk_size = 32768  # 32k
+    def parse(self, data, content_length = None):
+        # Don't bother reading anything if we already know it is too big
+        if self.max_size is not None and (content_length or 0) > self.max_size:
+            raise UploadTooLarge(f"Request is larger than {self.max_size} bytes")
+
+        received = 0
         while True:
-            chunk = data.read()
+            chunk = data.read(self.chunk_size)
             if len(chunk) == 0:
                 break
+
+            received += len(chunk)
+            if self.max_size is not None and received > self.max_size:
+                raise UploadTooLarge(f"Request is larger than {self.max_size} bytes")
+
             self._parser.data_received(chunk)
             time.sleep(0)
 
@@ -77,26 +156,36 @@ def _parseFormData(Schema, request, file_dir):
     headers = dict(request.headers)
     parser = StreamingFormDataParser(headers = headers)
     schema = Schema(parser, file_dir)  # materialize an instance of this schema
-    schema.parse(request.stream)
+    schema.parse(request.stream, request.content_length)
     return schema.values()
 
 
 class _fileResult:
-    def __init__(self, filename, filedir):
+    def __init__(self, filename, filedir, hash = None, size = 0):
         self._filename = filename
         self._filedir = filedir
+        self.hash = hash
+        self.size = size
 
     @property
     def name(self):
         return self._filename
 
+    @property
+    def path(self):
+        return os.path.join(self._filedir, self._filename)
+
     def save(self, dest):
-        src_file = os.path.join(self._filedir, self._filename)
+        src_file = self.path
         dst_file = os.path.join(dest, self._filename)
-        shutil.move(src_file, dst_file)
+        if os.path.abspath(src_file) != os.path.abspath(dst_file):
+            shutil.move(src_file, dst_file)
+            self._filedir = dest
 
 
 class _FileTarget(DirectoryTarget):
+    """Save an uploaded file to disk, hashing it as it streams in"""
+
     def __init__(
         self,
         directory_path: str = None,
@@ -113,6 +202,8 @@ class _FileTarget(DirectoryTarget):
 
         self._mode = 'wb' if allow_overwrite else 'xb'
         self._fd = None
+        self._hash = ContentHash()
+        self._size = 0
         self.multipart_filenames: List[str] = []
         self.multipart_content_types: List[str] = []
 
@@ -132,9 +223,16 @@ class _FileTarget(DirectoryTarget):
             Path(self.directory_path) / self.multipart_filename, self._mode
         )
 
+    def on_data_received(self, chunk: bytes):
+        super().on_data_received(chunk)
+        if self._fd:
+            self._hash.update(chunk)
+            self._size += len(chunk)
+
     @property
     def value(self):
-        return _fileResult(self.multipart_filename, self.directory_path)
+        return _fileResult(self.multipart_filename, self.directory_path,
+                           self._hash.hexdigest(), self._size)
 
     @property
     def finished(self):
@@ -228,9 +326,9 @@ class _TargetGenerator:
         for key, value in kwargs.items():
             setattr(self, key, value)
 
-    def target(self, *args):
+    def target(self, *args, **kwargs):
         args = self._adtl_args + list(args)
-        res = self._target(*args)
+        res = self._target(*args, **kwargs)
         return res
 
 
@@ -241,9 +339,9 @@ class File(_TargetGenerator):
     def set_directory(self, dest):
         self._file_dir = dest
 
-    def target(self, *args):
+    def target(self, *args, **kwargs):
         args = [self._file_dir] + self._adtl_args + list(args)
-        res = self._target(*args)
+        res = self._target(*args, **kwargs)
         return res
 
 
@@ -0,0 +1,329 @@
+import logging
+import os
+import sqlite3
+import time
+import uuid
+
+import numpy
+import osgeo.gdal
+
+from shapely import wkt
+from shapely.affinity import translate
+from shapely.geometry import Polygon, box
+from shapely.ops import unary_union
+
+try:
+    from . import config
+except ImportError:
+    import config
+
+try:
+    from . import utils
+except ImportError:
+    import utils
+
+
+WORLD = box(-180, -90, 180, 90)
+
+
+def raster_footprint(path):
+    """Get the lon/lat footprint of a raster (such as a tile) from its header.
+
+    The footprint is split at the dateline so it can be compared directly
+    against the (already split) request polygons.
+    """
+    ds = osgeo.gdal.Open(path)
+    corners = utils.get_corners(ds)
+    del ds
+
+    # Make longitudes continuous if the tile crosses the dateline
+    lons = [x for x, y in corners]
+    if max(lons) - min(lons) > 180:
+        corners = [(x - 360 if x > 0 else x, y) for x, y in corners]
+
+    poly = Polygon(corners)
+    footprint = unary_union([poly, translate(poly, 360), translate(poly, -360)])
+    return footprint.intersection(WORLD)
+
+
+def overlapping_tiles(footprints, polys, min_width = 0, min_height = 0):
+    """Names of the tiles in footprints (name -> lon/lat geometry) whose
+    bounding box overlaps one of polys by more than min_width by min_height
+    degrees, in their original order.
+
+    Footprints split at the dateline are checked one part at a time.
+    """
+    names = []
+    parts = []
+    for name, footprint in footprints.items():
+        for part in getattr(footprint, 'geoms', [footprint]):
+            names.append(name)
+            parts.append(part.bounds)
+
+    if not parts:
+        return []
+
+    parts = numpy.array(parts)
+    keep = numpy.zeros(len(parts), dtype = bool)
+    for poly in polys:
+        minx, miny, maxx, maxy = poly.bounds
+        width = numpy.minimum(parts[:, 2], maxx) - numpy.maximum(parts[:, 0], minx)
+        height = numpy.minimum(parts[:, 3], maxy) - numpy.maximum(parts[:, 1], miny)
+        keep |= (width > min_width) & (height > min_height)
+
+    kept = {names[idx] for idx in numpy.flatnonzero(keep)}
+    return [name for name in footprints if name in kept]
+
+
+class TileCache:
+    """On-disk, size-bounded cache of hillshade tiles downloaded from
+    elevation.alaska.gov, keyed by dataset and tile name.
+
+    Tiles are never extracted. They stay in the zip archives they were
+    downloaded in, and are read in place by GDAL using /vsizip/ paths.
+
+    Along with the tiles themselves we remember the footprint of each tile,
+    and which areas have already been queried from the server, so that we can
+    tell if a request is fully covered before making any network calls.
+    Areas that were queried but returned no tiles (open ocean, for example)
+    are covered as long as all the tiles from that query are still cached.
+
+    Archives are evicted least-recently-used first (along with all their
+    tiles) once the total size of the cache grows past `max_bytes`.
+    """
+
+    # Don't evict tiles that may still be in use by a running generator
+    MIN_AGE = 600
+
+    # Bump when the index tables change, and add any migration to _migrate.
+    # Indexes too old to migrate (and their tiles) are discarded.
+    SCHEMA_VERSION = 3
+
+    def __init__(self, cache_dir = None, max_bytes = None):
+        if cache_dir is None:
+            cache_dir = getattr(config, 'TILE_CACHE_DIR', None)
+        if cache_dir is None:
+            script_dir = os.path.dirname(__file__)
+            cache_dir = os.path.join(script_dir, 'cache', 'tiles')
+
+        if max_bytes is None:
+            max_bytes = getattr(config, 'TILE_CACHE_SIZE', 10 * 1024 ** 3)
+
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok = True)
+        self.cache_file = os.path.join(cache_dir, "tile_index")
+        with sqlite3.connect(self.cache_file) as cache:
+            cur = cache.cursor()
+            cur.execute("PRAGMA user_version")
+            version = cur.fetchone()[0]
+            if version < 2:
+                self._discard_index(cur)
+            elif version < self.SCHEMA_VERSION:
+                self._migrate(cur, version)
+
+            # Footprint bounding boxes are kept alongside the footprints, so
+            # lookups only need to load the footprints of nearby tiles.
+            cur.execute("""CREATE TABLE IF NOT EXISTS tiles(
+                dataset, name, path, archive, last_used, footprint,
+                minx, miny, maxx, maxy,
+                UNIQUE(dataset, name))""")
+            cur.execute("""CREATE INDEX IF NOT EXISTS tile_bounds
+                ON tiles(dataset, minx, maxx)""")
+            cur.execute("""CREATE TABLE IF NOT EXISTS archives(
+                path, size, UNIQUE(path))""")
+            cur.execute("""CREATE TABLE IF NOT EXISTS queries(
+                id INTEGER PRIMARY KEY, dataset, footprint)""")
+            cur.execute("""CREATE TABLE IF NOT EXISTS query_tiles(
+                query_id, name)""")
+            cur.execute(f"PRAGMA user_version={self.SCHEMA_VERSION}")
+
+    def _discard_index(self, cur):
+        cur.execute("SELECT name FROM sqlite_master WHERE type='table'")
+        tables = [row[0] for row in cur.fetchall()]
+        if 'tiles' in tables:
+            logging.info("Discarding old hillshade tile cache")
+            # Version 1 tiles were extracted files
+            cur.execute("SELECT path FROM tiles")
+            for path, in cur.fetchall():
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+        for table in tables:
+            cur.execute(f"DROP TABLE {table}")
+
+    def _migrate(self, cur, version):
+        if version < 3:
+            logging.info("Adding footprint bounds to hillshade tile cache")
+            for column in ('minx', 'miny', 'maxx', 'maxy'):
+                cur.execute(f"ALTER TABLE tiles ADD COLUMN {column}")
+            cur.execute("SELECT rowid, footprint FROM tiles")
+            cur.executemany("""UPDATE tiles SET minx=?, miny=?, maxx=?, maxy=?
+                            WHERE rowid=?""",
+                            [(*wkt.loads(footprint).bounds, rowid)
+                             for rowid, footprint in cur.fetchall()])
+
+    def tile_dir(self, dataset):
+        path = os.path.join(self.cache_dir, str(dataset))
+        os.makedirs(path, exist_ok = True)
+        return path
+
+    def archive_path(self, dataset):
+        """A new, unique path in the cache to save an archive to"""
+        return os.path.abspath(os.path.join(self.tile_dir(dataset),
+                                            f"{uuid.uuid4().hex}.zip"))
+
+    def __contains__(self, key):
+        dataset, name = key
+        with sqlite3.connect(self.cache_file) as cache:
+            cur = cache.cursor()
+            cur.execute("SELECT archive FROM tiles WHERE dataset=? AND name=?",
+                        (dataset, name))
+            row = cur.fetchone()
+
+        return row is not None and os.path.isfile(row[0])
+
+    def lookup(self, dataset, poly):
+        """Find the cached tiles intersecting poly.
+
+        Returns
+        -------
+        tiles : dict
+            Tile name -> path for all cached tiles touching poly
+        missing : shapely geometry
+            The part of poly not covered by the cache. Empty if no
+            download is needed.
+        """
+        tiles = {}
+        coverage = []
+        with sqlite3.connect(self.cache_file) as cache:
+            cur = cache.cursor()
+            minx, miny, maxx, maxy = poly.bounds
+            cur.execute("""SELECT name, path, archive, footprint FROM tiles
+                        WHERE dataset=? AND minx<=? AND maxx>=?
+                        AND miny<=? AND maxy>=?""",
+                        (dataset, maxx, minx, maxy, miny))
+            for name, path, archive, footprint in cur:
+                footprint = wkt.loads(footprint)
+                if not footprint.intersects(poly) or not os.path.isfile(archive):
+                    continue
+
+                tiles[name] = path
+                coverage.append(footprint)
+
+            cur.execute("SELECT footprint FROM queries WHERE dataset=?",
+                        (dataset, ))
+            for footprint, in cur:
+                footprint = wkt.loads(footprint)
+                if footprint.intersects(poly):
+                    coverage.append(footprint)
+
+        missing = poly.difference(unary_union(coverage))
+        # Ignore slivers from floating point differences along tile edges
+        if missing.area <= poly.area * 1e-4:
+            missing = Polygon()
+
+        self.touch(dataset, tiles.keys())
+        return tiles, missing
+
+    def touch(self, dataset, names):
+        now = time.time()
+        with sqlite3.connect(self.cache_file) as cache:
+            cur = cache.cursor()
+            cur.executemany("UPDATE tiles SET last_used=? WHERE dataset=? AND name=?",
+                            [(now, dataset, name) for name in names])
+            cache.commit()
+
+    def add_archive(self, archive):
+        """Add an archive saved to archive_path(), holding tiles to add()"""
+        with sqlite3.connect(self.cache_file) as cache:
+            cur = cache.cursor()
+            cur.execute("INSERT OR REPLACE INTO archives (path, size) VALUES (?,?)",
+                        (archive, os.path.getsize(archive)))
+            cache.commit()
+
+    def add(self, dataset, name, path, archive):
+        """Add a tile, read by GDAL from path (a /vsizip/ path within archive)"""
+        footprint = raster_footprint(path)
+        with sqlite3.connect(self.cache_file) as cache:
+            cur = cache.cursor()
+            cur.execute("""INSERT OR REPLACE INTO tiles
+                        (dataset, name, path, archive, last_used, footprint,
+                         minx, miny, maxx, maxy)
+                        VALUES (?,?,?,?,?,?,?,?,?,?)""",
+                        (dataset, name, path, archive, time.time(), footprint.wkt,
+                         *footprint.bounds))
+            cache.commit()
+
+        return path
+
+    def footprints(self, dataset, names):
+        """Tile name -> lon/lat footprint, for the named tiles"""
+        footprints = {}
+        with sqlite3.connect(self.cache_file) as cache:
+            cur = cache.cursor()
+            cur.execute("SELECT name, footprint FROM tiles WHERE dataset=?",
+                        (dataset, ))
+            names = set(names)
+            for name, footprint in cur:
+                if name in names:
+                    footprints[name] = wkt.loads(footprint)
+
+        return footprints
+
+    def add_query(self, dataset, poly, names):
+        """Record that poly has been queried, returning the tiles in names"""
+        with sqlite3.connect(self.cache_file) as cache:
+            cur = cache.cursor()
+            cur.execute("INSERT INTO queries (dataset, footprint) VALUES (?,?)",
+                        (dataset, poly.wkt))
+            query_id = cur.lastrowid
+            cur.executemany("INSERT INTO query_tiles (query_id, name) VALUES (?,?)",
+                            [(query_id, name) for name in names])
+            cache.commit()
+
+    def evict(self):
+        """Remove least recently used archives, and their tiles, until the
+        cache fits in max_bytes"""
+        with sqlite3.connect(self.cache_file) as cache:
+            cur = cache.cursor()
+            cur.execute("SELECT SUM(size) FROM archives")
+            total = cur.fetchone()[0] or 0
+            if total <= self.max_bytes:
+                return
+
+            # Archives whose tiles have all been replaced by newer downloads
+            # have no last used time, and go first.
+            cutoff = time.time() - self.MIN_AGE
+            cur.execute("""SELECT archives.path, archives.size,
+                        MAX(tiles.last_used) AS used FROM archives
+                        LEFT JOIN tiles ON tiles.archive=archives.path
+                        GROUP BY archives.path
+                        HAVING used IS NULL OR used<?
+                        ORDER BY COALESCE(used, 0)""", (cutoff, ))
+            for archive, size, used in cur.fetchall():
+                if total <= self.max_bytes:
+                    break
+
+                logging.info(f"Evicting hillshade archive {archive} from cache")
+                try:
+                    os.remove(archive)
+                except FileNotFoundError:
+                    pass
+
+                total -= size
+                # Any area queried that returned these tiles is no longer covered
+                cur.execute("""DELETE FROM queries WHERE EXISTS
+                            (SELECT 1 FROM query_tiles JOIN tiles
+                             ON tiles.name=query_tiles.name
+                             AND tiles.dataset=queries.dataset
+                             WHERE query_tiles.query_id=queries.id
+                             AND tiles.archive=?)""", (archive, ))
+                cur.execute("""DELETE FROM query_tiles WHERE query_id NOT IN
+                            (SELECT id FROM queries)""")
+                cur.execute("DELETE FROM tiles WHERE archive=?", (archive, ))
+                cur.execute("DELETE FROM archives WHERE path=?", (archive, ))
+
+            cache.commit()
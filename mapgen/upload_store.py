@@ -0,0 +1,188 @@
+"""Content-addressed store of uploaded rasters.
+
+Users often upload the same (large) image again and again for different
+maps. Uploads are kept here by content hash, along with their EPSG:4326
+warped version, so a repeat upload can be skipped entirely (the client
+asks first, using the same hash), and doesn't need re-warping.
+"""
+
+import hashlib
+import logging
+import os
+import re
+import shutil
+import sqlite3
+import time
+import uuid
+
+try:
+    from . import config
+except ImportError:
+    import config
+
+
+# Block size for ContentHash. Must match the client side hashing in main.js
+HASH_BLOCK_SIZE = 8 * 1024 * 1024
+
+_HASH_RE = re.compile('^[0-9a-f]{64}$')
+
+
+class ContentHash:
+    """SHA-256 of the SHA-256 digests of each HASH_BLOCK_SIZE block of a
+    file. Browsers can compute this a block at a time with SubtleCrypto,
+    rather than reading the entire file into memory."""
+
+    def __init__(self):
+        self._digest = hashlib.sha256()
+        self._block = hashlib.sha256()
+        self._block_size = 0
+
+    def update(self, data):
+        data = memoryview(data)
+        while data:
+            count = min(len(data), HASH_BLOCK_SIZE - self._block_size)
+            self._block.update(data[:count])
+            self._block_size += count
+            data = data[count:]
+            if self._block_size == HASH_BLOCK_SIZE:
+                self._digest.update(self._block.digest())
+                self._block = hashlib.sha256()
+                self._block_size = 0
+
+    def hexdigest(self):
+        digest = self._digest.copy()
+        if self._block_size:
+            digest.update(self._block.digest())
+
+        return digest.hexdigest()
+
+
+def valid_hash(value):
+    return bool(value) and _HASH_RE.match(value) is not None
+
+
+def _link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+class UploadStore:
+    """On-disk, size-bounded store of uploaded rasters keyed by content hash,
+    and of their processed (warped to EPSG:4326) versions, keyed by
+    processed_key.
+
+    Files are handed out as hard links (or copies) in the caller's directory,
+    so they stay usable even if evicted from the store. Least recently used
+    files are evicted first once the store grows past `max_bytes`.
+    """
+
+    # Don't evict files that were only just checked, and may be about to be
+    # requested without being uploaded.
+    MIN_AGE = 600
+
+    def __init__(self, store_dir = None, max_bytes = None):
+        if store_dir is None:
+            store_dir = getattr(config, 'UPLOAD_STORE_DIR', None)
+        if store_dir is None:
+            script_dir = os.path.dirname(__file__)
+            store_dir = os.path.join(script_dir, 'cache', 'uploads')
+
+        if max_bytes is None:
+            max_bytes = getattr(config, 'UPLOAD_STORE_SIZE', 20 * 1024 ** 3)
+
+        self.store_dir = store_dir
+        self.max_bytes = max_bytes
+        os.makedirs(store_dir, exist_ok = True)
+        self.cache_file = os.path.join(store_dir, "upload_index")
+        with sqlite3.connect(self.cache_file) as cache:
+            cur = cache.cursor()
+            cur.execute("""CREATE TABLE IF NOT EXISTS files(
+                key, path, size, last_used, UNIQUE(key))""")
+
+    @staticmethod
+    def processed_key(upload_hash, world_hash = None, proj = None):
+        """Key for the processed version of an upload. Image/world file
+        uploads depend on the world file and projection as well."""
+        key = f"{upload_hash}|{world_hash or ''}|{proj or ''}"
+        return 'processed-' + hashlib.sha256(key.encode('UTF-8')).hexdigest()
+
+    def __contains__(self, key):
+        return self._lookup(key, touch = True) is not None
+
+    def _lookup(self, key, touch = False):
+        with sqlite3.connect(self.cache_file) as cache:
+            cur = cache.cursor()
+            cur.execute("SELECT path FROM files WHERE key=?", (key, ))
+            row = cur.fetchone()
+            if row is None or not os.path.isfile(row[0]):
+                return None
+
+            if touch:
+                cur.execute("UPDATE files SET last_used=? WHERE key=?",
+                            (time.time(), key))
+                cache.commit()
+
+        return row[0]
+
+    def checkout(self, key, dest):
+        """Link the stored file for key to dest. Returns dest, or None if
+        the file isn't in the store."""
+        path = self._lookup(key, touch = True)
+        if path is None:
+            return None
+
+        try:
+            _link_or_copy(path, dest)
+        except FileNotFoundError:
+            return None  # Evicted out from under us
+
+        return dest
+
+    def add(self, key, path):
+        """Add a copy of the file at path to the store, under key"""
+        if self._lookup(key, touch = True) is not None:
+            return
+
+        ext = os.path.splitext(path)[1]
+        stored = os.path.join(self.store_dir, f"{key}{ext}")
+        tmp_path = f"{stored}.{uuid.uuid4().hex}"
+        _link_or_copy(path, tmp_path)
+        os.replace(tmp_path, stored)
+
+        with sqlite3.connect(self.cache_file) as cache:
+            cur = cache.cursor()
+            cur.execute("""INSERT OR REPLACE INTO files
+                        (key, path, size, last_used) VALUES (?,?,?,?)""",
+                        (key, stored, os.path.getsize(stored), time.time()))
+            cache.commit()
+
+        self.evict()
+
+    def evict(self):
+        """Remove least recently used files until the store fits in max_bytes"""
+        with sqlite3.connect(self.cache_file) as cache:
+            cur = cache.cursor()
+            cur.execute("SELECT SUM(size) FROM files")
+            total = cur.fetchone()[0] or 0
+            if total <= self.max_bytes:
+                return
+
+            cutoff = time.time() - self.MIN_AGE
+            cur.execute("""SELECT key, path, size FROM files
+                        WHERE last_used<? ORDER BY last_used""", (cutoff, ))
+            for key, path, size in cur.fetchall():
+                if total <= self.max_bytes:
+                    break
+
+                logging.info(f"Removing stored upload {key}")
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+                total -= size
+                cur.execute("DELETE FROM files WHERE key=?", (key, ))
+
+            cache.commit()
@@ -1,7 +1,17 @@
+import logging
+import queue
+import threading
+import time
+
+import numpy
 import pymysql
 
 from osgeo import osr
-from . import config
+
+try:
+    from . import config
+except ImportError:
+    import config
 
 
 def format_size(num, suffix = "B"):
@@ -13,22 +23,74 @@ def format_size(num, suffix = "B"):
     return f"{num:.1f}Yi{suffix}"
 
 
+class _ConnectionPool:
+    """Bounded pool of open database connections"""
+
+    def __init__(self, max_size, **connect_args):
+        self._connect_args = connect_args
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(max_size)
+
+    def get(self, timeout = None):
+        if not self._slots.acquire(timeout = timeout):
+            raise TimeoutError("No database connection available")
+
+        try:
+            connection = self._idle.get_nowait()
+        except queue.Empty:
+            connection = None
+
+        try:
+            if connection is not None:
+                connection.ping(reconnect = True)
+            else:
+                connection = pymysql.connect(**self._connect_args)
+        except Exception:
+            self._slots.release()
+            raise
+
+        return connection
+
+    def put(self, connection, discard = False):
+        if discard:
+            try:
+                connection.close()
+            except Exception:
+                pass
+        else:
+            self._idle.put(connection)
+
+        self._slots.release()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def _get_pool(**connect_args):
+    key = tuple(sorted(connect_args.items()))
+    with _pools_lock:
+        if key not in _pools:
+            max_size = getattr(config, 'DB_POOL_SIZE', 5)
+            _pools[key] = _ConnectionPool(max_size, **connect_args)
+
+        return _pools[key]
+
+
 class MySQLCursor:
-    """Context manager to connect to a MySQL database and get a cursor,
-    opionally using a cursor factory specified."""
+    """Context manager to get a cursor from a pooled MySQL database
+    connection, opionally using a cursor factory specified."""
 
     def __init__(self, database=config.DB_NAME, host = config.DB_HOST,
                  user = config.DB_USER, password = config.DB_PASSWORD, cursor_factory=None):
-        self._database = database
-        self._host = host
-        self._user = user
-        self._password = password
+        self._pool = _get_pool(host = host, user = user, password = password,
+                               database = database,
+                               connect_timeout = getattr(config, 'DB_CONNECT_TIMEOUT', 5))
         self._factory = cursor_factory
         self._connection = None
 
     def __enter__(self):
-        self._connection = pymysql.connect(host=self._host, user=self._user,
-                                           password=self._password, database=self._database)
+        self._connection = self._pool.get(timeout = getattr(config, 'DB_CONNECT_TIMEOUT', 5))
 
         if self._factory:
             cursor = self._connection.cursor(self._factory)
@@ -38,11 +100,72 @@ class MySQLCursor:
         return cursor
 
     def __exit__(self, exit_type, value, traceback):
-        self._connection.rollback()
-        self._connection.close()
+        # Don't reuse a connection that may be in a bad state
+        discard = isinstance(value, pymysql.MySQLError)
+        try:
+            self._connection.rollback()
+        except Exception:
+            discard = True
+
+        self._pool.put(self._connection, discard)
+        self._connection = None
 
 
-def get_extents(src, proj=None):
+class RefreshingCache:
+    """Cache a single, slowly changing value, such as the result of a
+    database query.
+
+    Once the value is more than `ttl` seconds old, it is refreshed in a
+    background thread while the old value continues to be returned. If
+    `loader` fails, the old value is kept. The first call waits up to
+    `timeout` seconds for a value, returning `default` if there isn't one.
+    """
+
+    def __init__(self, loader, ttl, default = None, timeout = 5):
+        self._loader = loader
+        self._ttl = ttl
+        self._timeout = timeout
+        self._value = default
+        self._loaded = 0
+        self._ready = threading.Event()
+        self._lock = threading.Lock()
+        self._refreshing = False
+
+    def _refresh(self):
+        try:
+            value = self._loader()
+        except Exception:
+            logging.exception("Unable to refresh cached value")
+        else:
+            self._value = value
+            self._loaded = time.time()
+        finally:
+            self._refreshing = False
+            self._ready.set()
+
+    def get(self):
+        with self._lock:
+            if not self._refreshing and time.time() - self._loaded > self._ttl:
+                self._refreshing = True
+                threading.Thread(target = self._refresh, daemon = True).start()
+
+        self._ready.wait(self._timeout)
+        return self._value
+
+
+def lon_in_bounds(lons, west, east):
+    """Boolean mask of the longitudes in lons (any range) that are between
+    west and east, which may run past +/-180 to cross the dateline"""
+    span = east - west
+    if span >= 360:
+        return numpy.ones(len(lons), dtype = bool)
+
+    return (numpy.asarray(lons) - west) % 360 <= span
+
+
+def get_corners(src, proj=None):
+    """Return the lon/lat of the top-left, top-right, bottom-right and
+    bottom-left corners of a GDAL dataset"""
     ulx, xres, xskew, uly, yskew, yres = src.GetGeoTransform()
     lrx = ulx + (src.RasterXSize * xres)
     lry = uly + (src.RasterYSize * yres)
@@ -60,12 +183,16 @@ def get_extents(src, proj=None):
     transform = osr.CoordinateTransformation(src_srs, tgt_srs)
     # top-left, top-right,bottom-right,bottom-left
     corners = ((ulx, uly), (lrx, uly), (lrx, lry), (ulx, lry))
-    trans_corners = transform.TransformPoints(corners)
+    return [(x, y) for x, y, _ in transform.TransformPoints(corners)]
+
+
+def get_extents(src, proj=None):
+    trans_corners = get_corners(src, proj)
 
-    ulx, uly, _ = trans_corners[0]
-    urx, ury, _ = trans_corners[1]
-    lrx, lry, _ = trans_corners[2]
-    llx, lly, _ = trans_corners[3]
+    ulx, uly = trans_corners[0]
+    urx, ury = trans_corners[1]
+    lrx, lry = trans_corners[2]
+    llx, lly = trans_corners[3]
 
     # figure out which X is to the left.
     # Make both upper and lower coordinates
@@ -0,0 +1,370 @@
+import contextlib
+import logging
+import multiprocessing
+import os
+import pickle
+import resource
+import shutil
+import sqlite3
+import threading
+import time
+import traceback
+
+try:
+    from . import config
+except ImportError:
+    import config
+
+try:
+    from . import _global_session
+except ImportError:
+    from file_cache import FileCache
+    _global_session = FileCache()
+
+
+def _warm_up():
+    """Import the heavy libraries and start a GMT session so the first map
+    generated by this worker doesn't have to wait for it."""
+    import osgeo.gdal
+    import pandas
+    import shapely
+    import xarray
+
+    try:
+        import pygmt
+    except Exception:
+        os.environ['GMT_LIBRARY_PATH'] = '/usr/local/lib'
+        import pygmt
+
+    from . import mapgenerator
+
+    fig = pygmt.Figure()
+    fig.basemap(region = [0, 1, 0, 1], projection = "X1c", frame = False)
+
+
+def _rss():
+    """Current resident set size of this process, in bytes"""
+    try:
+        with open('/proc/self/statm') as statm:
+            pages = int(statm.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        # Peak, rather than current, but better than nothing
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _worker_main(conn, max_jobs, max_rss):
+    try:
+        _warm_up()
+    except Exception:
+        logging.exception("Unable to warm up generator worker")
+
+    conn.send('READY')
+
+    jobs = 0
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            return
+
+        if job is None:
+            return
+
+        generator, status_pipe, req_id = job
+        try:
+            generator.generate(status_pipe, req_id)
+        except Exception:
+            traceback.print_exc()
+        finally:
+            status_pipe.close()
+
+        jobs += 1
+        recycle = (max_jobs and jobs >= max_jobs) or (max_rss and _rss() > max_rss)
+        if recycle:
+            logging.info(f"Recycling generator worker {os.getpid()} after {jobs} jobs")
+            conn.send('RECYCLE')
+            return
+
+        conn.send('DONE')
+
+
+class JobScheduler:
+    """Priority queue of map generation jobs, shared by every web server
+    process, with a limit on how many can run at once across all of them.
+
+    Jobs are kept (pickled) in a sqlite table, so whichever process has a
+    generator worker free first starts the next job, whichever process
+    queued it. Jobs with a lower priority value are started first, in the
+    order they were submitted. So that expensive jobs can't be starved by a
+    stream of cheap ones, any job that has been waiting longer than
+    `max_wait` seconds is treated as top priority.
+
+    `notify(job, position)` is called whenever a waiting job's position in
+    the queue changes. `lost(job)` is called for jobs that were running in a
+    process that has since died.
+    """
+
+    # Seconds between checks for jobs queued by other processes
+    poll_interval = 0.5
+
+    def __init__(self, max_running, max_wait = None, notify = None, lost = None,
+                 db_file = None):
+        if max_wait is None:
+            max_wait = getattr(config, 'SCHEDULER_MAX_WAIT', 120)
+        if db_file is None:
+            db_file = _global_session.cache_file
+
+        self._max_running = max_running
+        self._max_wait = max_wait
+        self._notify = notify
+        self._lost = lost
+        self._db_file = db_file
+        self._cond = threading.Condition()
+
+        with self._transaction() as db:
+            db.execute("""CREATE TABLE IF NOT EXISTS jobs(
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                job, priority, queued, running_pid, position)""")
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        # Immediate, so only one process at a time can be deciding what to
+        # run next
+        db = sqlite3.connect(self._db_file, timeout = 30, isolation_level = None)
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                yield db
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+            db.execute("COMMIT")
+        finally:
+            db.close()
+
+    def _update_positions(self, db):
+        """Store the position of each waiting job, returning (job,
+        position) for those that changed"""
+        rows = db.execute("""SELECT id, job, position FROM jobs
+                          WHERE running_pid IS NULL
+                          ORDER BY CASE WHEN queued < ? THEN -1 ELSE priority END, id""",
+                          (time.time() - self._max_wait, )).fetchall()
+        changed = []
+        for position, (job_id, job, old_position) in enumerate(rows, start = 1):
+            if position != old_position:
+                db.execute("UPDATE jobs SET position=? WHERE id=?", (position, job_id))
+                changed.append((job, position))
+
+        return changed
+
+    def _reap(self, db):
+        """Remove jobs running in processes that have died, returning them"""
+        lost = []
+        rows = db.execute("""SELECT id, job, running_pid FROM jobs
+                          WHERE running_pid IS NOT NULL""").fetchall()
+        for job_id, job, pid in rows:
+            try:
+                os.kill(pid, 0)
+                continue
+            except ProcessLookupError:
+                pass
+            except PermissionError:
+                continue  # Exists, as another user
+
+            logging.error(f"Web server process {pid} died while running job {job_id}")
+            db.execute("DELETE FROM jobs WHERE id=?", (job_id, ))
+            lost.append(job)
+
+        return lost
+
+    def _report(self, changed, lost = ()):
+        # Outside the transaction, as these send status messages
+        if self._notify is not None:
+            for job, position in changed:
+                self._notify(pickle.loads(job), position)
+
+        if self._lost is not None:
+            for job in lost:
+                self._lost(pickle.loads(job))
+
+    def put(self, job, priority = 0):
+        with self._transaction() as db:
+            db.execute("""INSERT INTO jobs (job, priority, queued)
+                       VALUES (?,?,?)""",
+                       (pickle.dumps(job), priority, time.time()))
+            changed = self._update_positions(db)
+
+        self._report(changed)
+        with self._cond:
+            self._cond.notify()
+
+    def _claim(self):
+        with self._transaction() as db:
+            lost = self._reap(db)
+            running, = db.execute("""SELECT COUNT(*) FROM jobs
+                                  WHERE running_pid IS NOT NULL""").fetchone()
+            row = None
+            changed = []
+            if running < self._max_running:
+                row = db.execute("""SELECT id, job FROM jobs WHERE running_pid IS NULL
+                                 ORDER BY CASE WHEN queued < ? THEN -1 ELSE priority END, id
+                                 LIMIT 1""",
+                                 (time.time() - self._max_wait, )).fetchone()
+            if row is not None:
+                db.execute("UPDATE jobs SET running_pid=?, position=NULL WHERE id=?",
+                           (os.getpid(), row[0]))
+                changed = self._update_positions(db)
+
+        self._report(changed, lost)
+        if row is None:
+            return None
+
+        return row[0], pickle.loads(row[1])
+
+    def get(self):
+        """Block until a job may be started, and return (job_id, job). Call
+        task_done(job_id) once it has finished."""
+        while True:
+            claimed = self._claim()
+            if claimed is not None:
+                return claimed
+
+            with self._cond:
+                self._cond.wait(self.poll_interval)
+
+    def task_done(self, job_id):
+        with self._transaction() as db:
+            db.execute("DELETE FROM jobs WHERE id=?", (job_id, ))
+
+        with self._cond:
+            self._cond.notify_all()
+
+
+class GeneratorPool:
+    """Fixed-size pool of long-lived map generator processes.
+
+    Each worker imports pygmt, GDAL etc. and starts GMT once, when it is
+    started, rather than for every map. Workers are replaced after
+    `max_jobs` maps, or once they grow past `max_rss` bytes.
+
+    Jobs are queued in a JobScheduler shared by every web server process,
+    and run by whichever process has a worker free. No more than
+    `max_running` maps are generated at once across all of them. Waiting
+    jobs are told their position in the queue through their status pipe.
+    """
+
+    def __init__(self, size = None, max_jobs = None, max_rss = None,
+                 max_running = None):
+        if size is None:
+            size = getattr(config, 'GENERATOR_WORKERS', 2)
+        if max_jobs is None:
+            max_jobs = getattr(config, 'GENERATOR_MAX_JOBS', 25)
+        if max_rss is None:
+            max_rss = getattr(config, 'GENERATOR_MAX_RSS', 2 * 1024 ** 3)
+        if max_running is None:
+            max_running = getattr(config, 'MAX_CONCURRENT_JOBS', size)
+
+        self._ctx = multiprocessing.get_context('spawn')
+        self._max_jobs = max_jobs
+        self._max_rss = max_rss
+        self._jobs = JobScheduler(max_running,
+                                  notify = self._queue_status,
+                                  lost = self._job_lost)
+
+        for idx in range(size):
+            thread = threading.Thread(target = self._run_worker,
+                                      args = (idx, ),
+                                      daemon = True)
+            thread.start()
+
+    def submit(self, generator, status_pipe, req_id, priority = 0,
+               callback = None):
+        """Queue generator.generate(status_pipe, req_id) to run in the pool.
+
+        If given, callback(req_id) is called once the job has finished,
+        whether or not it succeeded.
+        """
+        self._jobs.put(((generator, status_pipe, req_id), callback), priority)
+
+    @staticmethod
+    def _queue_status(job, position):
+        (generator, status_pipe, req_id), callback = job
+        if position == 1:
+            status = "Waiting for the next available map generator..."
+        else:
+            status = f"Waiting in queue (position {position})..."
+
+        _global_session.set_status(req_id, status)
+        try:
+            status_pipe.send(status)
+        except OSError:
+            pass  # Web socket has been closed
+        finally:
+            status_pipe.close()
+
+    @staticmethod
+    def _job_lost(job):
+        (generator, status_pipe, req_id), callback = job
+        try:
+            status_pipe.send('ERROR')
+        except OSError:
+            pass
+        finally:
+            status_pipe.close()
+
+        generator._gen_fail_callback(req_id, RuntimeError("Web server process died"))
+        shutil.rmtree(generator.tempdir(), ignore_errors = True)
+        if callback is not None:
+            callback(req_id)
+
+    def _start_worker(self):
+        parent_conn, child_conn = self._ctx.Pipe()
+        proc = self._ctx.Process(target = _worker_main,
+                                 args = (child_conn, self._max_jobs, self._max_rss),
+                                 daemon = True)
+        proc.start()
+        child_conn.close()
+        # Wait for the worker to finish warming up before handing it jobs
+        if parent_conn.recv() != 'READY':
+            raise RuntimeError("Generator worker failed to start")
+
+        logging.info(f"Generator worker {proc.pid} ready")
+        return proc, parent_conn
+
+    def _run_worker(self, idx):
+        # One thread per worker process, feeding it jobs and replacing it
+        # when it exits.
+        while True:
+            try:
+                proc, conn = self._start_worker()
+            except (EOFError, OSError, RuntimeError):
+                logging.exception(f"Unable to start generator worker {idx}")
+                time.sleep(5)
+                continue
+
+            while True:
+                job_id, (job, callback) = self._jobs.get()
+                generator, status_pipe, req_id = job
+                try:
+                    conn.send(job)
+                    result = conn.recv()
+                except (EOFError, OSError):
+                    logging.error(f"Generator worker {proc.pid} died while generating a map")
+                    try:
+                        status_pipe.send('ERROR')
+                    except OSError:
+                        pass
+                    generator._gen_fail_callback(req_id, RuntimeError("Generator worker died"))
+                    break
+                finally:
+                    self._jobs.task_done(job_id)
+                    if callback is not None:
+                        callback(req_id)
+                    status_pipe.close()
+
+                if result == 'RECYCLE':
+                    break
+
+            conn.close()
+            proc.join()